@@ -1,16 +1,65 @@
 import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from dotenv import load_dotenv
 from colorama import Fore, Style
 
 from utils.log_formmating import current_timedate_and_func_name
 
-from db_app.config import aws_clients_ec2
+from db_app.config import get_aws_clients_ec2
 
 load_dotenv()
 
 
-def get_all_ec2_dns_names():
+EC2_CACHE_TTL = float(os.getenv("ec2_cache_ttl", 300))
+EC2_INVENTORY_PATH = os.getenv("ec2_inventory_path")
+EXCLUDED_DNS_NAMES = {"ec2-184-72-156-151.compute-1.amazonaws.com"}
+
+_dns_names_cache = {"expires_at": 0.0, "dns_names": None}
+
+
+def describe_running_instances(client) -> list[dict]:
     active_dns_names = []
+    instances = client.describe_instances()
+
+    for reservation in instances["Reservations"]:
+        for instance in reservation["Instances"]:
+            if instance["State"]["Name"] == "running" and instance["PublicDnsName"] not in EXCLUDED_DNS_NAMES:
+                active_dns_names.append(
+                    {
+                        "dns_name": instance["PublicDnsName"],
+                        "instance_id": instance["KeyName"] + ".pem",
+                    }
+                )
+    return active_dns_names
+
+
+def load_ec2_inventory(path: str) -> list[dict]:
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_ec2_inventory(path: str, dns_names: list[dict]) -> None:
+    with open(path, "w") as file:
+        json.dump(dns_names, file, indent=4)
+
+
+def clear_ec2_cache() -> None:
+    _dns_names_cache["expires_at"] = 0.0
+    _dns_names_cache["dns_names"] = None
+
+
+def get_all_ec2_dns_names(ttl: float = EC2_CACHE_TTL, inventory_path: str | None = EC2_INVENTORY_PATH):
+    # Cached for ttl seconds. With an inventory file (ec2_inventory_path) AWS is never queried.
+    if inventory_path:
+        return load_ec2_inventory(inventory_path)
+
+    now = time.monotonic()
+    if _dns_names_cache["dns_names"] is not None and now < _dns_names_cache["expires_at"]:
+        return list(_dns_names_cache["dns_names"])
 
     print(
         (
@@ -19,18 +68,10 @@ def get_all_ec2_dns_names():
         )
     )
 
-    for client in aws_clients_ec2:
-        instances = client.describe_instances()
-
-        for reservation in instances["Reservations"]:
-            for instance in reservation["Instances"]:
-                if instance["State"]["Name"] == "running" and instance["PublicDnsName"] != "ec2-184-72-156-151.compute-1.amazonaws.com":
-                    active_dns_names.append(
-                        {
-                            "dns_name": instance["PublicDnsName"],
-                            "instance_id": instance["KeyName"] + ".pem",
-                        }
-                    )
+    clients = get_aws_clients_ec2()
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        regions = list(executor.map(describe_running_instances, clients))
+    active_dns_names = [dns_name for region in regions for dns_name in region]
 
     print(
         (
@@ -40,34 +81,60 @@ def get_all_ec2_dns_names():
         )
     )
     print(active_dns_names)
-    return active_dns_names
+    _dns_names_cache["dns_names"] = active_dns_names
+    _dns_names_cache["expires_at"] = now + ttl
+    return list(active_dns_names)
+
+
+async def get_all_ec2_dns_names_async(ttl: float = EC2_CACHE_TTL, inventory_path: str | None = EC2_INVENTORY_PATH):
+    return await asyncio.to_thread(get_all_ec2_dns_names, ttl, inventory_path)
+
+
+async def wait_for_instances(client, waiter_name: str, instance_ids: list[str]) -> None:
+    if instance_ids:
+        await asyncio.to_thread(client.get_waiter(waiter_name).wait, InstanceIds=instance_ids)
 
 
 async def start_stop_instances():
-    for client in aws_clients_ec2:
+    # Waits on the EC2 waiters instead of fixed sleeps; returns the new DNS names.
+    clients = get_aws_clients_ec2()
+    stopped_ids = []
+    for client in clients:
         instances = client.describe_instances()
+        instance_ids = []
 
         for reservation in instances["Reservations"]:
             for instance in reservation["Instances"]:
-                if instance["State"]["Name"] == "running" and instance["PublicDnsName"] != "ec2-184-72-156-151.compute-1.amazonaws.com":
-                    client.stop_instances(InstanceIds=[instance["InstanceId"]])
-                    print(f"{current_timedate_and_func_name()} Stopped instance {instance['InstanceId']}, old IP: {instance['PublicIpAddress']}")
-    await asyncio.sleep(60)
-    for client in aws_clients_ec2:
+                if instance["State"]["Name"] == "running" and instance["PublicDnsName"] not in EXCLUDED_DNS_NAMES:
+                    instance_ids.append(instance["InstanceId"])
+                    print(f"{current_timedate_and_func_name()} Stopping instance {instance['InstanceId']}, old IP: {instance['PublicIpAddress']}")
+        if instance_ids:
+            client.stop_instances(InstanceIds=instance_ids)
+        stopped_ids.append(instance_ids)
+    await asyncio.gather(
+        *(wait_for_instances(client, "instance_stopped", ids) for client, ids in zip(clients, stopped_ids))
+    )
+
+    started_ids = []
+    for client in clients:
         instances = client.describe_instances()
+        instance_ids = [
+            instance["InstanceId"]
+            for reservation in instances["Reservations"]
+            for instance in reservation["Instances"]
+            if instance["State"]["Name"] == "stopped"
+        ]
+        if instance_ids:
+            client.start_instances(InstanceIds=instance_ids)
+            print(f"{current_timedate_and_func_name()} Started instances {instance_ids}.")
+        started_ids.append(instance_ids)
+    await asyncio.gather(
+        *(wait_for_instances(client, "instance_running", ids) for client, ids in zip(clients, started_ids))
+    )
 
-        for reservation in instances["Reservations"]:
-            for instance in reservation["Instances"]:
-                if instance["State"]["Name"] == "stopped":
-                    client.start_instances(InstanceIds=[instance["InstanceId"]])
-                    print(f"{current_timedate_and_func_name()} Started instance {instance['InstanceId']}.")
-
-    print(f"{current_timedate_and_func_name()} Seeping... 3 minutes left")
-    await asyncio.sleep(60)
-    print(f"{current_timedate_and_func_name()} Seeping... 2 minutes left")
-    await asyncio.sleep(60)
-    print(f"{current_timedate_and_func_name()} Seeping... 1 minutes left")
-    await asyncio.sleep(60)
+    # Restarted instances come back with new public DNS names.
+    clear_ec2_cache()
+    return get_all_ec2_dns_names()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,198 @@
+import asyncio
+import math
+import os
+
+import aiohttp
+import asyncssh
+from asyncssh.misc import HostKeyNotVerifiable
+from colorama import Fore, Style
+from dotenv import load_dotenv
+
+from utils.log_formmating import current_timedate_and_func_name
+
+load_dotenv()
+
+
+TINYPROXY_PORT = 8888
+PROBE_URL = "https://api.binance.com/api/v3/ping"
+RESTART_COMMAND = "sudo systemctl restart tinyproxy"
+
+
+class ProxyRecycler:
+    # Restarts tinyproxy over persistent SSH connections in rolling batches, so the rest
+    # of the fleet keeps serving, and hands each proxy back once a probe through it passes.
+    # SSH settings left as None are read from the environment here, not at import time.
+    def __init__(
+            self,
+            port: int | None = None,
+            username: str | None = None,
+            keys_path: str | None = None,
+            proxy_port: int = TINYPROXY_PORT,
+            probe_url: str = PROBE_URL,
+            command: str = RESTART_COMMAND,
+            batch_fraction: float = 0.25,
+            probe_timeout: float = 5.0,
+            ready_timeout: float = 60.0,
+            max_attempts: int = 5,
+            retry_interval: float = 30.0,
+            connect=asyncssh.connect,
+    ):
+        self.port = port if port is not None else int(os.getenv("ssh_server_port", "22"))
+        self.username = username if username is not None else os.getenv("ssh_server_username")
+        self.keys_path = keys_path if keys_path is not None else os.getenv("general_keys_path", "")
+        self.proxy_port = proxy_port
+        self.probe_url = probe_url
+        self.command = command
+        self.batch_fraction = batch_fraction
+        self.probe_timeout = probe_timeout
+        self.ready_timeout = ready_timeout
+        self.max_attempts = max_attempts
+        self.retry_interval = retry_interval
+        self.connect = connect
+        self.connections = {}
+        # {proxy: task probing a proxy that stays drained until it passes}
+        self.reprobes = {}
+
+    async def __aenter__(self) -> "ProxyRecycler":
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        await self.close()
+
+    def proxy_url(self, server: dict) -> str:
+        return f"http://{server.get('dns_name')}:{self.proxy_port}"
+
+    async def connection(self, server: dict):
+        host = server.get("dns_name")
+        conn = self.connections.get(host)
+        if conn is not None and not conn.is_closed():
+            return conn
+
+        for attempt in range(self.max_attempts):
+            try:
+                conn = await self.connect(
+                    host=host,
+                    port=self.port,
+                    username=self.username,
+                    client_keys=f"{self.keys_path}{server.get('instance_id')}",
+                )
+                print(f"{current_timedate_and_func_name()} Connected to {Fore.GREEN}{host}{Style.RESET_ALL}")
+                self.connections[host] = conn
+                return conn
+            except HostKeyNotVerifiable as e:
+                # ssh_proxies reads its SSH settings at import, so it is only imported when needed.
+                from aws_ssh_app.ssh_proxies import add_server_to_known_hosts
+
+                print(f"{current_timedate_and_func_name()} {Fore.RED}{e}{Style.RESET_ALL}")
+                await add_server_to_known_hosts(host)
+            except (OSError, asyncssh.Error) as e:
+                delay = min(30, 2 ** attempt)
+                print(f"{current_timedate_and_func_name()} {Fore.RED}{e}{Style.RESET_ALL}, retrying in {delay} sec")
+                await asyncio.sleep(delay)
+        raise ConnectionError(f"Could not connect to {host} after {self.max_attempts} attempts")
+
+    async def restart(self, server: dict) -> None:
+        host = server.get("dns_name")
+        for attempt in range(self.max_attempts):
+            conn = await self.connection(server)
+            try:
+                await conn.run(self.command, check=True)
+                print(f"{current_timedate_and_func_name()} {Fore.RED}{self.command}{Style.RESET_ALL} succeeded with {host}")
+                return
+            except (OSError, asyncssh.Error) as e:
+                # A dropped connection is reopened on the next attempt.
+                self.connections.pop(host, None)
+                conn.close()
+                delay = min(30, 2 ** attempt)
+                print(f"{current_timedate_and_func_name()} {Fore.RED}{e}{Style.RESET_ALL}, retrying in {delay} sec")
+                await asyncio.sleep(delay)
+        raise ConnectionError(f"Could not restart tinyproxy on {host} after {self.max_attempts} attempts")
+
+    async def probe(self, session: aiohttp.ClientSession, proxy: str) -> bool:
+        try:
+            async with session.get(self.probe_url, proxy=proxy, ssl=False) as resp:
+                return resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def wait_ready(self, server: dict) -> bool:
+        proxy = self.proxy_url(server)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.ready_timeout
+        delay = 0.1
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.probe_timeout)) as session:
+            while loop.time() < deadline:
+                if await self.probe(session, proxy):
+                    return True
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+        return False
+
+    async def reprobe(self, server: dict, pool) -> None:
+        proxy = self.proxy_url(server)
+        try:
+            while True:
+                await asyncio.sleep(self.retry_interval)
+                if await self.wait_ready(server):
+                    print(f"{current_timedate_and_func_name()} {Fore.GREEN}{proxy} is ready{Style.RESET_ALL}")
+                    await pool.resume(proxy)
+                    return
+        finally:
+            if self.reprobes.get(proxy) is asyncio.current_task():
+                del self.reprobes[proxy]
+
+    async def recycle_one(self, server: dict, pool=None) -> bool:
+        proxy = self.proxy_url(server)
+        previous = self.reprobes.pop(proxy, None)
+        if previous is not None:
+            previous.cancel()
+        if pool is not None:
+            await pool.drain(proxy)
+        try:
+            await self.restart(server)
+            ready = await self.wait_ready(server)
+        except ConnectionError as e:
+            print(f"{current_timedate_and_func_name()} {Fore.RED}{e}{Style.RESET_ALL}")
+            ready = False
+
+        if ready:
+            print(f"{current_timedate_and_func_name()} {Fore.GREEN}{proxy} is ready{Style.RESET_ALL}")
+            if pool is not None:
+                await pool.resume(proxy)
+        else:
+            print(f"{current_timedate_and_func_name()} {Fore.RED}{proxy} did not become ready{Style.RESET_ALL}")
+            if pool is not None:
+                # An unready proxy stays drained and only goes back once a later probe passes.
+                self.reprobes[proxy] = asyncio.create_task(self.reprobe(server, pool))
+        return ready
+
+    async def recycle(self, servers: list[dict], pool=None) -> list[dict]:
+        # pool is a client_API.proxy_pool.ProxyPool whose proxies are drained around restarts.
+        # At most batch_fraction of the fleet is down at once; a slow server holds only its own slot.
+        slots = asyncio.Semaphore(max(1, math.floor(len(servers) * self.batch_fraction)))
+
+        async def recycle_in_slot(server: dict) -> bool:
+            async with slots:
+                return await self.recycle_one(server, pool)
+
+        results = await asyncio.gather(*(recycle_in_slot(server) for server in servers))
+        ready_servers = [server for server, ready in zip(servers, results) if ready]
+        print(
+            f"{current_timedate_and_func_name()} Recycled proxies, "
+            f"{Fore.BLUE}ready: {len(ready_servers)} of {len(servers)}{Style.RESET_ALL}"
+        )
+        return ready_servers
+
+    async def wait_all_ready(self, servers: list[dict]) -> list[dict]:
+        results = await asyncio.gather(*(self.wait_ready(server) for server in servers))
+        return [server for server, ready in zip(servers, results) if ready]
+
+    async def close(self) -> None:
+        reprobes = list(self.reprobes.values())
+        for task in reprobes:
+            task.cancel()
+        await asyncio.gather(*reprobes, return_exceptions=True)
+        for conn in self.connections.values():
+            conn.close()
+        await asyncio.gather(*(conn.wait_closed() for conn in self.connections.values()))
+        self.connections = {}
@@ -0,0 +1,253 @@
+import asyncio
+from datetime import datetime, timezone
+import logging
+import time
+
+import numpy as np
+
+from db_app.database import database
+from db_app.kline_cache import KlineCache, to_epoch_ms
+from indicators.vectorized import compute_provisional_macd, round_like_format
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+file_handler = logging.FileHandler('backtest.log')
+file_handler.setLevel(logging.INFO)
+
+file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(file_formatter)
+
+logger.addHandler(file_handler)
+
+HOUR_MS = 3_600_000
+
+MONITOR_INCREASE_STOCHASTIC = 0
+MONITOR_INCREASE_MACD = 1
+BUY_CRYPTO = 2
+MONITOR_SELL = 3
+SELL_CRYPTO = 4
+MONITOR_DECREASE_MACD = 5
+
+
+def klines_to_arrays(klines: list) -> dict[str, np.ndarray]:
+    # klines are [open_time, open, high, low, close] rows as used by SocketConn,
+    # or KLINE_DTYPE records, whose columns are used as they are.
+    if isinstance(klines, np.ndarray):
+        return {
+            "open_time": klines["open_time"],
+            "open": klines["open_price"],
+            "high": klines["high_price"],
+            "low": klines["low_price"],
+            "close": klines["close_price"],
+        }
+    return {
+        "open_time": np.fromiter((to_epoch_ms(kline[0]) for kline in klines), dtype=np.int64, count=len(klines)),
+        "open": np.fromiter((kline[1] for kline in klines), dtype=np.float64, count=len(klines)),
+        "high": np.fromiter((kline[2] for kline in klines), dtype=np.float64, count=len(klines)),
+        "low": np.fromiter((kline[3] for kline in klines), dtype=np.float64, count=len(klines)),
+        "close": np.fromiter((kline[4] for kline in klines), dtype=np.float64, count=len(klines)),
+    }
+
+
+def history_length_for_ticks(hour_open_time: np.ndarray, tick_open_time: np.ndarray, start_stream_ms: int) -> np.ndarray:
+    # own_socket.SocketConn commits the finished hour *after* the first tick of the
+    # next hour was evaluated, so tick i sees the hours before floor_hour(tick i - 1).
+    cut = np.empty_like(tick_open_time)
+    cut[0] = start_stream_ms
+    cut[1:] = tick_open_time[:-1] - tick_open_time[:-1] % HOUR_MS
+    return np.searchsorted(hour_open_time, cut, side="left")
+
+
+def prepare_backtest(
+        hour_klines: dict[str, np.ndarray],
+        tick_klines: dict[str, np.ndarray],
+        start_stream: datetime,
+) -> dict[str, np.ndarray]:
+    history_length = history_length_for_ticks(
+        hour_klines["open_time"],
+        tick_klines["open_time"],
+        to_epoch_ms(start_stream),
+    )
+    indicators = compute_provisional_macd(
+        hour_klines["high"],
+        hour_klines["low"],
+        hour_klines["close"],
+        history_length,
+        tick_klines["high"],
+        tick_klines["low"],
+        tick_klines["close"],
+    )
+    return {
+        "open_time": tick_klines["open_time"],
+        "hour": (tick_klines["open_time"] // HOUR_MS) % 24,
+        "close": tick_klines["close"],
+        "macD": round_like_format(indicators["macD"]),
+        "signal": round_like_format(indicators["signal"]),
+        "%K": round_like_format(indicators["%K"]),
+        "%D": round_like_format(indicators["%D"]),
+    }
+
+
+def first_index(condition, start: int, stop: int, block: int = 4096) -> int | None:
+    # Scans condition(start, end) -> bool array in growing blocks, so a trigger
+    # close to ``start`` does not cost a pass over the whole series.
+    while start < stop:
+        end = min(start + block, stop)
+        hits = np.flatnonzero(condition(start, end))
+        if len(hits):
+            return start + int(hits[0])
+        start = end
+        block *= 2
+    return None
+
+
+def run_backtest(
+        series: dict[str, np.ndarray],
+        macd_increase_target: float,
+        budget: float = 800,
+        search_for_trend: str = "decrease",
+        take_profit: float = 1.015,
+        stoch_increase_diff: float = 3.5,
+        stoch_confirm_diff: float = 0.5,
+) -> dict:
+    # Same transitions as own_socket.SocketConn, but instead of visiting every tick
+    # it jumps straight to the next tick where the current monitor would fire.
+    # A monitor that fires on tick i hands over to the next method from tick i + 1.
+    macd_values = series["macD"]
+    signal_values = series["signal"]
+    k_values = series["%K"]
+    d_values = series["%D"]
+    close_values = series["close"]
+    hours = series["hour"]
+    open_times = series["open_time"]
+    total = len(close_values)
+
+    state = MONITOR_INCREASE_STOCHASTIC if search_for_trend == "increase" else MONITOR_INCREASE_MACD
+    bought_crypto_price = None
+    bought_crypto_amount = None
+    bought_hour = None
+    bought_time = None
+    trades = []
+    budgets = [budget]
+    index = 0
+
+    def macd_below_signal(start: int, end: int) -> np.ndarray:
+        return (hours[start:end] != bought_hour) & (macd_values[start:end] < signal_values[start:end])
+
+    while index < total:
+        if state == MONITOR_INCREASE_STOCHASTIC:
+            fired = first_index(
+                lambda start, end: k_values[start:end] - d_values[start:end] >= stoch_increase_diff,
+                index,
+                total,
+            )
+            next_state = MONITOR_INCREASE_MACD
+        elif state == MONITOR_INCREASE_MACD:
+            fired = first_index(
+                lambda start, end: (
+                    (macd_values[start:end] - signal_values[start:end] >= macd_increase_target)
+                    & (k_values[start:end] - d_values[start:end] >= stoch_confirm_diff)
+                ),
+                index,
+                total,
+            )
+            next_state = BUY_CRYPTO
+        elif state == BUY_CRYPTO:
+            bought_crypto_price = float(close_values[index]) + 0.10
+            bought_crypto_amount = budget / bought_crypto_price
+            bought_hour = int(hours[index])
+            bought_time = int(open_times[index])
+            fired = index
+            next_state = MONITOR_SELL
+        elif state == MONITOR_SELL:
+            profit_target = (bought_crypto_price * take_profit) - bought_crypto_price
+            fired = first_index(
+                lambda start, end: (
+                    ((close_values[start:end] - bought_crypto_price) >= profit_target)
+                    | macd_below_signal(start, end)
+                ),
+                index,
+                total,
+            )
+            next_state = SELL_CRYPTO
+        elif state == SELL_CRYPTO:
+            close_price = float(close_values[index])
+            clean_profit = ((bought_crypto_amount * close_price) - budget) - 0.38
+            budget += clean_profit
+            budgets.append(budget)
+            trades.append((bought_time, bought_crypto_price, int(open_times[index]), close_price, clean_profit))
+            fired = index
+            next_state = MONITOR_DECREASE_MACD
+        else:
+            fired = first_index(macd_below_signal, index, total)
+            next_state = MONITOR_INCREASE_MACD
+
+        if fired is None:
+            break
+        index = fired + 1
+        state = next_state
+
+    budgets = np.asarray(budgets)
+    drawdown = np.maximum.accumulate(budgets) - budgets
+    return {
+        "budget": budget,
+        "trades": trades,
+        "max_drawdown": float(drawdown.max()),
+    }
+
+
+async def load_kline_arrays(
+        cache: KlineCache,
+        symbol: str,
+        interval: str,
+        start: datetime,
+        end: datetime,
+) -> dict[str, np.ndarray]:
+    columns = await cache.load_or_fill(
+        symbol,
+        interval,
+        start,
+        end,
+        columns=["open_time", "open_price", "high_price", "low_price", "close_price"],
+    )
+    return {
+        "open_time": columns["open_time"],
+        "open": columns["open_price"],
+        "high": columns["high_price"],
+        "low": columns["low_price"],
+        "close": columns["close_price"],
+    }
+
+
+async def main(start_stream: datetime, stream_interval: str = "1m"):
+    cache = KlineCache()
+    now = datetime.now(timezone.utc)
+    async with database:
+        hour_klines = await load_kline_arrays(
+            cache, "ETHUSDT", "1h", datetime(2023, 6, 1, tzinfo=timezone.utc), now,
+        )
+        stream_klines = await load_kline_arrays(cache, "ETHUSDT", stream_interval, start_stream, now)
+    logger.info(f"{len(hour_klines['close'])} hour klines, {len(stream_klines['close'])} klines in stream")
+
+    started = time.perf_counter()
+    series = prepare_backtest(hour_klines, stream_klines, start_stream)
+    result = run_backtest(series, macd_increase_target=0.75, budget=700)
+    logger.info(f"Backtest done in {time.perf_counter() - started:.2f} sec")
+
+    for bought_time, bought_price, sold_time, sold_price, clean_profit in result["trades"]:
+        logger.info(
+            f"Bought {datetime.fromtimestamp(bought_time / 1000, tz=timezone.utc)} for {bought_price}, "
+            f"sold {datetime.fromtimestamp(sold_time / 1000, tz=timezone.utc)} for {sold_price}, "
+            f"profit: {clean_profit}"
+        )
+    print(f"Total trades: {len(result['trades'])}, max drawdown: {result['max_drawdown']}")
+    print(f"Last budget is: {result['budget']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(
+        start_stream=datetime(
+            2024, 1, 1, hour=0, tzinfo=timezone.utc,
+        )
+    ))
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+import aiohttp
+
+from utils.decoders import DECODERS
+
+BASE_API_URL = "https://api.binance.com/api/v3/"
+STREAM_URL = "wss://stream.binance.com:9443/ws/ethusdt@kline_1s"
+PAYLOADS_PATH = os.path.join(os.path.dirname(__file__), "payloads")
+
+
+async def record_payloads(path: str = PAYLOADS_PATH, symbol: str = "ETHUSDT", events: int = 200) -> None:
+    # Saves one REST klines page, one aggTrades page and a run of websocket kline events.
+    os.makedirs(path, exist_ok=True)
+    async with aiohttp.ClientSession() as session:
+        for name, endpoint, params in (
+                ("rest_klines", "klines", {"symbol": symbol, "interval": "1s", "limit": 1000}),
+                ("agg_trades", "aggTrades", {"symbol": symbol, "limit": 1000}),
+        ):
+            async with session.get(f"{BASE_API_URL}{endpoint}", params=params) as resp:
+                with open(os.path.join(path, f"{name}.json"), "wb") as file:
+                    file.write(await resp.read())
+
+        async with session.ws_connect(STREAM_URL) as ws:
+            with open(os.path.join(path, "kline_events.jsonl"), "w") as file:
+                for _ in range(events):
+                    msg = await ws.receive()
+                    file.write(msg.data + "\n")
+
+
+def synthetic_payloads(rows: int = 1000, events: int = 200) -> dict:
+    # Same shapes as the recorded payloads, for machines without access to Binance.
+    start = 1_706_745_600_000
+    price = 2300.0
+    klines = []
+    trades = []
+    for index in range(rows):
+        price += random.uniform(-1, 1)
+        klines.append(
+            [
+                start + index * 1000, f"{price:.8f}", f"{price + 0.5:.8f}", f"{price - 0.5:.8f}", f"{price:.8f}",
+                f"{random.uniform(0, 50):.8f}", start + index * 1000 + 999, f"{random.uniform(0, 1e5):.8f}",
+                random.randint(1, 200), f"{random.uniform(0, 25):.8f}", f"{random.uniform(0, 5e4):.8f}", "0",
+            ]
+        )
+        trades.append(
+            {
+                "a": 1_000_000 + index, "p": f"{price:.8f}", "q": f"{random.uniform(0, 5):.8f}",
+                "f": 5_000_000 + 2 * index, "l": 5_000_001 + 2 * index, "T": start + index * 7,
+                "m": random.random() < 0.5, "M": True,
+            }
+        )
+    kline_events = [
+        json.dumps(
+            {
+                "e": "kline", "E": start + index, "s": "ETHUSDT",
+                "k": {
+                    "t": start, "T": start + 999, "s": "ETHUSDT", "i": "1s", "f": 1, "L": 2,
+                    "o": f"{price:.8f}", "c": f"{price:.8f}", "h": f"{price:.8f}", "l": f"{price:.8f}",
+                    "v": "1.00000000", "n": 2, "x": False, "q": "2300.00000000", "V": "0.5", "Q": "1150.0", "B": "0",
+                },
+            }
+        )
+        for index in range(events)
+    ]
+    return {
+        "rest_klines": json.dumps(klines).encode(),
+        "agg_trades": json.dumps(trades).encode(),
+        "kline_events": kline_events,
+    }
+
+
+def load_payloads(path: str = PAYLOADS_PATH) -> tuple[dict, str]:
+    if not os.path.exists(os.path.join(path, "rest_klines.json")):
+        return synthetic_payloads(), "synthetic"
+    payloads = {}
+    for name in ("rest_klines", "agg_trades"):
+        with open(os.path.join(path, f"{name}.json"), "rb") as file:
+            payloads[name] = file.read()
+    with open(os.path.join(path, "kline_events.jsonl")) as file:
+        payloads["kline_events"] = [line for line in file if line.strip()]
+    return payloads, "recorded"
+
+
+def time_per_call(function, payload, repeat: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        function(payload)
+    return (time.perf_counter() - started_at) / repeat
+
+
+def run(repeat: int = 200) -> list[dict]:
+    payloads, source = load_payloads()
+    results = []
+    for backend, decoder_class in DECODERS.items():
+        decoder = decoder_class()
+        results.append(
+            {
+                "backend": backend,
+                "rest_klines_us": time_per_call(decoder.rest_klines, payloads["rest_klines"], repeat) * 1e6,
+                "agg_trades_us": time_per_call(decoder.agg_trades, payloads["agg_trades"], repeat) * 1e6,
+                "kline_event_us": sum(
+                    time_per_call(decoder.kline_event, event, repeat) for event in payloads["kline_events"]
+                ) / len(payloads["kline_events"]) * 1e6,
+            }
+        )
+
+    baseline = results[0]
+    print(f"Decoding {source} payloads, microseconds per call:")
+    for result in results:
+        print(
+            f"{result['backend']:>8}: "
+            + ", ".join(
+                f"{name[:-3]} {result[name]:.1f} (x{baseline[name] / result[name]:.2f})"
+                for name in ("rest_klines_us", "agg_trades_us", "kline_event_us")
+            )
+        )
+    return results
+
+
+if __name__ == "__main__":
+    if os.getenv("record_payloads"):
+        asyncio.run(record_payloads())
+    run()
@@ -0,0 +1,242 @@
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+from backtest import klines_to_arrays, prepare_backtest, run_backtest
+from benchmarks.bench_decoders import load_payloads
+from client_API.trade_linking import MINUTE_MS, link_trades_to_klines
+from db_app.bulk_copy import encode_klines, encode_trades, kline_writer, trade_writer
+from db_app.kline_cache import KLINE_DTYPE, from_epoch_ms, kline_rows
+from db_app.record_buffers import TRADE_DTYPE
+from indicators.incremental import IncrementalMACD
+from indicators.MACD import search_macd
+from indicators.vectorized import compute_macd
+from utils.decoders import get_decoder
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+HOUR_MS = 3_600_000
+START_MS = 1_672_531_200_000
+# Slower than baseline by more than this fraction counts as a regression.
+TOLERANCE = float(os.getenv("bench_tolerance", "0.2"))
+
+
+def synthetic_klines(count: int, interval_ms: int = HOUR_MS, start: int = START_MS, seed: int = 0) -> np.ndarray:
+    # Random walk candles in KLINE_DTYPE; a fixed seed keeps runs comparable.
+    rng = np.random.default_rng(seed)
+    records = np.zeros(count, dtype=KLINE_DTYPE)
+    close = 2000 + np.cumsum(rng.normal(0, 5, count))
+    records["open_time"] = start + np.arange(count, dtype=np.int64) * interval_ms
+    records["close_time"] = records["open_time"] + interval_ms - 1
+    records["open_price"] = np.concatenate(([close[0]], close[:-1]))
+    records["close_price"] = close
+    records["high_price"] = np.maximum(records["open_price"], close) + rng.uniform(0, 3, count)
+    records["low_price"] = np.minimum(records["open_price"], close) - rng.uniform(0, 3, count)
+    records["volume"] = rng.uniform(0, 100, count)
+    records["number_of_trades"] = rng.integers(1, 1000, count)
+    return records
+
+
+def synthetic_trades(count: int, span_ms: int, start: int = START_MS, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    trades = np.zeros(count, dtype=TRADE_DTYPE)
+    trades["aggregated_trade_id"] = np.arange(count)
+    trades["price"] = 2000 + rng.normal(0, 5, count)
+    trades["quantity"] = rng.uniform(0, 5, count)
+    trades["first_trade_id"] = 2 * np.arange(count)
+    trades["last_trade_id"] = 2 * np.arange(count) + 1
+    trades["trade_time"] = np.sort(start + rng.integers(0, span_ms, count))
+    trades["flags"] = rng.integers(0, 4, count)
+    trades["kline_id"] = np.arange(count) // 100
+    return trades
+
+
+def autorange(function, min_time: float = 0.2) -> int:
+    number = 1
+    while True:
+        started_at = time.perf_counter()
+        for _ in range(number):
+            function()
+        if time.perf_counter() - started_at >= min_time:
+            return number
+        number *= 2
+
+
+def measure(function, repeat: int = 5) -> float:
+    # Best per-call time over several rounds, like timeit.
+    number = autorange(function)
+    best = float("inf")
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - started_at) / number)
+    return best
+
+
+def indicator_cases() -> dict:
+    cases = {}
+    for label, count in (("1k", 1_000), ("100k", 100_000), ("1m", 1_000_000)):
+        columns = klines_to_arrays(synthetic_klines(count))
+        cases[f"compute_macd_{label}"] = lambda columns=columns: compute_macd(
+            columns["high"], columns["low"], columns["close"], short_period=1, long_period=6,
+        )
+    for label, count in (("1k", 1_000), ("100k", 100_000)):
+        rows = kline_rows(synthetic_klines(count))
+        cases[f"search_macd_{label}"] = lambda rows=rows: search_macd(rows, short_period=1, long_period=6)
+
+    history = kline_rows(synthetic_klines(1_000))
+    engine = IncrementalMACD.from_klines(history, short_period=1, long_period=6)
+    tick = history[-1]
+    cases["incremental_peek_tick"] = lambda: engine.peek(tick)
+    cases["incremental_from_klines_1k"] = lambda: IncrementalMACD.from_klines(history, short_period=1, long_period=6)
+    return cases
+
+
+def parsing_cases() -> dict:
+    payloads, source = load_payloads()
+    decoder = get_decoder()
+    event = payloads["kline_events"][0]
+    return {
+        f"decode_rest_klines_{source}": lambda: decoder.rest_klines(payloads["rest_klines"]),
+        f"decode_agg_trades_{source}": lambda: decoder.agg_trades(payloads["agg_trades"]),
+        f"decode_kline_event_{source}": lambda: decoder.kline_event(event),
+    }
+
+
+def linking_cases() -> dict:
+    klines = synthetic_klines(10_000, interval_ms=MINUTE_MS)
+    trades = synthetic_trades(1_000_000, 10_000 * MINUTE_MS)
+    kline_ids = np.arange(len(klines), dtype=np.int64)
+    return {
+        "link_trades_1m": lambda: link_trades_to_klines(trades["trade_time"], klines["open_time"], kline_ids),
+    }
+
+
+def replay_cases() -> dict:
+    # A month of minute ticks over a year of hourly history, as backtest.main replays it.
+    hours = synthetic_klines(24 * 365)
+    ticks = synthetic_klines(30 * 24 * 60, interval_ms=MINUTE_MS, start=START_MS + 24 * 335 * HOUR_MS, seed=1)
+    start_stream = from_epoch_ms(int(ticks["open_time"][0]))
+    hour_columns = klines_to_arrays(hours)
+    tick_columns = klines_to_arrays(ticks)
+    series = prepare_backtest(hour_columns, tick_columns, start_stream)
+    return {
+        "prepare_backtest_month": lambda: prepare_backtest(hour_columns, tick_columns, start_stream),
+        "run_backtest_month": lambda: run_backtest(series, macd_increase_target=0.75, budget=700),
+    }
+
+
+def encoding_cases() -> dict:
+    klines = synthetic_klines(100_000, interval_ms=MINUTE_MS)
+    trades = synthetic_trades(100_000, 100_000 * MINUTE_MS)
+    return {
+        "encode_klines_100k": lambda: encode_klines(klines, "ETHUSDT", "1m"),
+        "encode_trades_100k": lambda: encode_trades(trades),
+    }
+
+
+async def bulk_write_results(dsn: str, rows: int = 100_000, repeat: int = 3) -> dict:
+    # COPY into temporary copies of the real tables, so nothing is left behind.
+    import asyncpg
+
+    klines = synthetic_klines(rows, interval_ms=MINUTE_MS)
+    trades = synthetic_trades(rows, rows * MINUTE_MS)
+    results = {}
+    connection = await asyncpg.connect(dsn)
+    try:
+        for name, make_writer, payload in (
+                ("copy_klines_100k", kline_writer, encode_klines(klines, "ETHUSDT", "1m")),
+                ("copy_trades_100k", trade_writer, encode_trades(trades)),
+        ):
+            writer = make_writer(connection=connection)
+            table = f"bench_{writer.table.lower()}"
+            await connection.execute(f'CREATE TEMP TABLE "{table}" (LIKE "{writer.table}" INCLUDING DEFAULTS)')
+            writer.table = table
+            best = float("inf")
+            for _ in range(repeat):
+                await connection.execute(f'TRUNCATE "{table}"')
+                started_at = time.perf_counter()
+                await writer.write_binary(payload, rows)
+                best = min(best, time.perf_counter() - started_at)
+            await connection.execute(f'DROP TABLE "{table}"')
+            results[name] = best
+    finally:
+        await connection.close()
+    return results
+
+
+def run(selected: str | None = None, dsn: str | None = None) -> dict[str, float]:
+    results = {}
+    for make_cases in (indicator_cases, parsing_cases, linking_cases, replay_cases, encoding_cases):
+        for name, function in make_cases().items():
+            if selected and selected not in name:
+                continue
+            results[name] = measure(function)
+            print(f"{name:>40}: {results[name] * 1e6:12.1f} us")
+    if dsn is not None:
+        for name, seconds in asyncio.run(bulk_write_results(dsn)).items():
+            if not selected or selected in name:
+                results[name] = seconds
+                print(f"{name:>40}: {seconds * 1e6:12.1f} us")
+    return results
+
+
+def machine() -> dict:
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def save_baseline(results: dict[str, float], path: str = BASELINE_PATH) -> None:
+    # Updates only the measured cases, so a filtered run keeps the rest of the baseline.
+    saved = {}
+    if os.path.exists(path):
+        with open(path) as file:
+            saved = json.load(file)["results"]
+    saved.update(results)
+    with open(path, "w") as file:
+        json.dump({"machine": machine(), "results": saved}, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def compare(results: dict[str, float], path: str = BASELINE_PATH, tolerance: float = TOLERANCE) -> list[str]:
+    # Prints current/baseline per case and returns the cases that regressed.
+    with open(path) as file:
+        baseline = json.load(file)
+    if baseline["machine"] != machine():
+        print(f"Baseline was recorded on {baseline['machine']}, ratios are only indicative")
+
+    regressions = []
+    print(f"{'case':>40}  {'baseline us':>12}  {'current us':>12}  ratio")
+    for name, seconds in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:>40}  {'-':>12}  {seconds * 1e6:12.1f}  new")
+            continue
+        ratio = seconds / before
+        verdict = ""
+        if ratio > 1 + tolerance:
+            verdict = "slower"
+            regressions.append(name)
+        elif ratio < 1 / (1 + tolerance):
+            verdict = "faster"
+        print(f"{name:>40}  {before * 1e6:12.1f}  {seconds * 1e6:12.1f}  x{ratio:.2f} {verdict}")
+    return regressions
+
+
+if __name__ == "__main__":
+    # bench_cases filters by substring, bench_dsn adds COPY timings against a Postgres with the schema.
+    results = run(os.getenv("bench_cases"), os.getenv("bench_dsn"))
+    if os.getenv("save_baseline") or not os.path.exists(BASELINE_PATH):
+        save_baseline(results)
+        print(f"Saved baseline to {BASELINE_PATH}")
+    elif compare(results):
+        sys.exit(1)
@@ -0,0 +1,189 @@
+import logging
+import math
+import os
+from datetime import datetime, timedelta, timezone
+
+from db_app.database import database
+from utils.intervals import INTERVAL_MS
+
+logger = logging.getLogger(__name__)
+
+
+def as_utc(date: datetime) -> datetime:
+    if date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def to_epoch_ms(date: datetime) -> int:
+    return int(as_utc(date).timestamp() * 1000)
+
+
+class CheckpointStore:
+    # Append-only file of finished window start times (epoch ms) or page ids, one per line.
+    def __init__(self, name: str, root: str = os.getenv("checkpoints_path", "checkpoints")):
+        self.path = os.path.join(root, f"{name}.done")
+        os.makedirs(root, exist_ok=True)
+        self.done = set()
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                self.done = {int(line) for line in file if line.strip()}
+
+    @staticmethod
+    def key(window_start: datetime | int) -> int:
+        # Windows are keyed by start time; plain ints such as aggTrade page ids are kept as they are.
+        return to_epoch_ms(window_start) if isinstance(window_start, datetime) else window_start
+
+    def is_done(self, window_start: datetime | int) -> bool:
+        return self.key(window_start) in self.done
+
+    def mark_done(self, window_starts: list[datetime | int]) -> None:
+        new_windows = [self.key(window_start) for window_start in window_starts]
+        new_windows = [window for window in new_windows if window not in self.done]
+        if not new_windows:
+            return
+        with open(self.path, "a") as file:
+            file.write("".join(f"{window}\n" for window in new_windows))
+            file.flush()
+            os.fsync(file.fileno())
+        self.done.update(new_windows)
+
+
+def expected_candles(window_start_ms: int, window_ms: int, interval_ms: int) -> int:
+    # Candle open times are multiples of the interval; count those in [start, start + window).
+    # At least 1, so a window that holds no open time is only skipped once checkpointed.
+    count = math.ceil((window_start_ms + window_ms) / interval_ms) - math.ceil(window_start_ms / interval_ms)
+    return max(count, 1)
+
+
+async def window_row_counts(
+        query: str,
+        start: datetime,
+        end: datetime,
+        window_ms: int,
+        *filters,
+) -> dict[int, int]:
+    # {window index counted from start: rows}, one grouped query for the whole range.
+    async with database.connection() as connection:
+        rows = await connection.fetch(query, to_epoch_ms(start), window_ms, as_utc(start), as_utc(end), *filters)
+    return {row["bucket"]: row["rows"] for row in rows}
+
+
+async def kline_coverage(symbol: str, interval: str, start: datetime, end: datetime, window_ms: int) -> dict[int, int]:
+    return await window_row_counts(
+        (
+            'SELECT ((EXTRACT(EPOCH FROM open_time) * 1000)::bigint - $1) / $2 AS bucket, count(*) AS rows '
+            'FROM "KlineData" '
+            'WHERE open_time >= $3 AND open_time < $4 AND symbmol = $5 AND interval = $6 '
+            'GROUP BY 1'
+        ),
+        start,
+        end,
+        window_ms,
+        symbol,
+        interval,
+    )
+
+
+async def trade_coverage(start: datetime, end: datetime, window_ms: int) -> dict[int, int]:
+    # AggregatedTradeData has no symbol column, so coverage is for whatever the table holds.
+    return await window_row_counts(
+        (
+            'SELECT ((EXTRACT(EPOCH FROM trade_time) * 1000)::bigint - $1) / $2 AS bucket, count(*) AS rows '
+            'FROM "AggregatedTradeData" '
+            'WHERE trade_time >= $3 AND trade_time < $4 '
+            'GROUP BY 1'
+        ),
+        start,
+        end,
+        window_ms,
+    )
+
+
+async def missing_kline_windows(
+        windows: list[datetime],
+        checkpoints: CheckpointStore,
+        symbol: str,
+        interval: str,
+        window_ms: int,
+) -> list[datetime]:
+    # A window is skipped when it is checkpointed or the DB already holds every candle of it.
+    if not windows:
+        return windows
+    start = windows[0]
+    coverage = await kline_coverage(symbol, interval, start, windows[-1] + timedelta(milliseconds=window_ms), window_ms)
+    interval_ms = INTERVAL_MS[interval]
+    start_ms = to_epoch_ms(start)
+    missing = [
+        window for window in windows
+        if not checkpoints.is_done(window)
+        and coverage.get((to_epoch_ms(window) - start_ms) // window_ms, 0)
+        < expected_candles(to_epoch_ms(window), window_ms, interval_ms)
+    ]
+    logger.info(f"{len(windows) - len(missing)} of {len(windows)} kline windows already done")
+    return missing
+
+
+async def missing_trade_windows(
+        windows: list[list[datetime]],
+        checkpoints: CheckpointStore,
+        window_ms: int = 30_000,
+) -> list[list[datetime]]:
+    # windows are TradeData.date_list entries: [minute start, second half start].
+    # Quiet halves with no trades only count as done once checkpointed.
+    if not windows:
+        return windows
+    start = windows[0][0]
+    coverage = await trade_coverage(start, windows[-1][0] + timedelta(milliseconds=2 * window_ms), window_ms)
+    start_ms = to_epoch_ms(start)
+
+    def half_done(half_start: datetime) -> bool:
+        # The second half starts a microsecond before the 30 s mark, hence round().
+        window = round((to_epoch_ms(half_start) - start_ms) / window_ms)
+        return checkpoints.is_done(half_start) or coverage.get(window, 0) > 0
+
+    missing = [window for window in windows if not all(half_done(half) for half in window)]
+    logger.info(f"{len(windows) - len(missing)} of {len(windows)} trade windows already done")
+    return missing
+
+
+async def trade_id_coverage(
+        first_id: int,
+        last_id: int,
+        page_size: int,
+) -> dict[int, int]:
+    # {page index counted from first_id: rows}; like trade_coverage it cannot tell symbols apart.
+    async with database.connection() as connection:
+        rows = await connection.fetch(
+            (
+                'SELECT (aggregated_trade_id - $1) / $2 AS bucket, count(*) AS rows '
+                'FROM "AggregatedTradeData" '
+                'WHERE aggregated_trade_id >= $1 AND aggregated_trade_id <= $3 '
+                'GROUP BY 1'
+            ),
+            first_id,
+            page_size,
+            last_id,
+        )
+    return {row["bucket"]: row["rows"] for row in rows}
+
+
+async def missing_trade_pages(
+        pages: list[int],
+        checkpoints: CheckpointStore,
+        last_id: int,
+        page_size: int,
+) -> list[int]:
+    # pages are the first ids of consecutive page_size id ranges ending at last_id.
+    # Ids have no gaps, so a page is done once the DB holds every one of its trades.
+    if not pages:
+        return pages
+    first_id = pages[0]
+    coverage = await trade_id_coverage(first_id, last_id, page_size)
+    missing = [
+        page for page in pages
+        if not checkpoints.is_done(page)
+        and coverage.get((page - first_id) // page_size, 0) < min(page_size, last_id - page + 1)
+    ]
+    logger.info(f"{len(pages) - len(missing)} of {len(pages)} trade id pages already done")
+    return missing
@@ -2,13 +2,17 @@ import asyncio
 from datetime import datetime, timedelta, timezone
 import logging
 
-import aiohttp
-import tortoise
 
-from aws_ssh_app.aws_ec2_accessor import get_all_ec2_dns_names
-from aws_ssh_app.ssh_proxies import connect_all_servers_and_run_cmd
-from db_app.models import KlineData
-from db_app.config import db_config
+from aws_ssh_app.aws_ec2_accessor import get_all_ec2_dns_names_async
+from aws_ssh_app.proxy_recycler import ProxyRecycler
+from client_API.checkpoints import CheckpointStore, missing_kline_windows
+from client_API.proxy_pool import ProxyPool, proxy_urls
+from client_API.scheduler import REQUEST_WEIGHTS, RequestScheduler
+from db_app.bulk_copy import BulkCopyWriter, encode_klines, kline_writer
+from db_app.database import database
+from db_app.kline_cache import KlineCache
+from db_app.record_buffers import KlineBuffer
+from utils.decoders import get_decoder
 
 BASE_API_URL = "https://api.binance.com/api/v3/"
 
@@ -31,43 +35,65 @@ class KlineDataClient:
             interval: str,
             limit: int,
             start_period: datetime,
-            stop_period: datetime = datetime.now()
+            stop_period: datetime = datetime.now(),
+            cache: KlineCache | None = None,
+            upsert: bool = True,
+            queue_size: int = 100,
+            batch_size: int = 50_000,
+            resume: bool = True,
     ):
         self.symbol = symbol
         self.interval = interval
         self.limit = limit
-        self.kline_data = []
+        self.kline_queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.written_klines = 0
         self.start_period = start_period
         self.end_period = stop_period
         self.date_list = None
         self.request_to_be_done = None
+        self.cache = cache
+        self.upsert = upsert
+        self.resume = resume
+        self.checkpoints = CheckpointStore(f"klines_{symbol}_{interval}")
+        self.scheduler = None
+        self.decoder = get_decoder()
 
     async def __call__(self):
-        self.generate_minute_range()
-        chunks = self.generate_chunks(self.date_list)
-        for index in range(len(chunks)):
-            logging.info(f"Sleeping before starting requests for chunk #{index+1} out of {len(chunks)}...")
-
-            logging.info(f"Preparing proxies to start requests...")
-            await connect_all_servers_and_run_cmd(
-                get_all_ec2_dns_names()
-            )
-
-            await self.start_requests(chunks[index])
-
-        logging.info(f"Preparing proxies to start requests...")
+        # The gap scan and the writer share one connection pool.
+        async with database:
+            self.generate_minute_range()
+            if self.resume:
+                self.date_list = await missing_kline_windows(
+                    self.date_list,
+                    self.checkpoints,
+                    self.symbol,
+                    self.interval,
+                    window_ms=16 * 60 * 1000,
+                )
+                self.request_to_be_done = len(self.date_list)
+                logging.info(f"Requests left after gap scan: {self.request_to_be_done}")
+            chunks = self.generate_chunks(self.date_list)
+            async with ProxyPool([]) as pool, ProxyRecycler() as recycler, kline_writer(upsert=self.upsert) as writer:
+                self.scheduler = RequestScheduler(pool)
+                # A failing writer cancels the fetchers blocked on the full queue and vice versa.
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(self.write_klines(writer))
+                    for index in range(len(chunks)):
+                        logging.info(f"Starting requests for chunk #{index+1} out of {len(chunks)}...")
+                        servers = await get_all_ec2_dns_names_async()
+                        pool.refresh(proxy_urls(servers))
+                        await pool.close_idle_retired()
+
+                        # Proxies are restarted in rolling batches while the rest serve the chunk.
+                        await asyncio.gather(
+                            recycler.recycle(servers, pool),
+                            self.start_requests(chunks[index]),
+                        )
 
-        logging.info(f"Sleeping before bulk creating klines...")
-        await asyncio.sleep(10)
-        await self.bulk_create_klines()
+                    await self.kline_queue.put(None)
 
-    @staticmethod
-    def rotate_proxies(
-            list_of_proxies: list[dict] = get_all_ec2_dns_names()
-    ):
-        proxies = [proxy for proxy in list_of_proxies]
-        for proxy in proxies:
-            yield proxy
+        logging.info(f"Backfill finished, {self.written_klines} klines written")
 
     def generate_minute_range(self):
         self.date_list = []
@@ -96,111 +122,69 @@ class KlineDataClient:
             self,
             start_time: datetime,
             end_time: datetime,
-            proxy_str: str,
             requests_count: int,
-            session: aiohttp.ClientSession,
-    ) -> dict:
-        try:
-            async with session.get(
-                f"{BASE_API_URL}klines",
-                proxy=f"http://{proxy_str}",
-                ssl=False,
-                params={
-                    "symbol": self.symbol,
-                    "interval": self.interval,
-                    "limit": self.limit,
-                    "startTime": int(start_time.replace(tzinfo=timezone.utc).timestamp() * 1000),
-                    "endTime": int(end_time.replace(tzinfo=timezone.utc).timestamp() * 1000),
-                }
-            ) as resp:
-                logging.info(
-                    f"Request #{requests_count}: for periond: "
-                    f"{start_time.date()} - {start_time.time()} - {end_time.time()}, "
-                    f"response: {resp.status} "
-                )
-                data = await resp.json()
-                if resp.status == 200:
-                    for kline in data:
-                        data_dict = {
-                            "open_time": datetime.utcfromtimestamp(kline[0] / 1000),
-                            "close_time": datetime.utcfromtimestamp(kline[6] / 1000),
-                            "open_price": float(kline[1]),
-                            "high_price": float(kline[2]),
-                            "low_price": float(kline[3]),
-                            "close_price": float(kline[4]),
-                            "volume": float(kline[5]),
-                            "trades": int(kline[8]),
-                            "quote_asset_volume": float(kline[7]),
-                            "taker_buy_base_asset_volume": float(kline[9]),
-                            "taker_buy_quote_asset_volume": float(kline[10]),
-                            "interval": self.interval,
-                            "symbol": self.symbol,
-                        }
-                        self.kline_data.append(KlineData.create_new_instance(data_dict))
-        except (aiohttp.ClientOSError, aiohttp.ServerDisconnectedError, asyncio.TimeoutError) as e:
-            logging.error(e)
-            await asyncio.sleep(20)
-            logging.info(f"Trying again to make request #{requests_count} with proxy: {proxy_str}..., after 20 sec")
-            await self.make_request_to_kline(
-                start_time,
-                end_time,
-                proxy_str,
-                requests_count,
-                session=session,
-            )
-        except Exception as e:
-            logging.error(f"{e} for response: {resp.status}, {resp.text}, response: {resp}, response: {data}")
-            await asyncio.sleep(20)
-            logging.info(f"Trying again to make request #{requests_count} with proxy: {proxy_str}..., after 20 sec")
-            await self.make_request_to_kline(
-                start_time,
-                end_time,
-                proxy_str,
-                requests_count,
-                session=session,
-            )
+    ) -> None:
+        data = await self.scheduler.get_json(
+            f"{BASE_API_URL}klines",
+            params={
+                "symbol": self.symbol,
+                "interval": self.interval,
+                "limit": self.limit,
+                "startTime": int(start_time.replace(tzinfo=timezone.utc).timestamp() * 1000),
+                "endTime": int(end_time.replace(tzinfo=timezone.utc).timestamp() * 1000),
+            },
+            weight=REQUEST_WEIGHTS["klines"],
+            decode=self.decoder.rest_klines,
+        )
+        logging.info(
+            f"Request #{requests_count}: for periond: "
+            f"{start_time.date()} - {start_time.time()} - {end_time.time()}, "
+            f"klines: {None if data is None else len(data)}"
+        )
+        if data is None:
+            # Not queued, so the window is not checkpointed and the next run retries it.
+            return
+        await self.kline_queue.put((start_time, data))
 
     async def start_requests(self, chunk: list[datetime]):
         logging.info(f"Starting requests...")
-        local_proxy_list = self.rotate_proxies()
-        current_proxy = next(local_proxy_list)
-
-        requests_count_per_proxy = 0
-        count_to_proxy_restart = 0
-        total_request_count = 0
-
-        async with aiohttp.ClientSession() as session:
-            async with asyncio.TaskGroup() as tg:
-                for date in chunk:
-                    tg.create_task(
-                        self.make_request_to_kline(
-                            start_time=date,
-                            end_time=date + timedelta(minutes=15, seconds=59, microseconds=999999),
-                            proxy_str=f"{current_proxy.get('dns_name')}:8888",
-                            requests_count=total_request_count,
-                            session=session,
-                        )
+
+        async with asyncio.TaskGroup() as tg:
+            for total_request_count, date in enumerate(chunk):
+                tg.create_task(
+                    self.make_request_to_kline(
+                        start_time=date,
+                        end_time=date + timedelta(minutes=15, seconds=59, microseconds=999999),
+                        requests_count=total_request_count,
                     )
+                )
+        logging.info(f"Proxy usage: {self.scheduler.stats()}")
 
-                    requests_count_per_proxy += 1
-                    total_request_count += 1
-                    count_to_proxy_restart += 1
-
-                    if requests_count_per_proxy == 3:
-                        try:
-                            current_proxy = next(local_proxy_list)
-                            requests_count_per_proxy = 0
-                            logging.info(f"Next proxy: {current_proxy.get('dns_name')}")
-                        except StopIteration:
-                            logging.info(f"Sleeping for 20 sec before restarting...")
-                            await asyncio.sleep(20)
-                            local_proxy_list = self.rotate_proxies()
-                            logging.info(f"Rotating proxies...")
-
-    async def bulk_create_klines(self):
-        logging.info(f"Bulk creating {len(self.kline_data)} klines")
-        await tortoise.Tortoise.init(db_config)
-        await KlineData.bulk_create(self.kline_data, batch_size=1_000_000)
+    async def write_klines(self, writer: BulkCopyWriter):
+        batch = KlineBuffer(self.batch_size)
+        windows = []
+        while True:
+            item = await self.kline_queue.get()
+            if item is None:
+                break
+            window_start, records = item
+            batch.extend(records)
+            windows.append(window_start)
+            if len(batch) >= self.batch_size:
+                await self.flush_klines(writer, batch, windows)
+                batch.clear()
+                windows = []
+        await self.flush_klines(writer, batch, windows)
+
+    async def flush_klines(self, writer: BulkCopyWriter, batch: KlineBuffer, windows: list[datetime]):
+        if len(batch):
+            await writer.write_binary(encode_klines(batch.records, self.symbol, self.interval), len(batch))
+            self.written_klines += len(batch)
+            logging.info(f"Written {self.written_klines} klines, queued batches: {self.kline_queue.qsize()}")
+            if self.cache is not None:
+                self.cache.append(self.symbol, self.interval, batch.records)
+        # Windows are only checkpointed once their rows are committed.
+        self.checkpoints.mark_done(windows)
 
 
 if __name__ == "__main__":
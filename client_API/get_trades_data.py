@@ -2,15 +2,24 @@ import asyncio
 from datetime import datetime, timedelta, timezone
 import logging
 
-import aiohttp
-import tortoise
-
-from aws_ssh_app.aws_ec2_accessor import get_all_ec2_dns_names
-from aws_ssh_app.ssh_proxies import connect_all_servers_and_run_cmd
-from db_app.models import AggregatedTradeData, Kline1mData
-from db_app.config import db_config
+import numpy as np
+
+from aws_ssh_app.aws_ec2_accessor import get_all_ec2_dns_names_async
+from aws_ssh_app.proxy_recycler import ProxyRecycler
+from client_API.checkpoints import CheckpointStore, missing_trade_pages, missing_trade_windows
+from client_API.proxy_pool import ProxyPool, proxy_urls
+from client_API.scheduler import REQUEST_WEIGHTS, RequestScheduler
+from client_API.trade_linking import MINUTE_MS, link_trades_to_klines, windows_containing
+from db_app.bulk_copy import encode_trades, trade_writer
+from db_app.database import database
+from db_app.kline_cache import from_epoch_ms, to_epoch_ms
+from db_app.models import KlineData
+from db_app.record_buffers import TradeBuffer
+from utils.decoders import get_decoder
 
 BASE_API_URL = "https://api.binance.com/api/v3/"
+# Longest startTime-endTime range aggTrades accepts.
+AGG_TRADES_MAX_RANGE_MS = 3_600_000
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -24,14 +33,6 @@ file_handler.setFormatter(file_formatter)
 logger.addHandler(file_handler)
 
 
-async def init_tortoise():
-    await tortoise.Tortoise.init(db_config)
-
-
-async def close_tortoise():
-    await tortoise.Tortoise.close_connections()
-
-
 class TradeData:
     def __init__(
             self,
@@ -39,37 +40,60 @@ class TradeData:
             limit: int,
             start_period: datetime,
             stop_period: datetime = datetime.utcnow(),
+            upsert: bool = True,
+            resume: bool = True,
+            by_id: bool = False,
     ) -> None:
         self.symbol = symbol
         self.limit = limit
-        self.trades = []
+        self.trades = TradeBuffer()
         self.start_period = start_period
         self.end_period = stop_period.replace(microsecond=999000)
         self.date_list = None
         self.request_to_be_done = None
+        self.upsert = upsert
+        self.resume = resume
+        self.checkpoints = CheckpointStore(f"agg_trades_{symbol}")
+        # by_id pages through the trade ids between the two periods instead of 30 second windows,
+        # so requests follow trade volume and a busy window is never cut at limit trades.
+        self.by_id = by_id
+        self.id_checkpoints = CheckpointStore(f"agg_trade_ids_{symbol}")
+        self.last_id = None
+        self.scheduler = None
+        self.decoder = get_decoder()
+        self.failed_windows = set()
 
     async def __call__(self):
-        self.generate_minute_range()
-        chunks = self.generate_chunks(self.date_list)
-        for index in range(len(chunks)):
-
-            logging.info(f"Sleeping before starting requests for chunk #{index + 1} out of {len(chunks)}...")
-            await asyncio.sleep(20)
-
-            logging.info(f"Preparing proxies to start requests...")
-            await connect_all_servers_and_run_cmd(
-                get_all_ec2_dns_names()
-            )
-
-            await self.start_requests(chunks[index])
-
-    @staticmethod
-    def rotate_proxies(
-            list_of_proxies: list[dict] = get_all_ec2_dns_names()
-    ):
-        proxies = [proxy for proxy in list_of_proxies]
-        for proxy in proxies:
-            yield proxy
+        # Gap scans, kline lookups and trade writes of every chunk share one connection pool.
+        async with database, ProxyPool([]) as pool, ProxyRecycler() as recycler:
+            self.scheduler = RequestScheduler(pool)
+            if self.by_id:
+                # The id range is looked up through the proxies before the first chunk.
+                pool.refresh(proxy_urls(await get_all_ec2_dns_names_async()))
+                await self.generate_id_pages()
+                start_requests = self.start_id_requests
+            else:
+                self.generate_minute_range()
+                start_requests = self.start_requests
+            if self.resume:
+                if self.by_id:
+                    self.date_list = await missing_trade_pages(self.date_list, self.id_checkpoints, self.last_id, self.limit)
+                else:
+                    self.date_list = await missing_trade_windows(self.date_list, self.checkpoints)
+                self.request_to_be_done = len(self.date_list)
+                logging.info(f"Requests left after gap scan: {self.request_to_be_done}")
+            chunks = self.generate_chunks(self.date_list)
+            for index in range(len(chunks)):
+                logging.info(f"Starting requests for chunk #{index + 1} out of {len(chunks)}...")
+                servers = await get_all_ec2_dns_names_async()
+                pool.refresh(proxy_urls(servers))
+                await pool.close_idle_retired()
+
+                # Proxies are restarted in rolling batches while the rest serve the chunk.
+                await asyncio.gather(
+                    recycler.recycle(servers, pool),
+                    start_requests(chunks[index]),
+                )
 
     def generate_minute_range(self):
         self.date_list = []
@@ -87,6 +111,46 @@ class TradeData:
         self.request_to_be_done = len(self.date_list)
         logging.info(f"Total requests should be done: {self.request_to_be_done}")
 
+    async def get_agg_trades(self, params: dict) -> np.ndarray | None:
+        return await self.scheduler.get_json(
+            f"{BASE_API_URL}aggTrades",
+            params={"symbol": self.symbol, **params},
+            weight=REQUEST_WEIGHTS["aggTrades"],
+            decode=self.decoder.agg_trades,
+        )
+
+    async def trade_id_at(self, time_ms: int) -> int | None:
+        # Id of the first trade at or after time_ms, None when there is none yet.
+        now_ms = to_epoch_ms(datetime.now(timezone.utc))
+        while time_ms <= now_ms:
+            data = await self.get_agg_trades(
+                {"limit": 1, "startTime": time_ms, "endTime": time_ms + AGG_TRADES_MAX_RANGE_MS - 1}
+            )
+            if data is None:
+                raise RuntimeError(f"Could not look up the trade id at {from_epoch_ms(time_ms)}")
+            if len(data):
+                return int(data["aggregated_trade_id"][0])
+            time_ms += AGG_TRADES_MAX_RANGE_MS
+        return None
+
+    async def generate_id_pages(self):
+        # Ids are consecutive, so the range splits into pages of limit ids without fetching it first.
+        self.date_list = []
+        first_id = await self.trade_id_at(to_epoch_ms(self.start_period))
+        if first_id is None:
+            logging.info(f"No trades since {self.start_period}")
+            return
+        next_id = await self.trade_id_at(to_epoch_ms(self.end_period) + 1)
+        if next_id is None:
+            latest = await self.get_agg_trades({"limit": 1})
+            if latest is None or not len(latest):
+                raise RuntimeError("Could not look up the latest trade id")
+            next_id = int(latest["aggregated_trade_id"][-1]) + 1
+        self.last_id = next_id - 1
+        self.date_list = list(range(first_id, next_id, self.limit))
+        self.request_to_be_done = len(self.date_list)
+        logging.info(f"Trade ids {first_id} - {self.last_id}, total requests should be done: {self.request_to_be_done}")
+
     @staticmethod
     def generate_chunks(array_of_elements, chunk_size=1440):
         chunks = []
@@ -102,162 +166,147 @@ class TradeData:
         return chunks
 
     async def find_kline_for_trade(self):
-        await tortoise.Tortoise.init(db_config)
-        klines_for_certain_period = await Kline1mData.filter(
-            open_time__gte=self.start_period,
-            close_time__lte=self.end_period,
-        )
-        klines_for_certain_period = {kline.open_time: kline for kline in klines_for_certain_period}
-
-        for trade_dict in self.trades:
-            date = (
-                trade_dict["trade_time"].replace(second=0, microsecond=0)
+        if not len(self.trades):
+            return
+        trade_times = self.trades["trade_time"]
+        async with database:
+            klines = await (
+                KlineData
+                .filter(
+                    symbmol=self.symbol,
+                    interval="1m",
+                    open_time__gte=from_epoch_ms(int(trade_times.min()) // MINUTE_MS * MINUTE_MS),
+                    open_time__lte=from_epoch_ms(int(trade_times.max())),
+                )
+                .order_by("open_time")
+                .values_list("id", "open_time")
             )
-            logging.info(f"Date: {date}")
-            trade_dict["kline"] = klines_for_certain_period.get(
-                trade_dict["trade_time"]
-                .replace(tzinfo=timezone.utc)
-                .replace(second=0, microsecond=0)
-            )
-            if trade_dict.get("kline"):
-                logging.info(f"Found kline: {trade_dict.get('trade_time')} - {trade_dict['kline']}")
-            else:
-                logging.info(f"{trade_dict.get('trade_time')} - no kline found")
 
-        await tortoise.Tortoise.close_connections()
+        kline_ids = np.array([kline[0] for kline in klines], dtype=np.int64)
+        kline_open_times = np.array([to_epoch_ms(kline[1]) for kline in klines], dtype=np.int64)
+        linked_ids = link_trades_to_klines(trade_times, kline_open_times, kline_ids)
+
+        self.trades["kline_id"][:] = linked_ids
+        unmatched = int((linked_ids < 0).sum())
+        logging.info(f"Linked {len(self.trades) - unmatched} of {len(self.trades)} trades to klines, {unmatched} unmatched")
 
     async def make_request_to_agg_trades(
             self,
             minute: list,
-            proxy_str: str,
-            session: aiohttp.ClientSession,
             requests_count: int,
-
-    ) -> dict:
-        try:
-            minute_data = []
-            for time in minute:
-                async with session.get(
-                        f"{BASE_API_URL}aggTrades",
-                        proxy=f"http://{proxy_str}",
-                        ssl=False,
-                        params={
-                            "symbol": self.symbol,
-                            "limit": self.limit,
-                            "startTime": int(time.replace(tzinfo=timezone.utc).timestamp() * 1000),
-                            "endTime": int(
-                                (time + timedelta(seconds=30)).replace(
-                                    tzinfo=timezone.utc
-                                ).timestamp() * 1000
-                            ),
-                        }
-                ) as resp:
-                    data = await resp.json()
-                    logging.info(
-                        f"Request #{requests_count}: for periond: "
-                        f"{time.replace(tzinfo=timezone.utc).date()} - "
-                        f"{time.replace(tzinfo=timezone.utc).time()} - "
-                        f"{(time + timedelta(seconds=30)).replace(tzinfo=timezone.utc).time()}, "
-                        f"response: {resp.status} "
-                    )
-                    if data:
-                        for trade in data:
-                            trade_dict = {
-                                "aggregated_trade_id": trade.get("a"),
-                                "price": float(trade.get("p")),
-                                "quantity": float(trade.get("q")),
-                                "trade_time": datetime.utcfromtimestamp(trade.get("T") / 1000),
-                                "first_trade_id": trade.get("f"),
-                                "last_trade_id": trade.get("l"),
-                                "buyer_market_maker": trade.get("m"),
-                                "best_price_match": trade.get("M"),
-                            }
-
-                            minute_data.append(trade_dict)
-
-            self.trades.extend(minute_data)
-            logging.info(f"Current total of trades: {len(self.trades)}")
-        except (aiohttp.ClientOSError, aiohttp.ServerDisconnectedError, asyncio.TimeoutError) as e:
-            logging.error(e)
-            await asyncio.sleep(20)
-            logging.info(f"Trying again to make request #{requests_count} with proxy: {proxy_str}..., after 20 sec")
-            await self.make_request_to_agg_trades(
-                minute,
-                proxy_str,
-                session,
-                requests_count,
+    ) -> None:
+        for time in minute:
+            data = await self.scheduler.get_json(
+                f"{BASE_API_URL}aggTrades",
+                params={
+                    "symbol": self.symbol,
+                    "limit": self.limit,
+                    "startTime": int(time.replace(tzinfo=timezone.utc).timestamp() * 1000),
+                    "endTime": int(
+                        (time + timedelta(seconds=30)).replace(
+                            tzinfo=timezone.utc
+                        ).timestamp() * 1000
+                    ),
+                },
+                weight=REQUEST_WEIGHTS["aggTrades"],
+                decode=self.decoder.agg_trades,
             )
-        except Exception as e:
-            logging.error(f"{e} for response: {resp.status}, {resp.text}, response: {resp}, response: {data}")
-            await asyncio.sleep(20)
-            logging.info(f"Trying again to make request #{requests_count} with proxy: {proxy_str}..., after 20 sec")
-            await self.make_request_to_agg_trades(
-                minute,
-                proxy_str,
-                session,
-                requests_count,
+            logging.info(
+                f"Request #{requests_count}: for periond: "
+                f"{time.replace(tzinfo=timezone.utc).date()} - "
+                f"{time.replace(tzinfo=timezone.utc).time()} - "
+                f"{(time + timedelta(seconds=30)).replace(tzinfo=timezone.utc).time()}, "
+                f"trades: {None if data is None else len(data)}"
             )
+            if data is None:
+                self.failed_windows.add(time)
+                continue
+            self.trades.extend(data)
+
+        logging.info(f"Current total of trades: {len(self.trades)}")
+
+    async def make_request_to_agg_trades_by_id(self, from_id: int, requests_count: int) -> None:
+        to_id = min(from_id + self.limit, self.last_id + 1) - 1
+        data = await self.get_agg_trades({"limit": to_id - from_id + 1, "fromId": from_id})
+        logging.info(
+            f"Request #{requests_count}: for ids {from_id} - {to_id}, "
+            f"trades: {None if data is None else len(data)}"
+        )
+        if data is None:
+            self.failed_windows.add(from_id)
+            return
+        self.trades.extend(data[data["aggregated_trade_id"] <= to_id])
+
+    async def walk_shard(self, pages: list[int], requests_count: int) -> None:
+        for index, from_id in enumerate(pages):
+            await self.make_request_to_agg_trades_by_id(from_id, requests_count + index)
+
+    async def start_id_requests(self, chunk: list[int]):
+        # One contiguous run of pages per in-flight slot of every proxy, each walked in id order.
+        logging.info(f"Starting requests...")
+        self.failed_windows = set()
+        pool = self.scheduler.pool
+        shards = max(len(pool.proxies), 1) * pool.max_in_flight
+        shard_size = max(-(-len(chunk) // shards), 1)
+
+        async with asyncio.TaskGroup() as tg:
+            for start in range(0, len(chunk), shard_size):
+                tg.create_task(self.walk_shard(chunk[start:start + shard_size], requests_count=start))
+        logging.info(f"Proxy usage: {self.scheduler.stats()}")
+
+        unlinked = await self.save_trades()
+        # Pages holding trades that could not be stored stay unmarked, like failed requests.
+        for index in windows_containing(np.array(chunk), unlinked["aggregated_trade_id"]):
+            self.failed_windows.add(chunk[index])
+        self.id_checkpoints.mark_done([page for page in chunk if page not in self.failed_windows])
+        self.trades.clear()
+        logging.info(f"Resetted trades: {len(self.trades)}")
 
     async def start_requests(self, chunk: list[list[datetime, datetime]]):
         logging.info(f"Starting requests...")
-        local_proxy_list = self.rotate_proxies()
-        current_proxy = next(local_proxy_list)
-
-        requests_count_per_proxy = 0
-        total_request_count = 0
-
-        async with aiohttp.ClientSession() as session:
-            async with asyncio.TaskGroup() as tg:
-                for date in chunk:
-                    tg.create_task(
-                        self.make_request_to_agg_trades(
-                            date,
-                            proxy_str=f"{current_proxy.get('dns_name')}:8888",
-                            session=session,
-                            requests_count=total_request_count,
-                        )
+        self.failed_windows = set()
+
+        async with asyncio.TaskGroup() as tg:
+            for total_request_count, date in enumerate(chunk):
+                tg.create_task(
+                    self.make_request_to_agg_trades(
+                        date,
+                        requests_count=total_request_count,
                     )
+                )
+        logging.info(f"Proxy usage: {self.scheduler.stats()}")
 
-                    requests_count_per_proxy += 1
-                    total_request_count += 1
-
-                    if requests_count_per_proxy == 1:
-                        try:
-                            current_proxy = next(local_proxy_list)
-                            requests_count_per_proxy = 0
-                            logging.info(f"Next proxy: {current_proxy.get('dns_name')}")
-                        except StopIteration:
-                            logging.info(f"Sleeping for 20 sec before restarting...")
-                            await asyncio.sleep(20)
-                            local_proxy_list = self.rotate_proxies()
-                            logging.info(f"Rotating proxies...")
-
-        await self.find_kline_for_trade()
-        list_of_instances = [
-            AggregatedTradeData(
-                aggregated_trade_id=data.get("aggregated_trade_id"),
-                price=data.get("price"),
-                quantity=data.get("quantity"),
-                trade_time=data.get("trade_time"),
-                first_trade_id=data.get("first_trade_id"),
-                last_trade_id=data.get("last_trade_id"),
-                buyer_market_maker=data.get("buyer_market_maker"),
-                best_price_match=data.get("best_price_match"),
-                kline=data.get("kline"),
-            )
-            for data in self.trades
-        ]
-
-        await self.bulk_create_trades(list_of_instances)
-        self.trades = []
+        unlinked = await self.save_trades()
+        halves = [half for minute in chunk for half in minute]
+        half_starts = np.array(
+            [to_epoch_ms(minute[0]) + offset for minute in chunk for offset in (0, MINUTE_MS // 2)]
+        )
+        for index in windows_containing(half_starts, unlinked["trade_time"]):
+            self.failed_windows.add(halves[index])
+        # Halves the scheduler gave up on, or with trades that could not be stored, stay
+        # unmarked and are refetched on the next run.
+        self.checkpoints.mark_done(
+            [half for minute in chunk for half in minute if half not in self.failed_windows]
+        )
+        self.trades.clear()
         logging.info(f"Resetted trades: {len(self.trades)}")
 
-    @staticmethod
-    async def bulk_create_trades(list_of_instances: list):
-        await init_tortoise()
-        logging.info(f"Bulk creating {len(list_of_instances)} klines")
-        await AggregatedTradeData.bulk_create(list_of_instances, batch_size=1000)
-        await close_tortoise()
+    async def save_trades(self) -> np.ndarray:
+        await self.find_kline_for_trade()
+        unlinked = await self.bulk_create_trades(self.trades.records)
+        logging.info(f"Database pool: {database.stats()}")
+        return unlinked
+
+    async def bulk_create_trades(self, trades: np.ndarray) -> np.ndarray:
+        # kline_id is NOT NULL, so trades without a kline cannot be stored; they are returned
+        # so the caller can leave their windows unchecked until the klines are backfilled.
+        linked = trades[trades["kline_id"] >= 0]
+        if len(linked) < len(trades):
+            logging.warning(f"Not storing {len(trades) - len(linked)} trades without a kline, their windows stay unchecked")
+        logging.info(f"Bulk creating {len(linked)} trades")
+        async with trade_writer(upsert=self.upsert) as writer:
+            await writer.write_binary(encode_trades(linked), len(linked))
+        return trades[trades["kline_id"] < 0]
 
 
 if __name__ == "__main__":
@@ -266,5 +315,6 @@ if __name__ == "__main__":
         limit=1000,
         start_period=datetime(2024, 2, 1, 0, 0, 0),
         stop_period=datetime(2024, 2, 15, 23, 59, 59),
+        by_id=True,
     )
     asyncio.run(trade_instance())
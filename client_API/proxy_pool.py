@@ -0,0 +1,253 @@
+import asyncio
+import logging
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+BINANCE_WEIGHT_LIMIT_1M = 6000
+TINYPROXY_PORT = 8888
+
+
+def proxy_urls(servers: list[dict], port: int = TINYPROXY_PORT) -> list[str]:
+    # servers are get_all_ec2_dns_names() entries.
+    return [f"http://{server.get('dns_name')}:{port}" for server in servers]
+
+
+class ProxyBucket:
+    # Token bucket for one egress IP, refilled continuously and clamped to what
+    # Binance reports as already used in the current minute.
+    def __init__(self, proxy: str, capacity: float, max_in_flight: int, now: float):
+        self.proxy = proxy
+        self.capacity = capacity
+        self.rate = capacity / 60
+        self.tokens = capacity
+        self.updated_at = now
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.max_in_flight = max_in_flight
+        self.used_weight = 0
+        self.requests = 0
+        self.errors = 0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def available(self, now: float) -> bool:
+        return now >= self.blocked_until and self.in_flight < self.max_in_flight
+
+    def wait_time(self, weight: int, now: float) -> float:
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return max(0.0, (weight - self.tokens) / self.rate)
+
+    def observe_used_weight(self, used_weight: int) -> None:
+        self.used_weight = used_weight
+        self.tokens = min(self.tokens, self.capacity - used_weight)
+
+    def block(self, seconds: float, now: float) -> None:
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class ProxyHealth:
+    # Latency and error rate EWMAs. An unhealthy proxy is ejected for a cooldown that
+    # doubles on every failed probe; after it a single probe request decides readmission.
+    def __init__(
+            self,
+            alpha: float,
+            max_error_rate: float,
+            max_latency: float,
+            eject_seconds: float,
+            max_eject_seconds: float,
+    ):
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.max_latency = max_latency
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.latency = None
+        self.error_rate = 0.0
+        self.ejected = False
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.probing = False
+
+    def usable(self, now: float) -> bool:
+        if not self.ejected:
+            return True
+        return now >= self.ejected_until and not self.probing
+
+    def observe(self, latency: float, ok: bool, now: float) -> None:
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.latency = latency if self.latency is None else self.latency + self.alpha * (latency - self.latency)
+
+        if self.ejected:
+            self.probing = False
+            if ok:
+                logger.info("Probe succeeded, proxy readmitted")
+                self.ejected = False
+                self.ejections = 0
+                self.error_rate = 0.0
+                self.latency = latency
+            else:
+                self.eject(now)
+        elif self.error_rate > self.max_error_rate or (self.latency or 0.0) > self.max_latency:
+            self.eject(now)
+
+    def eject(self, now: float) -> None:
+        self.ejected = True
+        self.ejected_until = now + min(self.max_eject_seconds, self.eject_seconds * 2 ** self.ejections)
+        self.ejections += 1
+
+
+class PooledProxy:
+    def __init__(self, proxy: str, bucket: ProxyBucket, health: ProxyHealth, session: aiohttp.ClientSession):
+        self.proxy = proxy
+        self.bucket = bucket
+        self.health = health
+        self.session = session
+        self.retired = False
+        self.draining = False
+
+
+class ProxyPool:
+    # One keep-alive session per proxy, so CONNECT tunnels to Binance are reused
+    # instead of being opened for every request.
+    def __init__(
+            self,
+            proxies: list[str],
+            weight_limit: int = BINANCE_WEIGHT_LIMIT_1M,
+            safety_factor: float = 0.8,
+            max_in_flight: int = 10,
+            keepalive_timeout: float = 60.0,
+            request_timeout: float = 30.0,
+            alpha: float = 0.2,
+            max_error_rate: float = 0.5,
+            max_latency: float = 10.0,
+            eject_seconds: float = 30.0,
+            max_eject_seconds: float = 600.0,
+    ):
+        self.capacity = weight_limit * safety_factor
+        self.max_in_flight = max_in_flight
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.health_settings = {
+            "alpha": alpha,
+            "max_error_rate": max_error_rate,
+            "max_latency": max_latency,
+            "eject_seconds": eject_seconds,
+            "max_eject_seconds": max_eject_seconds,
+        }
+        self.proxies = {}
+        self.retired = []
+        self.refresh(proxies)
+
+    async def __aenter__(self) -> "ProxyPool":
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        await self.close()
+
+    def _new_session(self) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_in_flight,
+                keepalive_timeout=self.keepalive_timeout,
+                ssl=False,
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+        )
+
+    def _new_proxy(self, proxy: str, now: float) -> PooledProxy:
+        return PooledProxy(
+            proxy,
+            ProxyBucket(proxy, self.capacity, self.max_in_flight, now),
+            ProxyHealth(**self.health_settings),
+            self._new_session(),
+        )
+
+    def refresh(self, proxies: list[str]) -> None:
+        # Adds new proxies and retires vanished ones; their sessions close once idle.
+        now = asyncio.get_running_loop().time()
+        for proxy in proxies:
+            if proxy not in self.proxies:
+                self.proxies[proxy] = self._new_proxy(proxy, now)
+        for proxy in set(self.proxies) - set(proxies):
+            pooled = self.proxies.pop(proxy)
+            pooled.retired = True
+            self.retired.append(pooled)
+        logger.info(f"Proxy pool refreshed: {len(self.proxies)} active, {len(self.retired)} retiring")
+
+    def candidates(self, now: float) -> list[PooledProxy]:
+        return [
+            pooled for pooled in self.proxies.values()
+            if not pooled.draining and pooled.health.usable(now)
+        ]
+
+    async def drain(self, proxy: str, timeout: float = 30.0) -> None:
+        # Stops routing to the proxy and waits for its in-flight requests before a restart.
+        pooled = self.proxies.get(proxy)
+        if pooled is None:
+            return
+        pooled.draining = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while pooled.bucket.in_flight > 0 and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+    async def resume(self, proxy: str) -> None:
+        # Kept-alive tunnels did not survive the restart, so the session is replaced.
+        pooled = self.proxies.get(proxy)
+        if pooled is None or not pooled.draining:
+            return
+        session, pooled.session = pooled.session, self._new_session()
+        pooled.health = ProxyHealth(**self.health_settings)
+        pooled.draining = False
+        await session.close()
+
+    def acquired(self, pooled: PooledProxy, weight: int) -> None:
+        pooled.bucket.tokens -= weight
+        pooled.bucket.in_flight += 1
+        if pooled.health.ejected:
+            pooled.health.probing = True
+
+    def released(self, pooled: PooledProxy, latency: float, ok: bool, now: float) -> None:
+        pooled.bucket.in_flight -= 1
+        pooled.bucket.requests += 1
+        was_ejected = pooled.health.ejected
+        pooled.health.observe(latency, ok, now)
+        if pooled.health.ejected and not was_ejected:
+            logger.warning(
+                f"Ejected {pooled.proxy}: error rate {pooled.health.error_rate:.2f}, "
+                f"latency {pooled.health.latency or 0.0:.2f} sec"
+            )
+
+    async def close_idle_retired(self) -> None:
+        idle = [pooled for pooled in self.retired if pooled.bucket.in_flight == 0]
+        self.retired = [pooled for pooled in self.retired if pooled.bucket.in_flight > 0]
+        for pooled in idle:
+            await pooled.session.close()
+
+    async def close(self) -> None:
+        for pooled in list(self.proxies.values()) + self.retired:
+            await pooled.session.close()
+        self.proxies = {}
+        self.retired = []
+
+    def stats(self) -> list[dict]:
+        return [
+            {
+                "proxy": pooled.proxy,
+                "requests": pooled.bucket.requests,
+                "errors": pooled.bucket.errors,
+                "used_weight": pooled.bucket.used_weight,
+                "tokens": round(pooled.bucket.tokens, 1),
+                "latency": None if pooled.health.latency is None else round(pooled.health.latency, 3),
+                "error_rate": round(pooled.health.error_rate, 3),
+                "ejected": pooled.health.ejected,
+                "draining": pooled.draining,
+            }
+            for pooled in self.proxies.values()
+        ]
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import logging
+import random
+
+import aiohttp
+
+from client_API.proxy_pool import PooledProxy, ProxyPool
+
+logger = logging.getLogger(__name__)
+
+REQUEST_WEIGHTS = {
+    "klines": 2,
+    "aggTrades": 2,
+}
+
+
+class RequestScheduler:
+    def __init__(
+            self,
+            pool: ProxyPool,
+            max_attempts: int = 10,
+            base_backoff: float = 1.0,
+            max_backoff: float = 60.0,
+            idle_timeout: float = 30.0,
+    ):
+        self.pool = pool
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+
+    def backoff(self, attempt: int) -> float:
+        return min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    async def acquire(self, weight: int) -> PooledProxy:
+        # With nothing usable and nothing to wait for, a pool without proxies raises after
+        # idle_timeout; one whose proxies are all draining only warns, a recycler resumes them.
+        loop = asyncio.get_running_loop()
+        idle_since = None
+        while True:
+            now = loop.time()
+            candidates = self.pool.candidates(now)
+            for pooled in candidates:
+                pooled.bucket.refill(now)
+            ready = [
+                pooled for pooled in candidates
+                if pooled.bucket.available(now) and pooled.bucket.tokens >= weight
+            ]
+            if ready:
+                # Expected wait behind the requests already in flight, ties go to spare weight.
+                pooled = min(
+                    ready,
+                    key=lambda item: ((item.bucket.in_flight + 1) * (item.health.latency or 0.0), -item.bucket.tokens),
+                )
+                self.pool.acquired(pooled, weight)
+                return pooled
+            waits = [pooled.bucket.wait_time(weight, now) for pooled in candidates]
+            waits += [
+                pooled.health.ejected_until - now
+                for pooled in self.pool.proxies.values()
+                if pooled.health.ejected and not pooled.health.probing
+            ]
+            if waits:
+                idle_since = None
+            elif idle_since is None:
+                idle_since = now
+            elif now - idle_since >= self.idle_timeout:
+                if not self.pool.proxies:
+                    raise RuntimeError(f"Proxy pool has been empty for {self.idle_timeout:.0f} sec")
+                logger.warning(
+                    f"No usable proxy for {now - idle_since:.0f} sec, {len(self.pool.proxies)} in the pool"
+                )
+                idle_since = now
+            await asyncio.sleep(max(min(waits, default=1.0), 0.01) + random.uniform(0, 0.05))
+
+    def release(self, pooled: PooledProxy, started_at: float, ok: bool, headers=None) -> None:
+        now = asyncio.get_running_loop().time()
+        self.pool.released(pooled, now - started_at, ok, now)
+        if headers is not None and "X-MBX-USED-WEIGHT-1M" in headers:
+            pooled.bucket.observe_used_weight(int(headers["X-MBX-USED-WEIGHT-1M"]))
+
+    async def get_json(self, url: str, params: dict, weight: int, decode=json.loads):
+        # Returns decode(body) of a 200 response, None for other client errors.
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_attempts):
+            pooled = await self.acquire(weight)
+            bucket = pooled.bucket
+            started_at = loop.time()
+            try:
+                async with pooled.session.get(url, proxy=pooled.proxy, params=params) as resp:
+                    headers = resp.headers
+                    status = resp.status
+                    body = await resp.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.release(pooled, started_at, ok=False)
+                bucket.errors += 1
+                delay = self.backoff(attempt)
+                logger.warning(f"{e!r} with {pooled.proxy}, retrying in {delay:.1f} sec")
+                await asyncio.sleep(delay)
+                continue
+
+            self.release(pooled, started_at, ok=status < 500, headers=headers)
+            if status == 200:
+                return decode(body)
+            if status in (418, 429):
+                retry_after = float(headers.get("Retry-After", self.backoff(attempt)))
+                bucket.block(retry_after + random.uniform(0, 1), loop.time())
+                bucket.errors += 1
+                logger.warning(f"{status} from {pooled.proxy}, blocked for {retry_after} sec")
+                continue
+            if status >= 500:
+                bucket.errors += 1
+                delay = self.backoff(attempt)
+                logger.warning(f"{status} from {pooled.proxy}, retrying in {delay:.1f} sec")
+                await asyncio.sleep(delay)
+                continue
+            logger.error(f"{status} for {url} {params}: {body.decode(errors='replace')}")
+            return None
+        raise RuntimeError(f"Giving up on {url} {params} after {self.max_attempts} attempts")
+
+    def stats(self) -> list[dict]:
+        return self.pool.stats()
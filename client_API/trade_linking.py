@@ -0,0 +1,33 @@
+import numpy as np
+
+MINUTE_MS = 60_000
+
+
+def link_trades_to_klines(
+        trade_times: np.ndarray,
+        kline_open_times: np.ndarray,
+        kline_ids: np.ndarray,
+        interval_ms: int = MINUTE_MS,
+) -> np.ndarray:
+    # trade_times and kline_open_times are epoch ms, kline_open_times sorted ascending.
+    # Returns the id of the kline opening at each trade's floored interval, -1 where there is none.
+    trade_times = np.asarray(trade_times, dtype=np.int64)
+    if not len(kline_open_times):
+        return np.full(len(trade_times), -1, dtype=np.int64)
+
+    kline_open_times = np.asarray(kline_open_times, dtype=np.int64)
+    opens = trade_times - trade_times % interval_ms
+    positions = np.searchsorted(kline_open_times, opens)
+    np.minimum(positions, len(kline_open_times) - 1, out=positions)
+    matched = kline_open_times[positions] == opens
+    return np.where(matched, np.asarray(kline_ids, dtype=np.int64)[positions], -1)
+
+
+def windows_containing(window_starts: np.ndarray, values: np.ndarray) -> np.ndarray:
+    # window_starts are ascending epoch ms or ids; returns the sorted unique indices of the
+    # windows holding at least one of values, each window running up to the next start.
+    if not len(values) or not len(window_starts):
+        return np.empty(0, dtype=np.int64)
+    window_starts = np.asarray(window_starts, dtype=np.int64)
+    positions = np.searchsorted(window_starts, np.asarray(values, dtype=np.int64), side="right") - 1
+    return np.unique(positions[positions >= 0])
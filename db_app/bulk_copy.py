@@ -0,0 +1,293 @@
+import io
+import logging
+from datetime import datetime, timezone
+from typing import AsyncIterable, Iterable
+
+import asyncpg
+import numpy as np
+
+from db_app.database import database
+from db_app.models import ensure_unique_key
+
+logger = logging.getLogger(__name__)
+
+KLINE_TABLE = "KlineData"
+KLINE_COLUMNS = [
+    "open_time",
+    "close_time",
+    "open_price",
+    "high_price",
+    "low_price",
+    "close_price",
+    "volume",
+    "quote_asset_volume",
+    "buy_base_asset_volume",
+    "buy_quote_asset_volume",
+    "number_of_trades",
+    "symbmol",
+    "interval",
+]
+KLINE_CONFLICT_COLUMNS = ["symbmol", "interval", "open_time"]
+
+TRADE_TABLE = "AggregatedTradeData"
+TRADE_COLUMNS = [
+    "aggregated_trade_id",
+    "price",
+    "quantity",
+    "first_trade_id",
+    "last_trade_id",
+    "trade_time",
+    "buyer_market_maker",
+    "best_price_match",
+    "kline_id",
+]
+TRADE_CONFLICT_COLUMNS = ["kline_id", "aggregated_trade_id"]
+
+INT32_MIN, INT32_MAX = -(2 ** 31), 2 ** 31 - 1
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + (0).to_bytes(4, "big") + (0).to_bytes(4, "big")
+COPY_TRAILER = (-1).to_bytes(2, "big", signed=True)
+PG_EPOCH_MS = 946_684_800_000
+
+
+def as_utc(date: datetime) -> datetime:
+    if date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def kline_record(kline) -> tuple:
+    # kline is a KlineData instance.
+    return (
+        as_utc(kline.open_time),
+        as_utc(kline.close_time),
+        kline.open_price,
+        kline.high_price,
+        kline.low_price,
+        kline.close_price,
+        kline.volume,
+        kline.quote_asset_volume,
+        kline.buy_base_asset_volume,
+        kline.buy_quote_asset_volume,
+        kline.number_of_trades,
+        kline.symbmol,
+        kline.interval,
+    )
+
+
+def trade_record(trade: dict) -> tuple:
+    # trade is a dict as built by TradeData.make_request_to_agg_trades.
+    kline = trade.get("kline")
+    return (
+        trade.get("aggregated_trade_id"),
+        trade.get("price"),
+        trade.get("quantity"),
+        trade.get("first_trade_id"),
+        trade.get("last_trade_id"),
+        as_utc(trade.get("trade_time")),
+        trade.get("buyer_market_maker"),
+        trade.get("best_price_match"),
+        kline.id if kline is not None else trade.get("kline_id"),
+    )
+
+
+def pg_timestamps(epoch_ms: np.ndarray) -> np.ndarray:
+    # timestamptz travels as microseconds since 2000-01-01 in the binary COPY format.
+    return (np.asarray(epoch_ms, dtype=np.int64) - PG_EPOCH_MS) * 1000
+
+
+def int32_column(values: np.ndarray, name: str) -> np.ndarray:
+    # INTEGER columns; numpy would wrap an out of range value into a wrong one without a word.
+    values = np.asarray(values)
+    if len(values) and (values.min() < INT32_MIN or values.max() > INT32_MAX):
+        raise ValueError(f"{name} does not fit a 32-bit INTEGER column: {values.min()}..{values.max()}")
+    return values
+
+
+def encode_binary_copy(columns: list[tuple[str, object]], rows: int) -> bytes:
+    # columns are (big-endian numpy format, values) pairs in table column order. Every field
+    # is fixed width, so all rows share one structured dtype and are written with one tobytes().
+    dtype = [("field_count", ">i2")]
+    for index, (fmt, _) in enumerate(columns):
+        dtype += [(f"length_{index}", ">i4"), (f"value_{index}", fmt)]
+    table = np.empty(rows, dtype=dtype)
+    table["field_count"] = len(columns)
+    for index, (fmt, values) in enumerate(columns):
+        table[f"length_{index}"] = np.dtype(fmt).itemsize
+        table[f"value_{index}"] = values
+    return COPY_HEADER + table.tobytes() + COPY_TRAILER
+
+
+def encode_klines(records: np.ndarray, symbol: str, interval: str) -> bytes:
+    # records are db_app.kline_cache.KLINE_DTYPE rows, encoded in KLINE_COLUMNS order.
+    symbol = symbol.encode()
+    interval = interval.encode()
+    return encode_binary_copy(
+        [
+            (">i8", pg_timestamps(records["open_time"])),
+            (">i8", pg_timestamps(records["close_time"])),
+            (">f8", records["open_price"]),
+            (">f8", records["high_price"]),
+            (">f8", records["low_price"]),
+            (">f8", records["close_price"]),
+            (">f8", records["volume"]),
+            (">f8", records["quote_asset_volume"]),
+            (">f8", records["buy_base_asset_volume"]),
+            (">f8", records["buy_quote_asset_volume"]),
+            (">i4", int32_column(records["number_of_trades"], "number_of_trades")),
+            (f"S{len(symbol)}", symbol),
+            (f"S{len(interval)}", interval),
+        ],
+        len(records),
+    )
+
+
+def encode_trades(records: np.ndarray) -> bytes:
+    # records are db_app.record_buffers.TRADE_DTYPE rows, encoded in TRADE_COLUMNS order.
+    return encode_binary_copy(
+        [
+            (">i8", records["aggregated_trade_id"]),
+            (">f8", records["price"]),
+            (">f8", records["quantity"]),
+            (">i8", records["first_trade_id"]),
+            (">i8", records["last_trade_id"]),
+            (">i8", pg_timestamps(records["trade_time"])),
+            ("u1", records["flags"] & 1),
+            ("u1", (records["flags"] >> 1) & 1),
+            (">i4", int32_column(records["kline_id"], "kline_id")),
+        ],
+        len(records),
+    )
+
+
+class BulkCopyWriter:
+    def __init__(
+            self,
+            table: str,
+            columns: list[str],
+            conflict_columns: list[str] | None = None,
+            batch_size: int = 50_000,
+            dsn: str | None = None,
+            connection: asyncpg.Connection | None = None,
+    ):
+        self.table = table
+        self.columns = columns
+        self.conflict_columns = conflict_columns
+        self.batch_size = batch_size
+        self.dsn = dsn
+        self.connection = connection
+        self.own_connection = connection is None
+        self.lease = None
+        self.staging_table = f"staging_{table.lower()}"
+        self.written = 0
+
+    async def __aenter__(self) -> "BulkCopyWriter":
+        if self.connection is None:
+            if self.dsn is None:
+                # Borrowed from the shared pool for as long as the writer is open.
+                self.lease = database.connection()
+                self.connection = await self.lease.__aenter__()
+            else:
+                self.connection = await asyncpg.connect(self.dsn)
+        if self.conflict_columns:
+            # ON CONFLICT needs a unique index on exactly these columns.
+            await ensure_unique_key(self.connection, self.table, self.conflict_columns)
+            await self.connection.execute(
+                f'CREATE TEMP TABLE IF NOT EXISTS "{self.staging_table}" '
+                f'(LIKE "{self.table}" INCLUDING DEFAULTS)'
+            )
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        if self.conflict_columns:
+            await self.connection.execute(f'DROP TABLE IF EXISTS "{self.staging_table}"')
+        if self.own_connection:
+            if self.lease is None:
+                await self.connection.close()
+            else:
+                await self.lease.__aexit__(exc_type, exc, traceback)
+                self.lease = None
+            self.connection = None
+
+    def _merge_query(self) -> str:
+        # conflict_columns are a unique key of the table, see the models' Meta.unique_together.
+        columns = ", ".join(f'"{column}"' for column in self.columns)
+        conflict = ", ".join(f'"{column}"' for column in self.conflict_columns)
+        return (
+            f'INSERT INTO "{self.table}" ({columns}) '
+            f'SELECT {columns} FROM "{self.staging_table}" '
+            f'ON CONFLICT ({conflict}) DO NOTHING'
+        )
+
+    async def _copy(self, table: str, records: list[tuple] | None, payload: bytes | None) -> None:
+        if payload is None:
+            await self.connection.copy_records_to_table(table, records=records, columns=self.columns)
+        else:
+            await self.connection.copy_to_table(
+                table, source=io.BytesIO(payload), columns=self.columns, format="binary",
+            )
+
+    async def _write(self, rows: int, records: list[tuple] | None = None, payload: bytes | None = None) -> int:
+        if not self.conflict_columns:
+            await self._copy(self.table, records, payload)
+            inserted = rows
+        else:
+            async with self.connection.transaction():
+                await self._copy(self.staging_table, records, payload)
+                status = await self.connection.execute(self._merge_query())
+                await self.connection.execute(f'TRUNCATE "{self.staging_table}"')
+            inserted = int(status.split()[-1])
+        self.written += inserted
+        logger.info(f"Copied {rows} rows into {self.table}, inserted {inserted}")
+        return inserted
+
+    async def write_batch(self, records: list[tuple]) -> int:
+        if not records:
+            return 0
+        return await self._write(len(records), records=records)
+
+    async def write_binary(self, payload: bytes, rows: int) -> int:
+        # payload is a complete binary COPY stream, e.g. from encode_klines or encode_trades.
+        if not rows:
+            return 0
+        return await self._write(rows, payload=payload)
+
+    async def write(self, records: Iterable[tuple]) -> int:
+        inserted = 0
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                inserted += await self.write_batch(batch)
+                batch = []
+        inserted += await self.write_batch(batch)
+        return inserted
+
+    async def write_async(self, records: AsyncIterable[tuple]) -> int:
+        inserted = 0
+        batch = []
+        async for record in records:
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                inserted += await self.write_batch(batch)
+                batch = []
+        inserted += await self.write_batch(batch)
+        return inserted
+
+
+def kline_writer(upsert: bool = False, **kwargs) -> BulkCopyWriter:
+    return BulkCopyWriter(
+        KLINE_TABLE,
+        KLINE_COLUMNS,
+        conflict_columns=KLINE_CONFLICT_COLUMNS if upsert else None,
+        **kwargs,
+    )
+
+
+def trade_writer(upsert: bool = False, **kwargs) -> BulkCopyWriter:
+    return BulkCopyWriter(
+        TRADE_TABLE,
+        TRADE_COLUMNS,
+        conflict_columns=TRADE_CONFLICT_COLUMNS if upsert else None,
+        **kwargs,
+    )
@@ -1,3 +1,4 @@
+import functools
 import os
 
 import dotenv
@@ -54,11 +55,14 @@ accounts_config = [
 ]
 
 
-aws_clients_ec2 = [
-    boto3.client(
-        'ec2',
-        aws_access_key_id=account.get("aws_access_key_id"),
-        aws_secret_access_key=account.get("aws_secret_access_key"),
-        region_name=account.get("region_name")
-    ) for account in accounts_config
-]
+@functools.cache
+def get_aws_clients_ec2() -> list:
+    # Built on first use, so importing the config does not create boto3 sessions.
+    return [
+        boto3.client(
+            'ec2',
+            aws_access_key_id=account.get("aws_access_key_id"),
+            aws_secret_access_key=account.get("aws_secret_access_key"),
+            region_name=account.get("region_name")
+        ) for account in accounts_config
+    ]
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from tortoise import Tortoise, connections
+
+from db_app.config import db_config
+from utils.latency import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+DB_POOL_MIN_SIZE = int(os.getenv("db_pool_min_size", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("db_pool_max_size", "10"))
+
+
+def sized_config(config: dict, min_size: int, max_size: int) -> dict:
+    # Tortoise passes minsize/maxsize from the URL or credentials on to asyncpg.create_pool.
+    connection = config["connections"]["default"]
+    if isinstance(connection, dict):
+        connection = {**connection, "credentials": {**connection["credentials"], "minsize": min_size, "maxsize": max_size}}
+    else:
+        separator = "&" if "?" in connection else "?"
+        connection = f"{connection}{separator}minsize={min_size}&maxsize={max_size}"
+    return {**config, "connections": {**config["connections"], "default": connection}}
+
+
+class Database:
+    # One Tortoise setup and connection pool per process. Entry points hold it open with
+    # `async with database:`; library code does the same, which then only reuses the open pool.
+    def __init__(
+            self,
+            config: dict = db_config,
+            min_size: int = DB_POOL_MIN_SIZE,
+            max_size: int = DB_POOL_MAX_SIZE,
+    ):
+        self.config = config
+        self.min_size = min_size
+        self.max_size = max_size
+        self.users = 0
+        self.opening = None
+        self.wait = LatencyHistogram()
+        self.acquisitions = 0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    async def __aenter__(self) -> "Database":
+        if self.opening is None:
+            self.opening = asyncio.ensure_future(
+                Tortoise.init(sized_config(self.config, self.min_size, self.max_size))
+            )
+        try:
+            # Shielded, so a cancelled caller does not leave Tortoise half initialised for the rest.
+            await asyncio.shield(self.opening)
+        except BaseException:
+            if not self.users and self.opening.done():
+                self.opening = None
+            raise
+        self.users += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        if self.users == 1:
+            logger.info(f"Closing database connections: {self.stats()}")
+        self.users -= 1
+        if not self.users:
+            self.opening = None
+            await Tortoise.close_connections()
+
+    @asynccontextmanager
+    async def connection(self):
+        # A raw asyncpg connection from the same pool the ORM uses, e.g. for COPY.
+        async with self:
+            started_at = time.perf_counter_ns()
+            async with connections.get("default").acquire_connection() as connection:
+                self.wait.record(time.perf_counter_ns() - started_at)
+                self.acquisitions += 1
+                self.in_use += 1
+                self.max_in_use = max(self.max_in_use, self.in_use)
+                try:
+                    yield connection
+                finally:
+                    self.in_use -= 1
+
+    def stats(self) -> dict:
+        # wait and in_use cover connection() leases; pool_size and pool_idle include ORM queries.
+        stats = {
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "users": self.users,
+            "acquisitions": self.acquisitions,
+            "in_use": self.in_use,
+            "max_in_use": self.max_in_use,
+            "wait": self.wait.summary(),
+        }
+        if self.users:
+            # Tortoise does not expose its asyncpg pool, which is created on the first query.
+            pool = getattr(connections.get("default"), "_pool", None)
+            if pool is not None:
+                stats["pool_size"] = pool.get_size()
+                stats["pool_idle"] = pool.get_idle_size()
+        return stats
+
+
+database = Database()
@@ -0,0 +1,234 @@
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from db_app.database import database
+from db_app.models import KlineData
+from utils.intervals import INTERVAL_MS
+
+logger = logging.getLogger(__name__)
+
+DAY_MS = 86_400_000
+
+KLINE_DTYPE = np.dtype(
+    [
+        ("open_time", "<i8"),
+        ("close_time", "<i8"),
+        ("open_price", "<f8"),
+        ("high_price", "<f8"),
+        ("low_price", "<f8"),
+        ("close_price", "<f8"),
+        ("volume", "<f8"),
+        ("quote_asset_volume", "<f8"),
+        ("buy_base_asset_volume", "<f8"),
+        ("buy_quote_asset_volume", "<f8"),
+        ("number_of_trades", "<i8"),
+    ]
+)
+
+KLINE_FIELDS = list(KLINE_DTYPE.names)
+
+
+def to_epoch_ms(date: datetime) -> int:
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+def from_epoch_ms(value: int) -> datetime:
+    return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+
+
+def records_from_rows(rows: list) -> np.ndarray:
+    # rows are tuples in KLINE_FIELDS order with datetimes for the two time columns.
+    records = np.empty(len(rows), dtype=KLINE_DTYPE)
+    if not rows:
+        return records
+    columns = list(zip(*rows))
+    records["open_time"] = [to_epoch_ms(value) for value in columns[0]]
+    records["close_time"] = [to_epoch_ms(value) for value in columns[1]]
+    for index, name in enumerate(KLINE_FIELDS[2:], start=2):
+        records[name] = columns[index]
+    return records
+
+
+def records_from_klines(klines: list[KlineData]) -> np.ndarray:
+    return records_from_rows(
+        [tuple(getattr(kline, name) for name in KLINE_FIELDS) for kline in klines]
+    )
+
+
+def kline_rows(columns: dict[str, np.ndarray]) -> list[list]:
+    # [open_time, open, high, low, close] lists, the shape SocketConn and search_macd expect.
+    return [
+        [from_epoch_ms(open_time), open_price, high_price, low_price, close_price]
+        for open_time, open_price, high_price, low_price, close_price in zip(
+            columns["open_time"].tolist(),
+            columns["open_price"].tolist(),
+            columns["high_price"].tolist(),
+            columns["low_price"].tolist(),
+            columns["close_price"].tolist(),
+        )
+    ]
+
+
+class KlineCache:
+    def __init__(self, root: str = os.getenv("kline_cache_path", "kline_cache")):
+        self.root = root
+
+    def _directory(self, symbol: str, interval: str) -> str:
+        return os.path.join(self.root, symbol, interval)
+
+    def _path(self, symbol: str, interval: str, day: int, complete: bool) -> str:
+        name = datetime.fromtimestamp(day * 86_400, tz=timezone.utc).strftime("%Y-%m-%d")
+        suffix = ".npy" if complete else ".partial.npy"
+        return os.path.join(self._directory(symbol, interval), name + suffix)
+
+    def cached_days(self, symbol: str, interval: str) -> dict[int, bool]:
+        # {day number since epoch: complete}
+        directory = self._directory(symbol, interval)
+        if not os.path.isdir(directory):
+            return {}
+        days = {}
+        for file_name in os.listdir(directory):
+            if not file_name.endswith(".npy"):
+                continue
+            date = datetime.strptime(file_name[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            day = int(date.timestamp()) // 86_400
+            days[day] = days.get(day, False) or not file_name.endswith(".partial.npy")
+        return days
+
+    def read_day(self, symbol: str, interval: str, day: int) -> np.ndarray | None:
+        for complete in (True, False):
+            path = self._path(symbol, interval, day, complete)
+            if os.path.exists(path):
+                return np.load(path, mmap_mode="r")
+        return None
+
+    def write_day(self, symbol: str, interval: str, day: int, records: np.ndarray, complete: bool) -> None:
+        os.makedirs(self._directory(symbol, interval), exist_ok=True)
+        path = self._path(symbol, interval, day, complete)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            np.save(file, np.ascontiguousarray(records, dtype=KLINE_DTYPE))
+        os.replace(temporary_path, path)
+        if complete:
+            stale_path = self._path(symbol, interval, day, complete=False)
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+    def append(self, symbol: str, interval: str, records: np.ndarray, complete_until: int | None = None) -> None:
+        # Merges records into their day files, newer rows win on equal open_time.
+        # Days that end before complete_until (epoch ms) are stored as complete.
+        if not len(records):
+            return
+        days = records["open_time"] // DAY_MS
+        cached = self.cached_days(symbol, interval)
+        for day in np.unique(days):
+            day = int(day)
+            new_records = records[days == day]
+            existing = self.read_day(symbol, interval, day)
+            if existing is not None:
+                new_records = np.concatenate([new_records, np.asarray(existing)])
+            _, first_seen = np.unique(new_records["open_time"], return_index=True)
+            merged = new_records[first_seen]
+            complete = cached.get(day, False) or (
+                complete_until is not None and (day + 1) * DAY_MS <= complete_until
+            )
+            self.write_day(symbol, interval, day, merged, complete)
+
+    def load(
+            self,
+            symbol: str,
+            interval: str,
+            start: datetime,
+            end: datetime,
+            columns: list[str] | None = None,
+    ) -> dict[str, np.ndarray]:
+        # Rows with start <= open_time < end.
+        start_ms = to_epoch_ms(start)
+        end_ms = to_epoch_ms(end)
+        columns = columns or KLINE_FIELDS
+        parts = []
+        for day in range(start_ms // DAY_MS, (end_ms - 1) // DAY_MS + 1):
+            records = self.read_day(symbol, interval, day)
+            if records is None:
+                continue
+            open_time = records["open_time"]
+            left = np.searchsorted(open_time, start_ms, side="left")
+            right = np.searchsorted(open_time, end_ms, side="left")
+            if right > left:
+                parts.append(records[left:right])
+
+        if not parts:
+            return {name: np.empty(0, dtype=KLINE_DTYPE[name]) for name in columns}
+        records = np.concatenate(parts)
+        return {name: records[name] for name in columns}
+
+    def load_frame(self, symbol: str, interval: str, start: datetime, end: datetime, columns: list[str] | None = None) -> pd.DataFrame:
+        frame = pd.DataFrame(self.load(symbol, interval, start, end, columns=columns))
+        for name in ("open_time", "close_time"):
+            if name in frame:
+                frame[name] = pd.to_datetime(frame[name], unit="ms", utc=True)
+        return frame
+
+    async def fill_from_db(
+            self,
+            symbol: str,
+            interval: str,
+            start: datetime,
+            end: datetime,
+            complete_until: int | None = None,
+    ) -> int:
+        # Pulls every missing or partial day in [start, end) from KlineData, one query per day.
+        # The database is only opened when some day is missing.
+        # A day is stored as complete only when it holds every candle, or ends before complete_until
+        # (epoch ms) for callers that know the DB is final up to there; anything else stays partial.
+        day_candles = DAY_MS // INTERVAL_MS[interval]
+        cached = self.cached_days(symbol, interval)
+        days = [
+            day for day in range(to_epoch_ms(start) // DAY_MS, (to_epoch_ms(end) - 1) // DAY_MS + 1)
+            if not cached.get(day)
+        ]
+        if not days:
+            return 0
+        filled = 0
+        async with database:
+            for day in days:
+                day_start = from_epoch_ms(day * DAY_MS)
+                rows = await (
+                    KlineData
+                    .filter(
+                        symbmol=symbol,
+                        interval=interval,
+                        open_time__gte=day_start,
+                        open_time__lt=day_start + timedelta(days=1),
+                    )
+                    .order_by("open_time")
+                    .values_list(*KLINE_FIELDS)
+                )
+                if not rows:
+                    continue
+                complete = len(rows) == day_candles or (
+                    complete_until is not None and (day + 1) * DAY_MS <= complete_until
+                )
+                self.write_day(symbol, interval, day, records_from_rows(rows), complete)
+                filled += len(rows)
+        if filled:
+            logger.info(f"Cached {filled} {symbol} {interval} klines from DB")
+        return filled
+
+    async def load_or_fill(
+            self,
+            symbol: str,
+            interval: str,
+            start: datetime,
+            end: datetime,
+            columns: list[str] | None = None,
+            complete_until: int | None = None,
+    ) -> dict[str, np.ndarray]:
+        await self.fill_from_db(symbol, interval, start, end, complete_until=complete_until)
+        return self.load(symbol, interval, start, end, columns=columns)
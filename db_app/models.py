@@ -1,10 +1,13 @@
 import asyncio
+import logging
+import zlib
 
 from tortoise import Tortoise, fields
 from tortoise.models import Model
 
-from db_app.config import db_config
+from db_app.database import database
 
+logger = logging.getLogger(__name__)
 
 class KlineData(Model):
     open_time = fields.DatetimeField(index=True)
@@ -26,6 +29,8 @@ class KlineData(Model):
     class Meta:
         table = "KlineData"
         indexes = [("open_time", "symbmol"), ("close_time", "symbmol")]
+        # The conflict key of the bulk COPY upsert, see db_app.bulk_copy.
+        unique_together = (("symbmol", "interval", "open_time"),)
 
     def __str__(self) -> str:
         return (
@@ -62,11 +67,11 @@ class KlineData(Model):
 
 
 class AggregatedTradeData(Model):
-    aggregated_trade_id = fields.IntField()
+    aggregated_trade_id = fields.BigIntField()
     price = fields.FloatField()
     quantity = fields.FloatField()
-    first_trade_id = fields.IntField()
-    last_trade_id = fields.IntField()
+    first_trade_id = fields.BigIntField()
+    last_trade_id = fields.BigIntField()
     trade_time = fields.DatetimeField()
     buyer_market_maker = fields.BooleanField()
     best_price_match = fields.BooleanField()
@@ -77,6 +82,9 @@ class AggregatedTradeData(Model):
 
     class Meta:
         table = "AggregatedTradeData"
+        # Trade ids repeat across symbols and the table has no symbol column; the kline a
+        # trade links to belongs to one symbol, so the pair is unique across symbols.
+        unique_together = (("kline_id", "aggregated_trade_id"),)
 
     def __str__(self) -> str:
         return (
@@ -102,9 +110,88 @@ class AggregatedTradeData(Model):
         )
 
 
+# BIGINT trade ids for tables created before the models used them, and the earlier unique
+# index on the trade id alone, which rejected other symbols' trades. Safe to re-run.
+SCHEMA_UPGRADES = [
+    'ALTER TABLE "AggregatedTradeData" '
+    'ALTER COLUMN aggregated_trade_id TYPE BIGINT, '
+    'ALTER COLUMN first_trade_id TYPE BIGINT, '
+    'ALTER COLUMN last_trade_id TYPE BIGINT',
+    'DROP INDEX IF EXISTS "uid_aggregatedtradedata_aggregated_trade_id"',
+]
+
+KLINE_DUPLICATES = (
+    '(SELECT id, min(id) OVER (PARTITION BY symbmol, "interval", open_time) AS keep '
+    'FROM "KlineData") AS duplicate'
+)
+
+# Run before a unique key is added to a table that may already hold duplicates, keeping
+# the row with the lowest id. Trades are moved onto the surviving kline before the
+# duplicate klines go, since deleting a kline cascades to its trades; trades that would
+# then repeat on that kline are deleted first, so an existing trade key is not violated.
+DEDUPLICATE = {
+    "KlineData": [
+        'DELETE FROM "AggregatedTradeData" AS trade '
+        'USING (SELECT moving.id, min(moving.id) OVER (PARTITION BY duplicate.keep, moving.aggregated_trade_id) AS keep '
+        f'FROM "AggregatedTradeData" AS moving JOIN {KLINE_DUPLICATES} ON moving.kline_id = duplicate.id) AS moved '
+        'WHERE trade.id = moved.id AND moved.id <> moved.keep',
+        f'UPDATE "AggregatedTradeData" AS trade SET kline_id = duplicate.keep FROM {KLINE_DUPLICATES} '
+        'WHERE trade.kline_id = duplicate.id AND duplicate.id <> duplicate.keep',
+        f'DELETE FROM "KlineData" AS kline USING {KLINE_DUPLICATES} '
+        'WHERE kline.id = duplicate.id AND duplicate.id <> duplicate.keep',
+    ],
+    "AggregatedTradeData": [
+        'DELETE FROM "AggregatedTradeData" AS trade '
+        'USING (SELECT id, min(id) OVER (PARTITION BY kline_id, aggregated_trade_id) AS keep '
+        'FROM "AggregatedTradeData") AS duplicate '
+        'WHERE trade.id = duplicate.id AND duplicate.id <> duplicate.keep',
+    ],
+}
+
+
+async def has_unique_key(connection, table: str, columns: list[str]) -> bool:
+    return await connection.fetchval(
+        (
+            "SELECT EXISTS (SELECT 1 FROM pg_index AS i WHERE i.indrelid = to_regclass($1) AND i.indisunique "
+            "AND (SELECT array_agg(a.attname::text ORDER BY a.attname) FROM pg_attribute AS a "
+            "WHERE a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)) = $2::text[])"
+        ),
+        f'"{table}"',
+        sorted(columns),
+    )
+
+
+async def ensure_unique_key(connection, table: str, columns: list[str]) -> None:
+    # Tables made by generate_schemas already have the key from Meta.unique_together; older
+    # ones are deduplicated and indexed once, under a lock so concurrent writers wait.
+    if await has_unique_key(connection, table, columns):
+        return
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock($1)", zlib.crc32(table.encode()))
+        if await has_unique_key(connection, table, columns):
+            return
+        logger.warning(f"Adding unique key ({', '.join(columns)}) to {table}, removing duplicates first")
+        for statement in DEDUPLICATE.get(table, []):
+            status = await connection.execute(statement)
+            logger.info(f"{table}: {status}")
+        index = f"uid_{table.lower()}_{'_'.join(columns)}"
+        listed = ", ".join(f'"{column}"' for column in columns)
+        await connection.execute(f'CREATE UNIQUE INDEX "{index}" ON "{table}" ({listed})')
+
+
+async def upgrade_schemas():
+    async with database.connection() as connection:
+        for statement in SCHEMA_UPGRADES:
+            await connection.execute(statement)
+        for model in (KlineData, AggregatedTradeData):
+            for columns in model._meta.unique_together:
+                await ensure_unique_key(connection, model._meta.db_table, list(columns))
+
+
 async def init_and_generate_schemas():
-    await Tortoise.init(db_config)
-    await Tortoise.generate_schemas()
+    async with database:
+        await Tortoise.generate_schemas(safe=True)
+        await upgrade_schemas()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+import numpy as np
+
+from db_app.kline_cache import KLINE_DTYPE
+
+TRADE_DTYPE = np.dtype(
+    [
+        ("aggregated_trade_id", "<i8"),
+        ("price", "<f8"),
+        ("quantity", "<f8"),
+        ("first_trade_id", "<i8"),
+        ("last_trade_id", "<i8"),
+        ("trade_time", "<i8"),
+        ("flags", "u1"),
+        ("kline_id", "<i8"),
+    ]
+)
+
+BUYER_MARKET_MAKER = 1
+BEST_PRICE_MATCH = 2
+
+
+class RecordBuffer:
+    # Growable structured array; records are filled in place and read back as column views.
+    def __init__(self, dtype: np.dtype, capacity: int = 1024):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.data[name][:self.size]
+
+    @property
+    def records(self) -> np.ndarray:
+        return self.data[:self.size]
+
+    @property
+    def nbytes(self) -> int:
+        return self.size * self.data.dtype.itemsize
+
+    def reserve(self, count: int) -> np.ndarray:
+        # Returns the next count uninitialised slots and counts them as filled.
+        needed = self.size + count
+        if needed > len(self.data):
+            grown = np.empty(max(needed, 2 * len(self.data)), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        slots = self.data[self.size:needed]
+        self.size = needed
+        return slots
+
+    def extend(self, records: np.ndarray) -> None:
+        self.reserve(len(records))[:] = records
+
+    def clear(self) -> None:
+        self.size = 0
+
+
+class KlineBuffer(RecordBuffer):
+    def __init__(self, capacity: int = 1024):
+        super().__init__(KLINE_DTYPE, capacity)
+
+    def extend_klines(self, klines: list[list]) -> np.ndarray:
+        # klines are rows of the /api/v3/klines response.
+        slots = self.reserve(len(klines))
+        if not klines:
+            return slots
+        columns = list(zip(*klines))
+        slots["open_time"] = columns[0]
+        slots["close_time"] = columns[6]
+        slots["open_price"] = np.asarray(columns[1], dtype=np.float64)
+        slots["high_price"] = np.asarray(columns[2], dtype=np.float64)
+        slots["low_price"] = np.asarray(columns[3], dtype=np.float64)
+        slots["close_price"] = np.asarray(columns[4], dtype=np.float64)
+        slots["volume"] = np.asarray(columns[5], dtype=np.float64)
+        slots["quote_asset_volume"] = np.asarray(columns[7], dtype=np.float64)
+        slots["buy_base_asset_volume"] = np.asarray(columns[9], dtype=np.float64)
+        slots["buy_quote_asset_volume"] = np.asarray(columns[10], dtype=np.float64)
+        slots["number_of_trades"] = columns[8]
+        return slots
+
+
+class TradeBuffer(RecordBuffer):
+    def __init__(self, capacity: int = 1024):
+        super().__init__(TRADE_DTYPE, capacity)
+
+    def extend_agg_trades(self, trades: list[dict]) -> np.ndarray:
+        # trades are items of the /api/v3/aggTrades response.
+        slots = self.reserve(len(trades))
+        if not trades:
+            return slots
+        slots["aggregated_trade_id"] = [trade["a"] for trade in trades]
+        slots["price"] = np.asarray([trade["p"] for trade in trades], dtype=np.float64)
+        slots["quantity"] = np.asarray([trade["q"] for trade in trades], dtype=np.float64)
+        slots["first_trade_id"] = [trade["f"] for trade in trades]
+        slots["last_trade_id"] = [trade["l"] for trade in trades]
+        slots["trade_time"] = [trade["T"] for trade in trades]
+        slots["flags"] = [
+            BUYER_MARKET_MAKER * trade["m"] + BEST_PRICE_MATCH * trade["M"] for trade in trades
+        ]
+        slots["kline_id"] = -1
+        return slots
+
+    @property
+    def buyer_market_maker(self) -> np.ndarray:
+        return (self["flags"] & BUYER_MARKET_MAKER) != 0
+
+    @property
+    def best_price_match(self) -> np.ndarray:
+        return (self["flags"] & BEST_PRICE_MATCH) != 0
@@ -1,7 +1,18 @@
-import requests
-from datetime import datetime, timedelta, timezone
+import asyncio
+from datetime import datetime, timezone
 import logging
 
+import aiohttp
+import numpy as np
+
+from client_API.proxy_pool import ProxyPool
+from client_API.scheduler import REQUEST_WEIGHTS, RequestScheduler
+from client_API.trade_linking import MINUTE_MS
+from db_app.kline_cache import from_epoch_ms, to_epoch_ms
+from db_app.record_buffers import TRADE_DTYPE, TradeBuffer
+from indicators.order_flow import OrderFlowAccumulator, order_flow
+from utils.decoders import get_decoder
+
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -16,115 +27,199 @@ logger.addHandler(file_handler)
 
 
 BASE_API_URL = "https://api.binance.com/api/v3/"
+STREAM_URL = "wss://stream.binance.com:9443/ws/"
+AGG_TRADES_LIMIT = 1000
 
 
-def make_request_to_klines(start_time: datetime, end_time: datetime):
-    resp = requests.get(
-        f"{BASE_API_URL}klines",
-        params={
-            "symbol": "ETHUSDT",
-            "interval": "1m",
-            "limit": 1000,
-            "startTime": int(start_time),
-            "endTime": int(end_time),
-        },
-    )
-
-    kline = resp.json()[0]
-    open_price = float(kline[1])
-    high_price = float(kline[2])
-    low_price = float(kline[3])
-    close_price = float(kline[4])
-    logger.info(
-        (
-            f"*Open price*: {open_price}, "
-            f"*High price*: {high_price}, "
-            f"*Low price*: {low_price}, "
-            f"*Close price*: {close_price} "
-        )
-    )
-
-
-def anylyze_price(trades: list[dict]):
-    total_buy_trades = 0
-    total_buy_in_eth = 0
-    total_buy_in_usdt = 0
-
-    total_sell_trades = 0
-    total_sell_in_eth = 0
-    total_sell_in_usdt = 0
-
-    for trade in trades:
-        if trade.get("m"):
-            total_buy_trades += 1
-            total_buy_in_usdt += float(trade.get("p"))
-            total_buy_in_eth += float(trade.get("q"))
-        else:
-            total_sell_trades += 1
-            total_sell_in_usdt += float(trade.get("p"))
-            total_sell_in_eth += float(trade.get("q"))
+def anylyze_price(trades: TradeBuffer):
+    # Sides are the aggressor's: a trade whose buyer was the maker is a sell.
+    for feature in order_flow(trades.records, MINUTE_MS):
+        log_order_flow(feature)
 
-    total_trade_operations = total_buy_trades + total_sell_trades
-    defference_in_usdt = total_buy_in_usdt - total_sell_in_usdt
-    defference_in_eth = total_buy_in_eth - total_sell_in_eth
 
+def log_order_flow(feature):
     logger.info(
         (
-            f"**Total trades**: {total_trade_operations}, "
-            f"**Total buy trades**: {total_buy_trades}, "
-            f"**Total sell trades**: {total_sell_trades}, "
-            f"**Defference in usdt**: {defference_in_usdt}, "
-            f"**Defference in eth**: {defference_in_eth} "
-            f"**Total buy in usdt**: {total_buy_in_usdt}, "
-            f"**Total buy in eth**: {total_buy_in_eth}, "
-            f"**Total sell in usdt**: {total_sell_in_usdt}, "
-            f"**Total sell in eth**: {total_sell_in_eth} "
+            f"**Window**: {from_epoch_ms(int(feature['open_time']))}, "
+            f"**Total trades**: {feature['buy_trades'] + feature['sell_trades']}, "
+            f"**Total buy trades**: {feature['buy_trades']}, "
+            f"**Total sell trades**: {feature['sell_trades']}, "
+            f"**Defference in usdt**: {feature['buy_notional'] - feature['sell_notional']}, "
+            f"**Defference in eth**: {feature['buy_volume'] - feature['sell_volume']} "
+            f"**Total buy in usdt**: {feature['buy_notional']}, "
+            f"**Total buy in eth**: {feature['buy_volume']}, "
+            f"**Total sell in usdt**: {feature['sell_notional']}, "
+            f"**Total sell in eth**: {feature['sell_volume']}, "
+            f"**CVD**: {feature['cvd']}, "
+            f"**VWAP**: {feature['vwap']}, "
+            f"**Trade imbalance**: {feature['trade_imbalance']} "
         )
     )
 
 
-def make_request_to_aggtrades(start_time: datetime, end_time: datetime):
-    resp = requests.get(
-        f"{BASE_API_URL}aggTrades",
-        params={
-            "symbol": "ETHUSDT",
-            "startTime": int(start_time),
-            "endTime": int(end_time),
-            "limit": 1000,
-        },
-    )
-
-    logger.info(f"Response status code: {resp.status_code}")
-
-    anylyze_price(resp.json())
-
-
-def start_requests():
-    start_time = datetime(2024, 2, 10, 0, 0, )
-    end_time = datetime(2024, 2, 10, 0, 1, 0)
-
-    logger.info(
-            f"{'=' * 7}START REQUESTS FOR {start_time.date()}, {start_time.time()} - {end_time.time()}{'=' * 7}"
-    )
-
-    while True:
-        make_request_to_aggtrades(
-            start_time.replace(tzinfo=timezone.utc).timestamp() * 1000,
-            end_time.replace(tzinfo=timezone.utc).timestamp() * 1000,
+class MinuteScanner:
+    # Catches up minute by minute over REST with many minutes in flight, then follows
+    # the @aggTrade stream. Trades are paged by fromId, so busy minutes are never cut at 1000.
+    def __init__(
+            self,
+            scheduler: RequestScheduler,
+            symbol: str = "ETHUSDT",
+            concurrency: int = 16,
+    ):
+        self.scheduler = scheduler
+        self.symbol = symbol
+        self.concurrency = concurrency
+        self.decoder = get_decoder()
+        self.last_trade_id = None
+        self.features = []
+        self.failed_minutes = []
+
+    async def __call__(self, start_time: datetime):
+        features = await self.catch_up(start_time, datetime.now(timezone.utc))
+        # The live CVD carries on from the caught-up one.
+        await self.live(float(features["cvd"][-1]) if len(features) else 0.0)
+
+    async def agg_trades_page(self, params: dict) -> np.ndarray:
+        # A page the scheduler gave up on raises, an empty page would pass for a quiet minute.
+        page = await self.scheduler.get_json(
+            f"{BASE_API_URL}aggTrades",
+            {"symbol": self.symbol, "limit": AGG_TRADES_LIMIT, **params},
+            REQUEST_WEIGHTS["aggTrades"],
+            decode=self.decoder.agg_trades,
         )
-
-        make_request_to_klines(
-            start_time.replace(tzinfo=timezone.utc).timestamp() * 1000,
-            end_time.replace(tzinfo=timezone.utc).timestamp() * 1000,
+        if page is None:
+            raise RuntimeError(f"Could not fetch {self.symbol} aggTrades for {params}")
+        return page
+
+    async def trades_from_id(self, from_id: int, end_time: int | None = None, last_id: int | None = None) -> np.ndarray:
+        # Pages forward from from_id until a trade passes end_time (epoch ms) or last_id.
+        pages = []
+        while True:
+            page = await self.agg_trades_page({"fromId": from_id})
+            if end_time is not None:
+                page = page[page["trade_time"] <= end_time]
+            if last_id is not None:
+                page = page[page["aggregated_trade_id"] <= last_id]
+            pages.append(page)
+            if len(page) < AGG_TRADES_LIMIT:
+                return np.concatenate(pages)
+            from_id = int(page["aggregated_trade_id"][-1]) + 1
+
+    async def make_request_to_aggtrades(self, start_time: int, end_time: int) -> np.ndarray:
+        trades = await self.agg_trades_page({"startTime": start_time, "endTime": end_time})
+        if len(trades) < AGG_TRADES_LIMIT:
+            return trades
+        rest = await self.trades_from_id(int(trades["aggregated_trade_id"][-1]) + 1, end_time=end_time)
+        return np.concatenate((trades, rest))
+
+    async def make_request_to_klines(self, start_time: int, end_time: int):
+        klines = await self.scheduler.get_json(
+            f"{BASE_API_URL}klines",
+            {"symbol": self.symbol, "interval": "1m", "limit": 1, "startTime": start_time, "endTime": end_time},
+            REQUEST_WEIGHTS["klines"],
+            decode=self.decoder.rest_klines,
+        )
+        if klines is None or not len(klines):
+            return
+        kline = klines[0]
+        logger.info(
+            (
+                f"*Open price*: {kline['open_price']}, "
+                f"*High price*: {kline['high_price']}, "
+                f"*Low price*: {kline['low_price']}, "
+                f"*Close price*: {kline['close_price']} "
+            )
         )
 
+    async def scan_minute(self, start_time: int) -> np.ndarray:
+        end_time = start_time + MINUTE_MS - 1
+        try:
+            trades, _ = await asyncio.gather(
+                self.make_request_to_aggtrades(start_time, end_time),
+                self.make_request_to_klines(start_time, end_time),
+            )
+        except RuntimeError as e:
+            logger.error(f"Minute {from_epoch_ms(start_time)} failed: {e}")
+            self.failed_minutes.append(start_time)
+            return order_flow(np.empty(0, TRADE_DTYPE), MINUTE_MS)
+        features = order_flow(trades, MINUTE_MS)
+        for feature in features:
+            log_order_flow(feature)
+        if len(trades):
+            last_id = int(trades["aggregated_trade_id"][-1])
+            self.last_trade_id = last_id if self.last_trade_id is None else max(self.last_trade_id, last_id)
+        return features
+
+    async def catch_up(self, start_time: datetime, end_time: datetime) -> np.ndarray:
+        # Every finished minute in [start_time, end_time), concurrency of them at a time.
+        first = to_epoch_ms(start_time) // MINUTE_MS * MINUTE_MS
+        last = to_epoch_ms(end_time) // MINUTE_MS * MINUTE_MS
+        minutes = iter(range(first, last, MINUTE_MS))
         logger.info(
-            f"{'=' * 7}END REQUESTS FOR {start_time.date()}, {start_time.time()} - {end_time.time()}{'=' * 7}"
+            f"{'=' * 7}CATCHING UP {from_epoch_ms(first)} - {from_epoch_ms(last)}, "
+            f"{(last - first) // MINUTE_MS} minutes{'=' * 7}"
         )
 
-        start_time = end_time
-        end_time = end_time + timedelta(minutes=1)
+        async def worker():
+            for minute in minutes:
+                self.features.append(await self.scan_minute(minute))
+
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(self.concurrency):
+                tg.create_task(worker())
+
+        features = np.concatenate(self.features) if self.features else order_flow(np.empty(0, TRADE_DTYPE), MINUTE_MS)
+        features = features[np.argsort(features["open_time"], kind="stable")]
+        features["cvd"] = np.cumsum(features["buy_volume"] - features["sell_volume"])
+        self.features = []
+        logger.info(f"{'=' * 7}CAUGHT UP, {len(features)} minutes with trades{'=' * 7}")
+        if self.failed_minutes:
+            self.failed_minutes.sort()
+            logger.warning(
+                f"{len(self.failed_minutes)} minutes failed and are left out of the CVD: "
+                f"{', '.join(str(from_epoch_ms(minute)) for minute in self.failed_minutes)}"
+            )
+        return features
+
+    async def live(self, cvd_start: float = 0.0):
+        # Trades are buffered and folded into the order flow once a minute closes.
+        accumulator = OrderFlowAccumulator(MINUTE_MS, cvd_start=cvd_start)
+        buffer = TradeBuffer()
+        current_minute = None
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(f"{STREAM_URL}{self.symbol.lower()}@aggTrade") as ws:
+                while True:
+                    msg = await ws.receive()
+                    if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                        logger.info(f"Stream closed: {msg.type}")
+                        break
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    trade = self.decoder.agg_trade_event(msg.data)
+                    trade_id = trade[0]
+                    if self.last_trade_id is not None:
+                        if trade_id <= self.last_trade_id:
+                            continue
+                        if trade_id > self.last_trade_id + 1:
+                            # Trades made between the end of catch-up and the first stream event.
+                            buffer.extend(await self.trades_from_id(self.last_trade_id + 1, last_id=trade_id - 1))
+                    self.last_trade_id = trade_id
+
+                    buffer.reserve(1)[0] = trade
+                    minute = trade[5] // MINUTE_MS
+                    if minute != current_minute:
+                        # The first trade of a minute is what closes the previous one.
+                        for feature in accumulator.extend(buffer.records):
+                            log_order_flow(feature)
+                        buffer.clear()
+                        current_minute = minute
+
+
+async def main():
+    async with ProxyPool([None]) as pool:
+        scanner = MinuteScanner(RequestScheduler(pool))
+        await scanner(datetime(2024, 2, 10, tzinfo=timezone.utc))
 
 
 if __name__ == "__main__":
-    start_requests()
+    asyncio.run(main())
@@ -6,10 +6,9 @@ import asyncio
 from datetime import datetime, timezone
 import logging
 
-import tortoise
-
 from db_app.models import KlineData, AggregatedTradeData
-from db_app.config import db_config
+from db_app.database import database
+from db_app.kline_cache import KlineCache, from_epoch_ms, to_epoch_ms
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -60,13 +59,11 @@ async def find_profit(
         signal_date_to_increase: datetime,
         signal_date_to_decrease: datetime,
 ) -> tuple:
-    await tortoise.Tortoise.init(db_config)
-    klines_for_certain_period = await KlineData.filter(
-        open_time__gte=signal_date_to_increase,
-        close_time__lte=signal_date_to_decrease
-    ).order_by("open_time")
-
-    await tortoise.Tortoise.close_connections()
+    async with database:
+        klines_for_certain_period = await KlineData.filter(
+            open_time__gte=signal_date_to_increase,
+            close_time__lte=signal_date_to_decrease
+        ).order_by("open_time")
 
     signal_kline = klines_for_certain_period[0]
 
@@ -83,22 +80,93 @@ async def find_profit(
     return signal_kline.open_time, on_signal_bought_price, max_price, profit
 
 
-async def analyse_ginals(signals_list: list[dict]):
+def build_sparse_table(values: np.ndarray, max_length: int) -> list[np.ndarray]:
+    # table[level][i] == values[i:i + 2 ** level].max(); levels stop at max_length.
+    table = [np.asarray(values, dtype=np.float64)]
+    level = 1
+    while (1 << level) <= max_length:
+        previous = table[-1]
+        half = 1 << (level - 1)
+        table.append(np.maximum(previous[:-half], previous[half:]))
+        level += 1
+    return table
+
+
+def range_max(values: np.ndarray, starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    # max(values[start:stop]) for every pair, NaN for empty ranges.
+    lengths = stops - starts
+    result = np.full(len(starts), np.nan)
+    non_empty = lengths > 0
+    if not non_empty.any():
+        return result
+    table = build_sparse_table(values, int(lengths[non_empty].max()))
+    levels = np.log2(lengths[non_empty]).astype(np.int64)
+    left = starts[non_empty]
+    right = stops[non_empty] - (1 << levels)
+    for level in np.unique(levels):
+        rows = levels == level
+        result_rows = np.flatnonzero(non_empty)[rows]
+        result[result_rows] = np.maximum(table[level][left[rows]], table[level][right[rows]])
+    return result
+
+
+async def find_profits(
+        signal_pairs: list[tuple[datetime, datetime]],
+        symbol: str = "ETHUSDT",
+        interval: str = "1m",
+        cache: KlineCache | None = None,
+) -> list[tuple]:
+    # Batch version of find_profit: one load of the covering range, then every pair
+    # is two searchsorted lookups and one sparse-table range max.
+    if not signal_pairs:
+        return []
+    cache = cache or KlineCache()
+    increase_ms = np.array([to_epoch_ms(increase) for increase, _ in signal_pairs], dtype=np.int64)
+    decrease_ms = np.array([to_epoch_ms(decrease) for _, decrease in signal_pairs], dtype=np.int64)
+
+    klines = await cache.load_or_fill(
+        symbol,
+        interval,
+        from_epoch_ms(int(increase_ms.min())),
+        from_epoch_ms(int(decrease_ms.max()) + 1),
+        columns=["open_time", "close_time", "open_price", "high_price"],
+    )
+
+    open_time = klines["open_time"]
+    high_price = np.ascontiguousarray(klines["high_price"])
+    starts = np.searchsorted(open_time, increase_ms, side="left")
+    stops = np.maximum(np.searchsorted(klines["close_time"], decrease_ms, side="right"), starts)
+    max_prices = range_max(high_price, starts + 1, stops)
+
+    results = []
+    for index, (start, stop, max_price) in enumerate(zip(starts.tolist(), stops.tolist(), max_prices.tolist())):
+        if stop == start:
+            logger.info(f"No klines for signal at {signal_pairs[index][0]}")
+            results.append((signal_pairs[index][0], np.nan, np.nan, np.nan))
+            continue
+        signal_time = from_epoch_ms(int(open_time[start]))
+        if stop - start < 2:
+            results.append((signal_time, float(high_price[start]), float(high_price[start]), -0.99999))
+            continue
+        on_signal_bought_price = float(klines["open_price"][start])
+        results.append((signal_time, on_signal_bought_price, max_price, max_price - on_signal_bought_price))
+    return results
+
+
+async def analyse_ginals(signals_list: list[dict], symbol: str = "ETHUSDT", interval: str = "1m"):
     if signals_list[0].get("crossover") == -1:
         logger.info(f"Deleted first signal: {signals_list[0]}")
         signals_list.pop(0)
 
-    results = []
+    signal_pairs = []
 
     while len(signals_list) >= 2:
         increase_signal = signals_list.pop(0)
         decrease_signal = signals_list.pop(0)
-        result = await find_profit(
-            signal_date_to_increase=increase_signal["open_time"],
-            signal_date_to_decrease=decrease_signal["open_time"],
-        )
-        results.append(result)
-        logger.info(f"Sending request for {increase_signal['open_time']} and {decrease_signal['open_time']}")
+        signal_pairs.append((increase_signal["open_time"], decrease_signal["open_time"]))
+
+    logger.info(f"Evaluating {len(signal_pairs)} signal pairs")
+    results = await find_profits(signal_pairs, symbol=symbol, interval=interval)
 
     df = pd.DataFrame(results).iloc[:, :4]
     df.columns = ["signal_time", "on_signal_bought_price", "max_price", "profit"]
@@ -0,0 +1,151 @@
+import math
+from collections import deque
+
+
+class RollingExtreme:
+    def __init__(self, window: int, is_max: bool = True):
+        self.window = window
+        self.is_max = is_max
+        self.values = deque()
+        self.count = 0
+
+    def _dominates(self, old_value: float, new_value: float) -> bool:
+        if self.is_max:
+            return old_value <= new_value
+        return old_value >= new_value
+
+    def push(self, value: float) -> None:
+        while self.values and self._dominates(self.values[-1][1], value):
+            self.values.pop()
+        self.values.append((self.count, value))
+        self.count += 1
+        while self.values and self.values[0][0] <= self.count - 1 - self.window:
+            self.values.popleft()
+
+    def extreme_with(self, value: float) -> float:
+        # Extreme over the last ``window`` committed values plus ``value``,
+        # which is why the deque itself only keeps ``window - 1`` of them.
+        if self.count < self.window:
+            return math.nan
+        if not self.values:
+            return value
+        current = self.values[0][1]
+        if self.is_max:
+            return value if value > current else current
+        return value if value < current else current
+
+
+class IncrementalMACD:
+    def __init__(
+            self,
+            short_period: int = 12,
+            long_period: int = 26,
+            k_period: int = 12,
+            d_period: int = 3,
+            signal_period: int = 9,
+    ):
+        self.short_period = short_period
+        self.long_period = long_period
+        self.k_period = k_period
+        self.d_period = d_period
+        self.fast_alpha = 2 / (short_period + 1)
+        self.slow_alpha = 2 / (long_period + 1)
+        self.signal_alpha = 2 / (signal_period + 1)
+
+        self.ma_fast = None
+        self.ma_slow = None
+        self.signal = None
+        self.macd = math.nan
+        self.stoch_k = math.nan
+        self.stoch_d = math.nan
+        self.highs = RollingExtreme(k_period - 1, is_max=True)
+        self.lows = RollingExtreme(k_period - 1, is_max=False)
+        self.last_k_values = deque(maxlen=d_period - 1)
+        self.committed = 0
+
+    @classmethod
+    def from_klines(cls, klines_data: list, **kwargs) -> "IncrementalMACD":
+        engine = cls(**kwargs)
+        for kline in klines_data:
+            engine.commit(kline)
+        return engine
+
+    @staticmethod
+    def _ewm(previous: float | None, value: float, alpha: float) -> float:
+        if previous is None:
+            return value
+        return previous + alpha * (value - previous)
+
+    @staticmethod
+    def _stochastic_k(close: float, n_high: float, n_low: float) -> float:
+        numerator = (close - n_low) * 100
+        denominator = n_high - n_low
+        if denominator == 0:
+            if numerator == 0 or math.isnan(numerator):
+                return math.nan
+            return math.copysign(math.inf, numerator)
+        return numerator / denominator
+
+    def _stochastic_d(self, stoch_k: float) -> float:
+        if len(self.last_k_values) < self.d_period - 1:
+            return math.nan
+        return (sum(self.last_k_values) + stoch_k) / self.d_period
+
+    @staticmethod
+    def _crossover(current: float, current_signal: float, previous: float, previous_signal: float) -> int:
+        if current > current_signal and previous <= previous_signal:
+            return 1
+        if current < current_signal and previous >= previous_signal:
+            return -1
+        return 0
+
+    def _compute(self, kline) -> dict:
+        open_time, open_price, high_price, low_price, close_price = kline[:5]
+
+        ma_fast = self._ewm(self.ma_fast, close_price, self.fast_alpha)
+        ma_slow = self._ewm(self.ma_slow, close_price, self.slow_alpha)
+        macd = ma_fast - ma_slow
+        signal = self._ewm(self.signal, macd, self.signal_alpha)
+        n_high = self.highs.extreme_with(high_price)
+        n_low = self.lows.extreme_with(low_price)
+        stoch_k = self._stochastic_k(close_price, n_high, n_low)
+        stoch_d = self._stochastic_d(stoch_k)
+
+        return {
+            "open_time": open_time,
+            "open": open_price,
+            "high": high_price,
+            "low": low_price,
+            "close": close_price,
+            "ma_fast": ma_fast,
+            "ma_slow": ma_slow,
+            "macD": macd,
+            "signal": signal,
+            "n_high": n_high,
+            "n_low": n_low,
+            "%K": stoch_k,
+            "%D": stoch_d,
+            "macd_crossover": self._crossover(macd, signal, self.macd, self._last_signal()),
+            "stochastic_crossover": self._crossover(stoch_k, stoch_d, self.stoch_k, self.stoch_d),
+        }
+
+    def _last_signal(self) -> float:
+        return math.nan if self.signal is None else self.signal
+
+    def peek(self, kline) -> dict:
+        return self._compute(kline)
+
+    def commit(self, kline) -> dict:
+        result = self._compute(kline)
+        self.ma_fast = result["ma_fast"]
+        self.ma_slow = result["ma_slow"]
+        self.signal = result["signal"]
+        self.macd = result["macD"]
+        self.stoch_k = result["%K"]
+        self.stoch_d = result["%D"]
+        self.highs.push(result["high"])
+        self.lows.push(result["low"])
+        if self.d_period > 1:
+            self.last_k_values.append(result["%K"])
+        self.committed += 1
+        return result
@@ -0,0 +1,100 @@
+import numpy as np
+
+from db_app.record_buffers import BUYER_MARKET_MAKER
+from indicators.resample import group_starts
+
+ORDER_FLOW_DTYPE = np.dtype(
+    [
+        ("open_time", "<i8"),
+        ("buy_volume", "<f8"),
+        ("sell_volume", "<f8"),
+        ("buy_notional", "<f8"),
+        ("sell_notional", "<f8"),
+        ("buy_trades", "<i8"),
+        ("sell_trades", "<i8"),
+        ("cvd", "<f8"),
+        ("vwap", "<f8"),
+        ("volume_imbalance", "<f8"),
+        ("trade_imbalance", "<f8"),
+    ]
+)
+
+SUM_FIELDS = ["buy_volume", "sell_volume", "buy_notional", "sell_notional", "buy_trades", "sell_trades"]
+
+
+def derive(features: np.ndarray, cvd_start: float = 0.0) -> np.ndarray:
+    # Fills the ratio columns and the running volume delta from the summed ones, in place.
+    volume = features["buy_volume"] + features["sell_volume"]
+    trades = features["buy_trades"] + features["sell_trades"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        features["vwap"] = (features["buy_notional"] + features["sell_notional"]) / volume
+        features["volume_imbalance"] = (features["buy_volume"] - features["sell_volume"]) / volume
+        features["trade_imbalance"] = (features["buy_trades"] - features["sell_trades"]) / trades
+    features["cvd"] = cvd_start + np.cumsum(features["buy_volume"] - features["sell_volume"])
+    return features
+
+
+def order_flow(trades: np.ndarray, window_ms: int, cvd_start: float = 0.0) -> np.ndarray:
+    # trades are TRADE_DTYPE sorted by trade_time, window_ms any window length.
+    # Sides follow the aggressor: a trade whose buyer was the maker was a market sell.
+    bucket = trades["trade_time"] - trades["trade_time"] % window_ms
+    starts = group_starts(bucket)
+    features = np.zeros(len(starts), dtype=ORDER_FLOW_DTYPE)
+    if not len(starts):
+        return features
+    quantity = trades["quantity"]
+    notional = trades["price"] * quantity
+    sell = (trades["flags"] & BUYER_MARKET_MAKER) != 0
+    features["open_time"] = bucket[starts]
+    features["sell_volume"] = np.add.reduceat(np.where(sell, quantity, 0), starts)
+    features["buy_volume"] = np.add.reduceat(quantity, starts) - features["sell_volume"]
+    features["sell_notional"] = np.add.reduceat(np.where(sell, notional, 0), starts)
+    features["buy_notional"] = np.add.reduceat(notional, starts) - features["sell_notional"]
+    features["sell_trades"] = np.add.reduceat(sell.astype(np.int64), starts)
+    features["buy_trades"] = np.diff(np.append(starts, len(trades))) - features["sell_trades"]
+    return derive(features, cvd_start)
+
+
+def order_flow_signals(feature) -> dict:
+    # One ORDER_FLOW_DTYPE record as extra keys for a strategy's indicator dict.
+    return {
+        "cvd": float(feature["cvd"]),
+        "vwap": float(feature["vwap"]),
+        "volume_imbalance": float(feature["volume_imbalance"]),
+        "trade_imbalance": float(feature["trade_imbalance"]),
+    }
+
+
+class OrderFlowAccumulator:
+    # Live counterpart of order_flow: takes trades in batches, keeps the open window,
+    # and returns windows as they close. Work is vectorized per batch, not per trade.
+    def __init__(self, window_ms: int, cvd_start: float = 0.0):
+        self.window_ms = window_ms
+        self.cvd = cvd_start
+        self.window = None
+
+    def extend(self, trades: np.ndarray) -> np.ndarray:
+        if not len(trades):
+            return np.empty(0, dtype=ORDER_FLOW_DTYPE)
+        features = order_flow(trades, self.window_ms)
+        if self.window is not None:
+            if features["open_time"][0] == self.window["open_time"][0]:
+                for name in SUM_FIELDS:
+                    features[name][0] += self.window[name][0]
+            else:
+                features = np.concatenate((self.window, features))
+        derive(features, self.cvd)
+        self.window = features[-1:].copy()
+        closed = features[:-1]
+        if len(closed):
+            self.cvd = float(closed["cvd"][-1])
+        return closed
+
+    def current(self):
+        # The open window, or None before the first trade.
+        return None if self.window is None else self.window[0]
+
+    def signals(self) -> dict:
+        if self.window is None:
+            return {}
+        return order_flow_signals(self.window[0])
@@ -0,0 +1,203 @@
+import numpy as np
+
+from db_app.kline_cache import KLINE_DTYPE, from_epoch_ms
+from db_app.record_buffers import BUYER_MARKET_MAKER
+from utils.intervals import INTERVAL_MS
+
+SUM_FIELDS = ["volume", "quote_asset_volume", "buy_base_asset_volume", "buy_quote_asset_volume", "number_of_trades"]
+
+# Positions in a candle tuple, which follows KLINE_DTYPE field order.
+OPEN_TIME, CLOSE_TIME, OPEN, HIGH, LOW, CLOSE = range(6)
+FIRST_SUM = 6
+
+
+def group_starts(bucket: np.ndarray) -> np.ndarray:
+    # bucket is sorted, so every group is one contiguous run.
+    if not len(bucket):
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(([0], np.flatnonzero(bucket[1:] != bucket[:-1]) + 1))
+
+
+def resample_klines(records: np.ndarray, interval_ms: int) -> np.ndarray:
+    # records are KLINE_DTYPE sorted by open_time at any finer interval that divides interval_ms.
+    bucket = records["open_time"] - records["open_time"] % interval_ms
+    starts = group_starts(bucket)
+    ends = np.append(starts[1:], len(records)) - 1
+    candles = np.empty(len(starts), dtype=KLINE_DTYPE)
+    if not len(starts):
+        return candles
+    candles["open_time"] = bucket[starts]
+    candles["close_time"] = bucket[starts] + interval_ms - 1
+    candles["open_price"] = records["open_price"][starts]
+    candles["close_price"] = records["close_price"][ends]
+    candles["high_price"] = np.maximum.reduceat(records["high_price"], starts)
+    candles["low_price"] = np.minimum.reduceat(records["low_price"], starts)
+    for name in SUM_FIELDS:
+        candles[name] = np.add.reduceat(records[name], starts)
+    return candles
+
+
+def resample_trades(trades: np.ndarray, interval_ms: int) -> np.ndarray:
+    # trades are TRADE_DTYPE sorted by trade_time. The buyer is the taker when it is not the maker,
+    # and number_of_trades counts the individual trades inside each aggregated one, as Binance does.
+    bucket = trades["trade_time"] - trades["trade_time"] % interval_ms
+    starts = group_starts(bucket)
+    ends = np.append(starts[1:], len(trades)) - 1
+    candles = np.empty(len(starts), dtype=KLINE_DTYPE)
+    if not len(starts):
+        return candles
+    price = trades["price"]
+    quantity = trades["quantity"]
+    quote = price * quantity
+    taker_buy = (trades["flags"] & BUYER_MARKET_MAKER) == 0
+    candles["open_time"] = bucket[starts]
+    candles["close_time"] = bucket[starts] + interval_ms - 1
+    candles["open_price"] = price[starts]
+    candles["close_price"] = price[ends]
+    candles["high_price"] = np.maximum.reduceat(price, starts)
+    candles["low_price"] = np.minimum.reduceat(price, starts)
+    candles["volume"] = np.add.reduceat(quantity, starts)
+    candles["quote_asset_volume"] = np.add.reduceat(quote, starts)
+    candles["buy_base_asset_volume"] = np.add.reduceat(np.where(taker_buy, quantity, 0), starts)
+    candles["buy_quote_asset_volume"] = np.add.reduceat(np.where(taker_buy, quote, 0), starts)
+    candles["number_of_trades"] = np.add.reduceat(trades["last_trade_id"] - trades["first_trade_id"] + 1, starts)
+    return candles
+
+
+def resample_many(records: np.ndarray, intervals: list[str], trades: bool = False) -> dict[str, np.ndarray]:
+    # Finest interval first; each coarser one is built from the finest result that divides it,
+    # so a year of 1s klines is scanned once and 1d reads the much shorter 1h array.
+    built = {}
+    for name in sorted(intervals, key=INTERVAL_MS.get):
+        interval_ms = INTERVAL_MS[name]
+        source = None
+        for finer in reversed(list(built)):
+            if interval_ms % INTERVAL_MS[finer] == 0:
+                source = built[finer]
+                break
+        if source is not None:
+            built[name] = resample_klines(source, interval_ms)
+        elif trades:
+            built[name] = resample_trades(records, interval_ms)
+        else:
+            built[name] = resample_klines(records, interval_ms)
+    return built
+
+
+def merge_candles(first: tuple, second: tuple) -> tuple:
+    return (
+        first[OPEN_TIME],
+        second[CLOSE_TIME],
+        first[OPEN],
+        max(first[HIGH], second[HIGH]),
+        min(first[LOW], second[LOW]),
+        second[CLOSE],
+        *(a + b for a, b in zip(first[FIRST_SUM:], second[FIRST_SUM:])),
+    )
+
+
+def candle_row(candle: tuple) -> list:
+    # [open_time, open, high, low, close], the row shape IncrementalMACD and SocketConn work with.
+    return [from_epoch_ms(candle[OPEN_TIME]), candle[OPEN], candle[HIGH], candle[LOW], candle[CLOSE]]
+
+
+def candle_dict(candle: tuple | None) -> dict:
+    # The fields the notifications show, keyed like KlineData.
+    if candle is None:
+        return {}
+    return {
+        "open_time": from_epoch_ms(candle[OPEN_TIME]),
+        "open_price": candle[OPEN],
+        "close_price": candle[CLOSE],
+        "high_price": candle[HIGH],
+        "low_price": candle[LOW],
+    }
+
+
+class BarAggregator:
+    # Builds candles for several intervals at once, one source bar or trade at a time.
+    # A source bar repeating the open_time of the previous one revises it instead of adding to it,
+    # so unclosed Binance stream klines can be fed as they arrive.
+    def __init__(self, intervals: list[str]):
+        self.intervals = {name: INTERVAL_MS[name] for name in intervals}
+        self.buckets = dict.fromkeys(self.intervals)
+        self.settled = dict.fromkeys(self.intervals)
+        self.pending = dict.fromkeys(self.intervals)
+        self.pending_times = dict.fromkeys(self.intervals)
+
+    def settle(self, interval: str) -> None:
+        # Folds the last revisable bar into the candle once a later bar shows it is final.
+        pending = self.pending[interval]
+        if pending is not None:
+            settled = self.settled[interval]
+            self.settled[interval] = pending if settled is None else merge_candles(settled, pending)
+            self.pending[interval] = None
+
+    def current(self, interval: str) -> tuple | None:
+        # The candle being built for interval, including the latest revision, as a KLINE_DTYPE tuple.
+        settled = self.settled[interval]
+        pending = self.pending[interval]
+        if settled is None:
+            return pending
+        if pending is None:
+            return settled
+        return merge_candles(settled, pending)
+
+    def update(
+            self,
+            open_time: int,
+            open_price: float,
+            high_price: float,
+            low_price: float,
+            close_price: float,
+            volume: float = 0.0,
+            quote_asset_volume: float = 0.0,
+            buy_base_asset_volume: float = 0.0,
+            buy_quote_asset_volume: float = 0.0,
+            number_of_trades: int = 0,
+            revisable: bool = True,
+    ) -> list[tuple[str, tuple]]:
+        # open_time is epoch ms. Returns (interval, candle) for every candle this bar closed.
+        closed = []
+        for name, interval_ms in self.intervals.items():
+            bucket = open_time - open_time % interval_ms
+            if bucket != self.buckets[name]:
+                if self.buckets[name] is not None:
+                    closed.append((name, self.current(name)))
+                self.buckets[name] = bucket
+                self.settled[name] = None
+                self.pending[name] = None
+
+            bar = (
+                bucket, bucket + interval_ms - 1, open_price, high_price, low_price, close_price,
+                volume, quote_asset_volume, buy_base_asset_volume, buy_quote_asset_volume, number_of_trades,
+            )
+            if self.pending[name] is not None and self.pending_times[name] == open_time:
+                self.pending[name] = bar
+                continue
+            self.settle(name)
+            if revisable:
+                self.pending[name] = bar
+                self.pending_times[name] = open_time
+            else:
+                self.settled[name] = bar if self.settled[name] is None else merge_candles(self.settled[name], bar)
+        return closed
+
+    def update_kline(self, kline: list) -> list[tuple[str, tuple]]:
+        # kline is an [open_time, open, high, low, close] row with a datetime open_time.
+        return self.update(int(kline[0].timestamp() * 1000), *kline[1:5])
+
+    def add_trade(
+            self,
+            trade_time: int,
+            price: float,
+            quantity: float,
+            buyer_market_maker: bool,
+            trades: int = 1,
+    ) -> list[tuple[str, tuple]]:
+        taker_buy = 0.0 if buyer_market_maker else quantity
+        return self.update(
+            trade_time, price, price, price, price,
+            quantity, price * quantity, taker_buy, taker_buy * price, trades,
+            revisable=False,
+        )
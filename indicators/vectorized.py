@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def ewm_mean(values: np.ndarray, span: int) -> np.ndarray:
+    return pd.Series(values).ewm(span=span, adjust=False).mean().to_numpy()
+
+
+def rolling_extreme(values: np.ndarray, window: int, is_max: bool = True) -> np.ndarray:
+    # result[i] is the extreme of values[i - window:i], i.e. of the ``window``
+    # values *before* i, NaN while there are not enough of them.
+    result = np.full(len(values) + 1, np.nan)
+    if window == 0:
+        return result
+    if len(values) < window:
+        return result
+    windows = sliding_window_view(values, window)
+    result[window:] = windows.max(axis=1) if is_max else windows.min(axis=1)
+    return result
+
+
+def rolling_sum_before(values: np.ndarray, window: int) -> np.ndarray:
+    # Sum of the ``window`` values before each position, same layout as rolling_extreme.
+    result = np.full(len(values) + 1, np.nan)
+    if window == 0:
+        result[:] = 0.0
+        return result
+    if len(values) < window:
+        return result
+    result[window:] = sliding_window_view(values, window).sum(axis=1)
+    return result
+
+
+def stochastic_k(close: np.ndarray, n_high: np.ndarray, n_low: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (close - n_low) * 100 / (n_high - n_low)
+
+
+def compute_macd(
+        high: np.ndarray,
+        low: np.ndarray,
+        close: np.ndarray,
+        short_period: int = 12,
+        long_period: int = 26,
+        k_period: int = 12,
+        d_period: int = 3,
+        signal_period: int = 9,
+) -> dict[str, np.ndarray]:
+    ma_fast = ewm_mean(close, short_period)
+    ma_slow = ewm_mean(close, long_period)
+    macd = ma_fast - ma_slow
+    signal = ewm_mean(macd, signal_period)
+    n_high = pd.Series(high).rolling(k_period).max().to_numpy()
+    n_low = pd.Series(low).rolling(k_period).min().to_numpy()
+    stoch_k = stochastic_k(close, n_high, n_low)
+    stoch_d = pd.Series(stoch_k).rolling(d_period).mean().to_numpy()
+    return {
+        "ma_fast": ma_fast,
+        "ma_slow": ma_slow,
+        "macD": macd,
+        "signal": signal,
+        "n_high": n_high,
+        "n_low": n_low,
+        "%K": stoch_k,
+        "%D": stoch_d,
+    }
+
+
+def compute_provisional_macd(
+        committed_high: np.ndarray,
+        committed_low: np.ndarray,
+        committed_close: np.ndarray,
+        history_length: np.ndarray,
+        high: np.ndarray,
+        low: np.ndarray,
+        close: np.ndarray,
+        short_period: int = 12,
+        long_period: int = 26,
+        k_period: int = 12,
+        d_period: int = 3,
+        signal_period: int = 9,
+) -> dict[str, np.ndarray]:
+    # Vectorised IncrementalMACD.peek: every provisional candle j is evaluated on top of
+    # the first history_length[j] committed candles.
+    committed = compute_macd(
+        committed_high,
+        committed_low,
+        committed_close,
+        short_period=short_period,
+        long_period=long_period,
+        k_period=k_period,
+        d_period=d_period,
+        signal_period=signal_period,
+    )
+    previous = history_length - 1
+    has_history = history_length > 0
+    safe_previous = np.where(has_history, previous, 0)
+
+    def step(state: np.ndarray, value: np.ndarray, span: int) -> np.ndarray:
+        if not len(state):
+            return value.copy()
+        alpha = 2 / (span + 1)
+        last = state[safe_previous]
+        return np.where(has_history, last + alpha * (value - last), value)
+
+    ma_fast = step(committed["ma_fast"], close, short_period)
+    ma_slow = step(committed["ma_slow"], close, long_period)
+    macd = ma_fast - ma_slow
+    signal = step(committed["signal"], macd, signal_period)
+
+    n_high = np.fmax(rolling_extreme(committed_high, k_period - 1, is_max=True)[history_length], high)
+    n_low = np.fmin(rolling_extreme(committed_low, k_period - 1, is_max=False)[history_length], low)
+    not_enough = history_length < k_period - 1
+    n_high[not_enough] = np.nan
+    n_low[not_enough] = np.nan
+    stoch_k = stochastic_k(close, n_high, n_low)
+    stoch_d = (rolling_sum_before(committed["%K"], d_period - 1)[history_length] + stoch_k) / d_period
+
+    return {
+        "ma_fast": ma_fast,
+        "ma_slow": ma_slow,
+        "macD": macd,
+        "signal": signal,
+        "n_high": n_high,
+        "n_low": n_low,
+        "%K": stoch_k,
+        "%D": stoch_d,
+    }
+
+
+def round_like_format(values: np.ndarray, decimals: int = 2) -> np.ndarray:
+    # np.round agrees with float(format(x, ".2f")) everywhere except at exact
+    # ties, so only those are re-rounded through format().
+    rounded = np.round(values, decimals)
+    scaled = values * 10 ** decimals
+    with np.errstate(invalid="ignore"):
+        near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for index in np.flatnonzero(near_tie):
+        rounded[index] = float(format(values[index], f".{decimals}f"))
+    return rounded
@@ -0,0 +1,179 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import itertools
+import logging
+from multiprocessing import shared_memory
+import os
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+from backtest import load_kline_arrays, prepare_backtest, run_backtest
+from db_app.database import database
+from db_app.kline_cache import KlineCache
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+file_handler = logging.FileHandler('optimizer.log')
+file_handler.setLevel(logging.INFO)
+
+file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(file_formatter)
+
+logger.addHandler(file_handler)
+
+# macd_decrease_target and price_target are not swept: own_socket.SocketConn
+# stores them but none of the buy/sell decisions read them.
+DEFAULT_GRID = {
+    "macd_increase_target": [0.25, 0.5, 0.75, 1.0, 1.25, 1.5],
+    "take_profit": [1.005, 1.01, 1.015, 1.02, 1.03],
+    "stoch_confirm_diff": [0.0, 0.5, 1.0, 2.0],
+    "stoch_increase_diff": [3.5],
+    "search_for_trend": ["decrease"],
+}
+
+DEFAULT_RANDOM_SPACE = {
+    "macd_increase_target": (0.1, 2.0),
+    "take_profit": (1.003, 1.04),
+    "stoch_confirm_diff": (0.0, 5.0),
+    "stoch_increase_diff": (0.5, 10.0),
+    "search_for_trend": ["decrease", "increase"],
+}
+
+_worker_series = None
+_worker_memory = None
+
+
+def grid_parameter_sets(grid: dict[str, list]) -> list[dict]:
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def random_parameter_sets(space: dict, samples: int, seed: int | None = None) -> list[dict]:
+    generator = random.Random(seed)
+    parameter_sets = []
+    for _ in range(samples):
+        parameters = {}
+        for name, bounds in space.items():
+            if isinstance(bounds, tuple):
+                parameters[name] = generator.uniform(*bounds)
+            else:
+                parameters[name] = generator.choice(bounds)
+        parameter_sets.append(parameters)
+    return parameter_sets
+
+
+def share_series(series: dict[str, np.ndarray]) -> tuple[list, dict]:
+    blocks = []
+    layout = {}
+    for name, array in series.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[:] = array
+        blocks.append(block)
+        layout[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, layout
+
+
+def attach_series(layout: dict) -> tuple[list, dict[str, np.ndarray]]:
+    blocks = []
+    series = {}
+    for name, (block_name, shape, dtype) in layout.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        blocks.append(block)
+        series[name] = array
+    return blocks, series
+
+
+def init_worker(layout: dict) -> None:
+    global _worker_series, _worker_memory
+    _worker_memory, _worker_series = attach_series(layout)
+
+
+def evaluate_parameters(task: tuple[dict, float]) -> dict:
+    parameters, budget = task
+    result = run_backtest(_worker_series, budget=budget, **parameters)
+    return {
+        **parameters,
+        "final_budget": result["budget"],
+        "profit": result["budget"] - budget,
+        "profit_percent": (result["budget"] - budget) * 100 / budget,
+        "trades": len(result["trades"]),
+        "max_drawdown": result["max_drawdown"],
+    }
+
+
+def run_sweep(
+        series: dict[str, np.ndarray],
+        parameter_sets: list[dict],
+        budget: float = 700,
+        workers: int | None = None,
+) -> pd.DataFrame:
+    workers = workers or os.cpu_count()
+    blocks, layout = share_series(series)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(layout,)) as executor:
+            chunksize = max(1, len(parameter_sets) // (workers * 4))
+            results = list(
+                executor.map(
+                    evaluate_parameters,
+                    [(parameters, budget) for parameters in parameter_sets],
+                    chunksize=chunksize,
+                )
+            )
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return (
+        pd.DataFrame(results)
+        .sort_values(["profit", "max_drawdown"], ascending=[False, True])
+        .reset_index(drop=True)
+    )
+
+
+async def main(
+        start_stream: datetime,
+        stream_interval: str = "1m",
+        mode: str = "grid",
+        samples: int = 500,
+        output_path: str = "optimizer_results.csv",
+):
+    cache = KlineCache()
+    now = datetime.now(timezone.utc)
+    async with database:
+        hour_klines = await load_kline_arrays(
+            cache, "ETHUSDT", "1h", datetime(2023, 6, 1, tzinfo=timezone.utc), now,
+        )
+        stream_klines = await load_kline_arrays(cache, "ETHUSDT", stream_interval, start_stream, now)
+
+    series = prepare_backtest(hour_klines, stream_klines, start_stream)
+    del hour_klines, stream_klines
+
+    if mode == "grid":
+        parameter_sets = grid_parameter_sets(DEFAULT_GRID)
+    else:
+        parameter_sets = random_parameter_sets(DEFAULT_RANDOM_SPACE, samples)
+    logger.info(f"Running {len(parameter_sets)} parameter sets over {len(series['close'])} klines")
+
+    started = time.perf_counter()
+    results = run_sweep(series, parameter_sets)
+    logger.info(f"Sweep done in {time.perf_counter() - started:.2f} sec")
+
+    results.to_csv(output_path, index=False)
+    logger.info(f"Top results:\n{results.head(20)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(
+        start_stream=datetime(
+            2024, 1, 1, hour=0, tzinfo=timezone.utc,
+        )
+    ))
@@ -2,12 +2,12 @@ import asyncio
 from datetime import datetime, timezone, timedelta
 import logging
 
-import tortoise
 
-from db_app.config import db_config
-from db_app.models import KlineData
-from indicators.MACD import search_macd
-from signal_notificator_bot import send_message_to_user
+from db_app.database import database
+from db_app.kline_cache import KlineCache, from_epoch_ms, kline_rows
+from indicators.incremental import IncrementalMACD
+from indicators.resample import CLOSE, HIGH, LOW, OPEN, OPEN_TIME, BarAggregator, candle_row
+from signal_notificator_bot import outbox
 
 BASE_API_URL = "https://api.binance.com/api/v3/"
 
@@ -34,15 +34,23 @@ class SocketConn:
             last_hour: datetime,
             budget: int = 800,
             search_for_trend: str = "decrease",
+            take_profit: float = 1.015,
+            stoch_increase_diff: float = 3.5,
+            stoch_confirm_diff: float = 0.5,
+            notify=outbox.notify,
     ):
+        self.notify = notify
         self.max_macd = None
         self.bought_crypto_amount = None
         self.bought_crypto_price = None
         self.need_to_sell_for_price = None
         self.started = True
-        self.kline_data = kline_data
+        self.indicators = IncrementalMACD.from_klines(kline_data)
         self.macd_increase_target = macd_increase_target
         self.macd_decrease_target = macd_decrease_target
+        self.take_profit = take_profit
+        self.stoch_increase_diff = stoch_increase_diff
+        self.stoch_confirm_diff = stoch_confirm_diff
         self.current_monitor_signal = self.monitor_increase_macd
         self.count_for_report = 0
         self.symbol = "ETHUSDT"
@@ -50,13 +58,7 @@ class SocketConn:
         self.last_hour = last_hour
         self.last_report_minute = datetime.utcnow().replace(tzinfo=timezone.utc)
         self.search_for_trend = search_for_trend
-        self.last_kline = {
-            "open_time": None,
-            "open_price": None,
-            "close_price": None,
-            "high_price": None,
-            "low_price": None,
-        }
+        self.bars = BarAggregator([self.interval])
         self.new_kline_data = new_kline_data
         self.budget = budget
         self.profit = price_target
@@ -76,8 +78,7 @@ class SocketConn:
             if self.start_budget_for_current_day is None:
                 self.start_budget_for_current_day = self.budget
 
-            self.kline_data.append(new_kline)
-            res = search_macd(self.kline_data)
+            res = self.indicators.peek(new_kline)
             logger.info(
                 (
                     f"Current MACD: {float(format(res['macD'], '.2f'))}, "
@@ -87,65 +88,45 @@ class SocketConn:
                 )
             )
             await self.current_monitor_signal(res)
-            self.kline_data.pop(-1)
 
             if self.started:
                 await self.on_open(res)
                 self.started = False
 
-            if self.last_kline["open_price"] is None:
-                self.last_kline["open_price"] = new_kline[1]
-                self.last_kline["open_time"] = new_kline[0]
             if (
                     datetime.utcnow().replace(tzinfo=timezone.utc) - self.last_report_minute
             ) >= timedelta(minutes=3):
                 await self.just_monitor(res)
                 self.last_report_minute = datetime.utcnow().replace(tzinfo=timezone.utc)
 
-            await self.generate_last_kline(new_kline)
-
-            if self.last_hour.hour != new_kline[0].hour:
-                lastKline = await KlineData.get(open_time=self.last_kline['open_time'], interval="1h", symbmol=self.symbol)
-                self.kline_data.append(
-                    [
-                        lastKline.open_time,
-                        lastKline.open_price,
-                        lastKline.high_price,
-                        lastKline.low_price,
-                        lastKline.close_price,
-                    ]
-                )
-                res = search_macd(self.kline_data)
-                new_kline[0].replace(tzinfo=None)
-                await send_message_to_user(
+            closed = self.bars.update_kline(new_kline)
+
+            for _, candle in closed:
+                # Built from the ticks themselves, so the hour close needs no DB round-trip.
+                res = self.indicators.commit(candle_row(candle))
+                closed_at = from_epoch_ms(candle[OPEN_TIME])
+                await self.notify(
                     message_text=(
                         f"🆕 Adding last hour kline for period 🆕\n"
                         f"<em>{self.last_hour.date()}</em>, {self.last_hour.hour}:00 "
                         f"to {self.last_hour.hour}:59\n"
                         f"\n"
                         f"<b>Kline added:</b> \n"
-                        f"Open time: {lastKline.open_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
-                        f"Open price: {lastKline.open_price}\n"
-                        f"High price: {lastKline.high_price}\n"
-                        f"Low price: {lastKline.low_price}\n"
-                        f"Close price: {lastKline.close_price}\n"
+                        f"Open time: {closed_at.strftime('%Y-%m-%d %H:%M:%S')}\n"
+                        f"Open price: {candle[OPEN]}\n"
+                        f"High price: {candle[HIGH]}\n"
+                        f"Low price: {candle[LOW]}\n"
+                        f"Close price: {candle[CLOSE]}\n"
                         f"Stochastic %K: {float(format(res['%K'], '.2f'))}\n"
                         f"Stochastic %D: {float(format(res['%D'], '.2f'))}\n"
                         f"MACD: {float(format(res['macD'], '.2f'))}\n"
                         f"Signal: {float(format(res['signal'], '.2f'))}\n"
                     ),
                 )
-                self.last_hour = self.last_kline["open_time"] + timedelta(hours=1)
-
-                self.last_kline = {
-                    "open_price": None,
-                    "close_price": None,
-                    "high_price": None,
-                    "low_price": None
-                }
+                self.last_hour = closed_at + timedelta(hours=1)
 
     async def on_open(self, kline):
-        await send_message_to_user(
+        await self.notify(
             (
                 f"👀 <b>Connection established, starting monitor</b> 👀\n"
                 f"<b>Looking for</b> {self.search_for_trend} trend\n"
@@ -158,19 +139,11 @@ class SocketConn:
             )
         )
 
-    async def generate_last_kline(self, kline):
-        self.last_kline["close_price"] = kline[4]
-        if self.last_kline["high_price"] is None or self.last_kline["high_price"] < kline[2]:
-            self.last_kline["high_price"] = kline[2]
-        if self.last_kline["low_price"] is None or self.last_kline["low_price"] > kline[3]:
-            self.last_kline["low_price"] = kline[3]
-
-    @staticmethod
-    async def just_monitor(last_macd_result):
-        await send_message_to_user(
+    async def just_monitor(self, last_macd_result):
+        await self.notify(
             (
                 f"⏳ Current situation: ⏳\n"
-                f"Current time: {last_macd_result[0].strftime('%Y-%m-%d %H:%M:%S')}\n"
+                f"Current time: {last_macd_result['open_time'].strftime('%Y-%m-%d %H:%M:%S')}\n"
                 f"<ins>Current price</ins>: <b>{float(format(last_macd_result['close'], '.2f'))}</b>\n"
                 f"<ins>Current stochastic %K</ins>: <b>{float(format(last_macd_result['%K'], '.2f'))}</b>\n"
                 f"<ins>Current stochastic %D</ins>: <b>{float(format(last_macd_result['%D'], '.2f'))}</b>\n"
@@ -183,11 +156,11 @@ class SocketConn:
         stoch_k_value = float(format(last_macd_result["%K"], '.2f'))
         stock_d_value = float(format(last_macd_result["%D"], '.2f'))
         diff = stoch_k_value - stock_d_value
-        if diff >= 3.5:
-            await send_message_to_user(
+        if diff >= self.stoch_increase_diff:
+            await self.notify(
                 (
                     f"⚡️ <b>Stochastic increase</b> ⚡️\n"
-                    f"Current time: {last_macd_result[0].strftime('%Y-%m-%d %H:%M')}\n"
+                    f"Current time: {last_macd_result['open_time'].strftime('%Y-%m-%d %H:%M')}\n"
                     f"Current stochastic %K: {stoch_k_value}\n"
                     f"Current stochastic %D: {stock_d_value}\n"
                     f"Current price: {last_macd_result['close']}\n"
@@ -200,7 +173,7 @@ class SocketConn:
         stock_d_value = float(format(last_macd_result["%D"], '.2f'))
 
         if stock_d_value <= 25 and stoch_k_value <= 25:
-            await send_message_to_user(
+            await self.notify(
                 (
                     f"❌ <b>Stochastic decrease</b> ❌\n"
                     f"Current time: {last_macd_result['open_time'].strftime('%Y-%m-%d %H:%M')}\n"
@@ -218,11 +191,11 @@ class SocketConn:
         stock_d_value = float(format(last_macd_result["%D"], '.2f'))
         diff = macd_value - signal_value
         stoch_diff = stoch_k_value - stock_d_value
-        if diff >= self.macd_increase_target and stoch_diff >= 0.5:
-            await send_message_to_user(
+        if diff >= self.macd_increase_target and stoch_diff >= self.stoch_confirm_diff:
+            await self.notify(
                 (
                     f"⚠️ <b>SIGNAL</b> ⚠️\n"
-                    f"Current time: {last_macd_result[0].strftime('%Y-%m-%d %H:%M')}\n"
+                    f"Current time: {last_macd_result['open_time'].strftime('%Y-%m-%d %H:%M')}\n"
                     f"Current MACD: {macd_value}\n"
                     f"Current MACD signal: {signal_value}\n"
                     f"Current stochastic %K: {stoch_k_value}\n"
@@ -243,11 +216,11 @@ class SocketConn:
         if macd_value > self.max_macd:
             self.max_macd = macd_value
 
-        if (last_macd_result["close"] - self.bought_crypto_price) >= (self.bought_crypto_price * 1.015) - self.bought_crypto_price:
-            await send_message_to_user(
+        if (last_macd_result["close"] - self.bought_crypto_price) >= (self.bought_crypto_price * self.take_profit) - self.bought_crypto_price:
+            await self.notify(
                 (
                     f"🤑 <b>Profit</b> 🤑\n"
-                    f"Profit time: {last_macd_result[0].strftime('%Y-%m-%d %H:%M')}\n"
+                    f"Profit time: {last_macd_result['open_time'].strftime('%Y-%m-%d %H:%M')}\n"
                     f"Current price: {last_macd_result['close']}\n"
                     f"Current profit: {last_macd_result['close'] - self.bought_crypto_price}\n"
                     f"Current budget: {self.budget}\n"
@@ -255,12 +228,12 @@ class SocketConn:
                 )
             )
             self.current_monitor_signal = self.sell_crypto
-        if self.bought_time.hour != last_macd_result.iloc[0].hour:
+        if self.bought_time.hour != last_macd_result['open_time'].hour:
             if macd_value < signal_value:
-                await send_message_to_user(
+                await self.notify(
                     (
                         f"🤑 <b>MACD decrease for sell</b> 🤑\n"
-                        f"Decrease time: {last_macd_result[0].strftime('%Y-%m-%d %H:%M')}\n"
+                        f"Decrease time: {last_macd_result['open_time'].strftime('%Y-%m-%d %H:%M')}\n"
                         f"Current MACD: {macd_value}\n"
                         f"Current MACD signal: {signal_value}\n"
                         f"Current price: {last_macd_result['close']}\n"
@@ -272,16 +245,16 @@ class SocketConn:
         macd_value = float(format(last_macd_result["macD"], '.2f'))
         signal_value = float(format(last_macd_result["signal"], '.2f'))
 
-        if self.bought_time.hour != last_macd_result.iloc[0].hour:
+        if self.bought_time.hour != last_macd_result['open_time'].hour:
             if macd_value < signal_value:
-                await send_message_to_user(
+                await self.notify(
                     (
                         f"❌ <b>MACD decrease</b> ❌\n"
-                        f"Decrease time: {last_macd_result[0].strftime('%Y-%m-%d %H:%M')}\n"
+                        f"Decrease time: {last_macd_result['open_time'].strftime('%Y-%m-%d %H:%M')}\n"
                         f"Current MACD: {macd_value}\n"
                         f"Current MACD signal: {signal_value}\n"
                         f"Current price: {last_macd_result['close']}\n"
-                        f"{self.bought_time.hour != last_macd_result.iloc[0].hour}"
+                        f"{self.bought_time.hour != last_macd_result['open_time'].hour}"
                     )
                 )
                 self.current_monitor_signal = self.monitor_increase_macd
@@ -290,20 +263,20 @@ class SocketConn:
         self.bought_crypto_price = last_macd_result["close"] + 0.10
         self.bought_crypto_amount = self.budget / self.bought_crypto_price
         self.need_to_sell_for_price = last_macd_result["close"] + self.profit + 0.07
-        self.bought_time = last_macd_result[0]
+        self.bought_time = last_macd_result['open_time']
         self.sold_last_buy = False
         self.buy_trades += 1
 
         self.current_monitor_signal = self.monitor_sell
 
-        await send_message_to_user(
+        await self.notify(
             (
                 f"🔥 <b>Buy</b> 🔥\n"
-                f"Buy time: {last_macd_result[0].strftime('%Y-%m-%d %H:%M')}\n"
+                f"Buy time: {last_macd_result['open_time'].strftime('%Y-%m-%d %H:%M')}\n"
                 f"Bought for price: {self.bought_crypto_price}\n"
                 f"Bought crypto amount: {self.bought_crypto_amount}\n"
                 f"\n"
-                f"Sell target: {self.bought_crypto_price * 1.015}\n"
+                f"Sell target: {self.bought_crypto_price * self.take_profit}\n"
             )
         )
 
@@ -311,10 +284,10 @@ class SocketConn:
         clean_profit = ((self.bought_crypto_amount * last_macd_result["close"]) - self.budget) - 0.38
         self.budget += clean_profit
         self.porfit_for_current_day += clean_profit
-        await send_message_to_user(
+        await self.notify(
             (
                 f"🔥 <b>Sold</b> 🔥\n"
-                f"Sell time: {last_macd_result[0].strftime('%Y-%m-%d %H:%M')}\n"
+                f"Sell time: {last_macd_result['open_time'].strftime('%Y-%m-%d %H:%M')}\n"
                 f"Sold for price: {last_macd_result['close']}\n"
                 f"\n"
                 f"Current budget: {self.budget}"
@@ -329,10 +302,10 @@ class SocketConn:
     async def urgent_sell_crypto(self, last_macd_result):
         clean_profit = ((self.bought_crypto_amount * last_macd_result["close"]) - self.budget) - 0.38
         self.budget += clean_profit
-        await send_message_to_user(
+        await self.notify(
             (
                 f"😖 <b>Sold</b> 😖\n"
-                f"Sell time: {last_macd_result[0].strftime('%Y-%m-%d %H:%M')}\n"
+                f"Sell time: {last_macd_result['open_time'].strftime('%Y-%m-%d %H:%M')}\n"
                 f"Sold for price: {last_macd_result['close']}\n"
                 f"\n"
                 f"Current budget: {self.budget}"
@@ -342,7 +315,7 @@ class SocketConn:
         self.urgent_trades += 1
 
     async def generate_day_report(self):
-        await send_message_to_user(
+        await self.notify(
             (
                 f"📊 <b>Day report</b> 📊\n"
                 f"Day {self.last_hour.date()} start budget: {self.start_budget_for_current_day}\n"
@@ -361,54 +334,20 @@ class SocketConn:
         self.start_budget_for_current_day = self.budget
 
 
-async def main(start_stream: datetime):
-    await tortoise.Tortoise.init(db_config)
-    open_time = datetime(2023, 6, 1, tzinfo=timezone.utc)
-    to_analyze_klines = await (
-        KlineData
-        .filter(
-            open_time__gte=open_time,
-            close_time__lte=start_stream - timedelta(microseconds=1),
-            symbmol="ETHUSDT",
-            interval="1h",
-        )
-        .order_by("open_time")
-    )
-    logger.info(f"{len(to_analyze_klines)} klines to analyze")
-
-    kline_data_for_analyze = []
-    for kline in to_analyze_klines:
-        kline_data_for_analyze.append(
-            [
-                kline.open_time,
-                kline.open_price,
-                kline.high_price,
-                kline.low_price,
-                kline.close_price,
-            ]
-        )
+async def main(start_stream: datetime, stream_interval: str = "1m"):
+    async with database:
+        cache = KlineCache()
+        columns = ["open_time", "open_price", "high_price", "low_price", "close_price"]
+        open_time = datetime(2023, 6, 1, tzinfo=timezone.utc)
+        to_analyze_klines = await cache.load_or_fill("ETHUSDT", "1h", open_time, start_stream, columns=columns)
+        logger.info(f"{len(to_analyze_klines['open_time'])} klines to analyze")
+        kline_data_for_analyze = kline_rows(to_analyze_klines)
 
-    stream_klines = await (
-        KlineData
-        .filter(
-            open_time__gte=start_stream,
-            symbmol="ETHUSDT",
-        )
-        .order_by("open_time")
-    )
-    logger.info(f"{len(stream_klines)} klines in stream")
-
-    new_stream_klines = []
-    for kline in stream_klines:
-        new_stream_klines.append(
-            [
-                kline.open_time,
-                kline.open_price,
-                kline.high_price,
-                kline.low_price,
-                kline.close_price,
-            ]
+        stream_klines = await cache.load_or_fill(
+            "ETHUSDT", stream_interval, start_stream, datetime.now(timezone.utc), columns=columns,
         )
+        logger.info(f"{len(stream_klines['open_time'])} klines in stream")
+        new_stream_klines = kline_rows(stream_klines)
 
     socket_conn = SocketConn(
         kline_data=kline_data_for_analyze,
@@ -421,7 +360,7 @@ async def main(start_stream: datetime):
     )
     await socket_conn()
     print(f"Last budget is: {socket_conn.budget}")
-    await tortoise.Tortoise.close_connections()
+    await outbox.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,312 @@
+import asyncio
+import json
+import logging
+import ssl
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from aiohttp import web
+
+from db_app.database import database
+from db_app.kline_cache import KlineCache, kline_rows
+from db_app.record_buffers import BEST_PRICE_MATCH, BUYER_MARKET_MAKER, TRADE_DTYPE
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+file_handler = logging.FileHandler('replay_server.log')
+file_handler.setLevel(logging.INFO)
+
+file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(file_formatter)
+
+logger.addHandler(file_handler)
+
+REPLAY_COLUMNS = [
+    "open_time",
+    "close_time",
+    "open_price",
+    "high_price",
+    "low_price",
+    "close_price",
+    "volume",
+    "quote_asset_volume",
+    "buy_base_asset_volume",
+    "buy_quote_asset_volume",
+    "number_of_trades",
+]
+
+
+def kline_frames(columns: dict[str, np.ndarray], symbol: str, interval: str) -> list[tuple[int, str]]:
+    # (event time ms, frame) pairs in the format of the <symbol>@kline_<interval> stream,
+    # one closed kline per frame, stamped with its close time.
+    frames = []
+    for (
+            open_time, close_time, open_price, high_price, low_price, close_price,
+            volume, quote_volume, buy_base_volume, buy_quote_volume, trades,
+    ) in zip(*(columns[name].tolist() for name in REPLAY_COLUMNS)):
+        frames.append(
+            (
+                close_time,
+                json.dumps(
+                    {
+                        "e": "kline", "E": close_time, "s": symbol,
+                        "k": {
+                            "t": open_time, "T": close_time, "s": symbol, "i": interval, "f": -1, "L": -1,
+                            "o": f"{open_price:.8f}", "c": f"{close_price:.8f}",
+                            "h": f"{high_price:.8f}", "l": f"{low_price:.8f}",
+                            "v": f"{volume:.8f}", "n": trades, "x": True, "q": f"{quote_volume:.8f}",
+                            "V": f"{buy_base_volume:.8f}", "Q": f"{buy_quote_volume:.8f}", "B": "0",
+                        },
+                    }
+                ),
+            )
+        )
+    return frames
+
+
+def agg_trade_frames(trades: np.ndarray, symbol: str) -> list[tuple[int, str]]:
+    # (trade time ms, frame) pairs in the format of the <symbol>@aggTrade stream.
+    frames = []
+    for trade_id, price, quantity, first_id, last_id, trade_time, flags in zip(
+            *(trades[name].tolist() for name in TRADE_DTYPE.names[:7])
+    ):
+        frames.append(
+            (
+                trade_time,
+                json.dumps(
+                    {
+                        "e": "aggTrade", "E": trade_time, "s": symbol, "a": trade_id,
+                        "p": f"{price:.8f}", "q": f"{quantity:.8f}", "f": first_id, "l": last_id,
+                        "T": trade_time, "m": bool(flags & BUYER_MARKET_MAKER), "M": bool(flags & BEST_PRICE_MATCH),
+                    }
+                ),
+            )
+        )
+    return frames
+
+
+def load_raw_frames(path: str) -> list[tuple[int, str]]:
+    # Captured stream frames, one per line as benchmarks/bench_decoders.py records them.
+    frames = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                frames.append((json.loads(line)["E"], line))
+    return frames
+
+
+def combined_frames(frames_by_stream: dict[str, list[tuple[int, str]]]) -> list[tuple[int, str]]:
+    # Interleaves per-stream frames by event time in the /stream?streams=... envelope.
+    frames = [
+        (event_time, f'{{"stream":"{name}","data":{frame}}}')
+        for name, stream_frames in frames_by_stream.items()
+        for event_time, frame in stream_frames
+    ]
+    frames.sort(key=lambda item: item[0])
+    return frames
+
+
+async def load_kline_frames(
+        symbol: str,
+        interval: str,
+        start: datetime,
+        end: datetime,
+        cache: KlineCache | None = None,
+) -> list[tuple[int, str]]:
+    columns = await (cache or KlineCache()).load_or_fill(symbol, interval, start, end, columns=REPLAY_COLUMNS)
+    return kline_frames(columns, symbol, interval)
+
+
+class ReplayServer:
+    # Serves recorded frames over a websocket as a local stand-in for the Binance stream.
+    # speed scales the recorded gaps between frames; speed=0 sends them as fast as possible.
+    # Every connection, on any path, gets its own replay from the first frame.
+    def __init__(
+            self,
+            frames: list[tuple[int, str]],
+            speed: float = 1.0,
+            host: str = "127.0.0.1",
+            port: int = 5555,
+            certfile: str | None = None,
+            keyfile: str | None = None,
+            stamp: bool = False,
+    ):
+        self.frames = frames
+        self.speed = speed
+        self.host = host
+        self.port = port
+        self.ssl_context = None
+        if certfile is not None:
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.stamp = stamp
+        self.runner = None
+        self.sent = 0
+
+    @property
+    def url(self) -> str:
+        scheme = "wss" if self.ssl_context is not None else "ws"
+        return f"{scheme}://{self.host}:{self.port}"
+
+    async def __aenter__(self) -> "ReplayServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        await self.stop()
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/{path:.*}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port, ssl_context=self.ssl_context).start()
+        logger.info(f"Replaying {len(self.frames)} frames at {self.url}, speed {self.speed or 'max'}")
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def stamped(self, frame: str) -> str:
+        # Send time goes in as an extra top-level key so the client can measure per-message latency.
+        return f'{frame[:-1]},"replay_sent_ns":{time.perf_counter_ns()}}}'
+
+    async def handle(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        logger.info(f"Client connected to {request.path}")
+
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        first_event_time = self.frames[0][0] if self.frames else 0
+        for event_time, frame in self.frames:
+            if ws.closed:
+                break
+            if self.speed:
+                delay = started_at + (event_time - first_event_time) / 1000 / self.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await ws.send_str(self.stamped(frame) if self.stamp else frame)
+            self.sent += 1
+
+        logger.info(f"Replay finished for {request.path}")
+        await ws.close()
+        return ws
+
+
+async def discard_message(*args, **kwargs) -> None:
+    pass
+
+
+async def load_test(
+        frames: list[tuple[int, str]],
+        kline_data: list[list],
+        speed: float = 0,
+        port: int = 5555,
+) -> dict:
+    # Runs SocketConn against a replay and reports its throughput and per-message latency.
+    from stream import SocketConn
+
+    latencies = []
+
+    def on_processed(data: str) -> None:
+        received_at = time.perf_counter_ns()
+        latencies.append(received_at - json.loads(data)["replay_sent_ns"])
+
+    async with ReplayServer(frames, speed=speed, port=port, stamp=True) as server:
+        socket_conn = SocketConn(server.url, kline_data, notify=discard_message, on_processed=on_processed)
+        started_at = time.perf_counter()
+        await socket_conn()
+        elapsed = time.perf_counter() - started_at
+
+    latencies_ms = np.asarray(latencies, dtype=np.float64) / 1e6
+    report = {
+        "messages": len(latencies),
+        "elapsed_s": elapsed,
+        "rate_per_s": len(latencies) / elapsed if elapsed else 0.0,
+    }
+    if len(latencies_ms):
+        report.update(
+            {
+                "p50_ms": float(np.percentile(latencies_ms, 50)),
+                "p95_ms": float(np.percentile(latencies_ms, 95)),
+                "p99_ms": float(np.percentile(latencies_ms, 99)),
+                "max_ms": float(latencies_ms.max()),
+            }
+        )
+    logger.info(f"Load test: {report}")
+    return report
+
+
+async def load_test_streams(
+        frames_by_stream: dict[str, list[tuple[int, str]]],
+        histories: dict[str, list[list]],
+        speed: float = 0,
+        port: int = 5555,
+) -> dict:
+    # Same as load_test for a StreamMultiplexer on one combined connection, reported per stream.
+    from stream import StreamMultiplexer
+
+    latencies = {name: [] for name in frames_by_stream}
+
+    def on_processed(name: str, data: str) -> None:
+        received_at = time.perf_counter_ns()
+        latencies[name].append(received_at - json.loads(data)["replay_sent_ns"])
+
+    async with ReplayServer(combined_frames(frames_by_stream), speed=speed, port=port, stamp=True) as server:
+        multiplexer = StreamMultiplexer(server.url, notify=discard_message, on_processed=on_processed)
+        for name in frames_by_stream:
+            symbol, interval = name.split("@kline_")
+            multiplexer.add(symbol.upper(), interval, histories[name])
+        started_at = time.perf_counter()
+        await multiplexer()
+        elapsed = time.perf_counter() - started_at
+
+    stats = multiplexer.stats()
+    for name, stream_latencies in latencies.items():
+        latencies_ms = np.asarray(stream_latencies, dtype=np.float64) / 1e6
+        if len(latencies_ms):
+            stats[name].update(
+                {
+                    "e2e_p50_ms": float(np.percentile(latencies_ms, 50)),
+                    "e2e_p99_ms": float(np.percentile(latencies_ms, 99)),
+                }
+            )
+    messages = sum(len(stream_latencies) for stream_latencies in latencies.values())
+    report = {
+        "streams": len(frames_by_stream),
+        "messages": messages,
+        "elapsed_s": elapsed,
+        "rate_per_s": messages / elapsed if elapsed else 0.0,
+        "per_stream": stats,
+    }
+    logger.info(f"Load test over {len(frames_by_stream)} streams: {messages} messages, {report['rate_per_s']:.0f}/s")
+    return report
+
+
+async def main():
+    async with database:
+        cache = KlineCache()
+        history = await cache.load_or_fill(
+            "ETHUSDT",
+            "1h",
+            datetime(2023, 12, 1, tzinfo=timezone.utc),
+            datetime(2024, 2, 1, tzinfo=timezone.utc),
+            columns=["open_time", "open_price", "high_price", "low_price", "close_price"],
+        )
+        frames = await load_kline_frames(
+            "ETHUSDT",
+            "1h",
+            datetime(2024, 2, 1, tzinfo=timezone.utc),
+            datetime.now(timezone.utc),
+            cache=cache,
+        )
+    await load_test(frames, kline_rows(history))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
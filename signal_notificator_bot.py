@@ -1,12 +1,169 @@
 import asyncio
+import logging
+import os
+from collections import deque
+from datetime import datetime
+
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 
 from bot import bot
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_USER_ID = 382861786
+# Telegram allows about one message per second to a chat and 30 per second overall.
+CHAT_INTERVAL = 1.0
+GLOBAL_INTERVAL = 1 / 30
+MAX_MESSAGE_LENGTH = 4096
+
 
-async def send_message_to_user(message_text: str, user_id: int = 382861786):
+async def send_message_to_user(message_text: str, user_id: int = DEFAULT_USER_ID):
     await bot.send_message(chat_id=user_id, text=message_text)
 
 
+async def telegram_sink(chat_id: int, text: str) -> None:
+    await bot.send_message(chat_id=chat_id, text=text)
+
+
+async def discard_sink(chat_id: int, text: str) -> None:
+    pass
+
+
+def file_sink(path: str):
+    async def write(chat_id: int, text: str) -> None:
+        with open(path, "a") as file:
+            file.write(f"{datetime.utcnow().isoformat()} {chat_id}\n{text}\n\n")
+    return write
+
+
+def make_sink(name: str | None = os.getenv("notification_sink")):
+    # "telegram" (default), "none" for backtests, anything else is a file path.
+    if name in (None, "", "telegram"):
+        return telegram_sink
+    if name == "none":
+        return discard_sink
+    return file_sink(name)
+
+
+class NotificationOutbox:
+    # notify() only queues, so tick handling never waits on Telegram. A background worker
+    # merges what piled up for each chat into as few messages as fit, within the rate limits.
+    def __init__(
+            self,
+            send=None,
+            chat_interval: float = CHAT_INTERVAL,
+            global_interval: float = GLOBAL_INTERVAL,
+            max_pending: int = 1000,
+            max_attempts: int = 5,
+    ):
+        self.send = send or make_sink()
+        self.chat_interval = chat_interval
+        self.global_interval = global_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.pending = {}
+        self.next_send_at = {}
+        self.wakeup = asyncio.Event()
+        self.worker = None
+        self.in_flight = 0
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+
+    async def __aenter__(self) -> "NotificationOutbox":
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        await self.close()
+
+    async def notify(self, message_text: str, user_id: int = DEFAULT_USER_ID) -> None:
+        # Same signature as send_message_to_user, but returns without any I/O.
+        messages = self.pending.setdefault(user_id, deque(maxlen=self.max_pending))
+        if len(messages) == self.max_pending:
+            self.dropped += 1
+        messages.append(message_text)
+        self.queued += 1
+        self.wakeup.set()
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    def coalesce(self, chat_id: int) -> str:
+        # Oldest queued messages joined up to the Telegram length limit; the rest wait.
+        messages = self.pending[chat_id]
+        text = messages.popleft()[:MAX_MESSAGE_LENGTH]
+        while messages and len(text) + 2 + len(messages[0]) <= MAX_MESSAGE_LENGTH:
+            text = f"{text}\n\n{messages.popleft()}"
+        if not messages:
+            del self.pending[chat_id]
+        return text
+
+    async def deliver(self, chat_id: int, text: str) -> bool:
+        for attempt in range(self.max_attempts):
+            try:
+                await self.send(chat_id, text)
+                self.sent += 1
+                return True
+            except TelegramRetryAfter as e:
+                delay = e.retry_after
+            except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                delay = min(30, 2 ** attempt)
+                logger.warning(f"Notification to {chat_id} failed: {e}, retrying in {delay} sec")
+            except TelegramAPIError as e:
+                logger.error(f"Notification to {chat_id} rejected: {e}")
+                break
+            await asyncio.sleep(delay)
+        self.dropped += 1
+        return False
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                now = loop.time()
+                ready = [chat_id for chat_id in self.pending if self.next_send_at.get(chat_id, 0) <= now]
+                if not ready:
+                    await asyncio.sleep(min(self.next_send_at[chat_id] for chat_id in self.pending) - now)
+                    continue
+                for chat_id in ready:
+                    self.in_flight += 1
+                    try:
+                        await self.deliver(chat_id, self.coalesce(chat_id))
+                    finally:
+                        self.in_flight -= 1
+                    self.next_send_at[chat_id] = loop.time() + self.chat_interval
+                    await asyncio.sleep(self.global_interval)
+
+    async def flush(self, timeout: float = 30.0) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (self.pending or self.in_flight) and self.worker is not None and not self.worker.done() and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def close(self, timeout: float = 30.0) -> None:
+        await self.flush(timeout)
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        logger.info(f"Notification outbox closed: {self.stats()}")
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "pending": sum(len(messages) for messages in self.pending.values()),
+        }
+
+
+outbox = NotificationOutbox()
+
+
 async def main():
     await send_message_to_user(382861786, "Hello, World!")
 
@@ -1,21 +1,31 @@
 import asyncio
+from collections import deque
 from datetime import datetime, timezone, timedelta
 import logging
+import os
+import time
 
 import aiohttp
-import tortoise
+import numpy as np
 import websocket
 import threading
 import ssl
-import json
 
-from db_app.config import db_config
-from db_app.models import KlineData
-from indicators.MACD import search_macd
-from signal_notificator_bot import send_message_to_user
+from db_app.database import database
+from db_app.kline_cache import KlineCache, from_epoch_ms, kline_rows
+from client_API.trade_linking import MINUTE_MS
+from db_app.record_buffers import TradeBuffer
+from indicators.incremental import IncrementalMACD
+from indicators.order_flow import OrderFlowAccumulator
+from indicators.resample import OPEN_TIME, BarAggregator, candle_dict, candle_row
+from signal_notificator_bot import outbox
+from utils.decoders import get_decoder, stream_of
+from utils.latency import TickLatency
 
 
 BASE_API_URL = "https://api.binance.com/api/v3/"
+STREAM_BASE_URL = "wss://stream.binance.com:9443"
+METRICS_PORT = os.getenv("metrics_port")
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -30,116 +40,112 @@ logger.addHandler(file_handler)
 
 
 class SocketConn:
-    def __init__(self, url, kline_data, search_for_trend: str = "decrease"):
+    def __init__(
+            self,
+            url,
+            kline_data,
+            search_for_trend: str = "decrease",
+            notify=outbox.notify,
+            on_processed=None,
+            symbol: str = "ETHUSDT",
+            interval: str = "1h",
+            latency: TickLatency | None = None,
+            order_flow: OrderFlowAccumulator | None = None,
+    ):
         self.url = url
+        self.order_flow = order_flow
+        self.notify = notify
+        self.on_processed = on_processed
+        self.latency = latency or TickLatency()
         self.started = True
-        self.kline_data = kline_data
+        self.indicators = IncrementalMACD.from_klines(kline_data, short_period=1, long_period=6)
+        self.decoder = get_decoder()
         self.current_monitor_signal = self.monitor_decrease_stochastic
         self.count_for_report = 0
-        self.symbol = "ETHUSDT"
-        self.interval = "1h"
+        self.symbol = symbol
+        self.interval = interval
         self.last_hour = datetime.utcnow().replace(tzinfo=timezone.utc)
         self.last_report_minute = datetime.utcnow().replace(tzinfo=timezone.utc)
         self.search_for_trend = search_for_trend
-        self.last_kline = {
-            "open_time": datetime(2024, 2, 27, hour=9, tzinfo=timezone.utc),
-            "open_price": 3219.98,
-            "close_price": 3254.82,
-            "high_price": 3254.82,
-            "low_price": 3219.98,
-        }
-
-    async def __call__(self, *args, **kwargs):
+        self.bars = BarAggregator([interval])
         if self.search_for_trend == "increase":
             self.current_monitor_signal = self.monitor_increase_stochastic
+
+    async def __call__(self, *args, **kwargs):
         proxy_url = "http://18.192.126.104:8888"
-        async with aiohttp.ClientSession(timeout=5) as session:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
             async with session.ws_connect(self.url, ssl=False) as ws: #TODO: return proxy
                 while True:
                     msg = await ws.receive()
+                    if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                        logger.info(f"Stream closed: {msg.type}")
+                        break
                     if msg.type == aiohttp.WSMsgType.TEXT:
-                        data = json.loads(msg.data)
-                        open_time = datetime.utcfromtimestamp(data["k"].get("t") / 1000)
-                        open_price = float(data["k"].get("o"))
-                        high_price = float(data["k"].get("h"))
-                        low_price = float(data["k"].get("l"))
-                        close_price = float(data["k"].get("c"))
-                        current_kline = [
-                            open_time,
-                            open_price,
-                            high_price,
-                            low_price,
-                            close_price,
-                        ]
-                        self.kline_data.append(current_kline)
-                        res = search_macd(self.kline_data, short_period=1, long_period=6)
-                        logger.info(
-                            (
-                                f"Current MACD: {float(format(res['macD'], '.2f'))}, "
-                                f"SIGNAL: {float(format(res['signal'], '.2f'))}, "
-                                f"%K: {float(format(res['%K'], '.2f'))}, "
-                                f"%D: {float(format(res['%D'], '.2f'))}, "
-                            )
-                        )
-                        await self.current_monitor_signal(res)
-                        self.kline_data.pop(-1)
-
-                        if self.started:
-                            await self.on_open(res)
-                            self.started = False
-
-                        if self.last_kline["open_price"] is None:
-                            self.last_kline["open_price"] = current_kline[1]
-                            self.last_kline["open_time"] = current_kline[0]
-
-                        if (
-                                datetime.utcnow().replace(tzinfo=timezone.utc) - self.last_report_minute
-                        ) >= timedelta(minutes=3):
-                            await self.just_monitor(res)
-                            self.last_report_minute = datetime.utcnow().replace(tzinfo=timezone.utc)
-
-                        await self.generate_last_kline(current_kline)
-
-                        if self.last_hour.hour != datetime.utcnow().hour:
-                            self.kline_data.append(
-                                [
-                                    self.last_kline["open_time"],
-                                    self.last_kline["open_price"],
-                                    self.last_kline["high_price"],
-                                    self.last_kline["low_price"],
-                                    self.last_kline["close_price"],
-                                ]
-                            )
-                            await send_message_to_user(
-                                message_text=(
-                                    f"🆕 Adding last hour kline for period 🆕\n"
-                                    f"<em>{self.last_hour.date()}</em>, {self.last_hour.hour}:00 "
-                                    f"to {self.last_hour.hour}:59\n"
-                                    f"\n"
-                                    f"<b>Kline added:</b> \n"
-                                    f"{self.last_kline}"
-                                ),
-                            )
-                            await send_message_to_user(
-                                message_text=(
-                                    f"🆕 New hour kline details 🆕\n"
-                                    f"<b>New period:</b> {self.last_hour.date()}, "
-                                    f"{self.last_hour.hour}:00–{self.last_hour.hour}:59\n"
-                                    f"\n"
-                                    f"New hour open price: {current_kline[1]}"
-                                )
-                            )
-                            self.last_kline = {
-                                "open_price": None,
-                                "close_price": None,
-                                "high_price": None,
-                                "low_price": None
-                            }
-
-                            self.last_hour = datetime.utcnow()
+                        self.latency.begin()
+                        current_kline = self.decoder.kline_event(msg.data)
+                        self.latency.mark("decode")
+                        await self.handle_kline(current_kline)
+                        self.latency.end()
+                        if self.on_processed is not None:
+                            self.on_processed(msg.data)
+
+    async def handle_kline(self, current_kline):
+        res = self.indicators.peek(current_kline)
+        if self.order_flow is not None:
+            res.update(self.order_flow.signals())
+        self.latency.mark("indicators")
+        logger.info(
+            (
+                f"Current MACD: {float(format(res['macD'], '.2f'))}, "
+                f"SIGNAL: {float(format(res['signal'], '.2f'))}, "
+                f"%K: {float(format(res['%K'], '.2f'))}, "
+                f"%D: {float(format(res['%D'], '.2f'))}, "
+            )
+        )
+        self.latency.mark("log")
+        await self.current_monitor_signal(res)
+        self.latency.mark("monitor")
+
+        if self.started:
+            await self.on_open(res)
+            self.started = False
+
+        if (
+                datetime.utcnow().replace(tzinfo=timezone.utc) - self.last_report_minute
+        ) >= timedelta(minutes=3):
+            await self.just_monitor(res)
+            self.last_report_minute = datetime.utcnow().replace(tzinfo=timezone.utc)
+
+        closed = self.bars.update_kline(current_kline)
+        self.latency.mark("report")
+
+        for _, candle in closed:
+            # The stream moved past the candle, so it is final and joins the history.
+            self.indicators.commit(candle_row(candle))
+            self.last_hour = from_epoch_ms(candle[OPEN_TIME])
+            await self.notify(
+                message_text=(
+                    f"🆕 Adding last hour kline for period 🆕\n"
+                    f"<em>{self.last_hour.date()}</em>, {self.last_hour.hour}:00 "
+                    f"to {self.last_hour.hour}:59\n"
+                    f"\n"
+                    f"<b>Kline added:</b> \n"
+                    f"{candle_dict(candle)}"
+                ),
+            )
+            await self.notify(
+                message_text=(
+                    f"🆕 New hour kline details 🆕\n"
+                    f"<b>New period:</b> {current_kline[0].date()}, "
+                    f"{current_kline[0].hour}:00–{current_kline[0].hour}:59\n"
+                    f"\n"
+                    f"New hour open price: {current_kline[1]}"
+                )
+            )
+        self.latency.mark("rollover")
 
     async def on_open(self, kline):
-        await send_message_to_user(
+        await self.notify(
             (
                 f"👀 <b>Connection established, starting monitor</b> 👀\n"
                 f"<b>Looking for</b> {self.search_for_trend} trend\n"
@@ -152,15 +158,8 @@ class SocketConn:
             )
         )
 
-    async def generate_last_kline(self, kline):
-        self.last_kline["close_price"] = kline[4]
-        if self.last_kline["high_price"] is None or self.last_kline["high_price"] < kline[2]:
-            self.last_kline["high_price"] = kline[2]
-        if self.last_kline["low_price"] is None or self.last_kline["low_price"] > kline[3]:
-            self.last_kline["low_price"] = kline[3]
-
     async def just_monitor(self, last_macd_result):
-        await send_message_to_user(
+        await self.notify(
             (
                 f"⏳ Current situation: ⏳\n"
                 f"<ins>Current price</ins>: <b>{float(format(last_macd_result['close'], '.2f'))}</b>\n"
@@ -168,7 +167,7 @@ class SocketConn:
                 f"<ins>Current stochastic %D</ins>: <b>{float(format(last_macd_result['%D'], '.2f'))}</b>\n"
                 f"<ins>Current MACD</ins>: <b>{float(format(last_macd_result['macD'], '.2f'))}</b>\n"
                 f"<ins>Current MACD signal</ins>: <b>{float(format(last_macd_result['signal'], '.2f'))}</b>\n"
-                f"{self.last_kline}"
+                f"{candle_dict(self.bars.current(self.interval))}"
             )
         )
 
@@ -177,7 +176,7 @@ class SocketConn:
         stock_d_value = float(format(last_macd_result["%D"], '.2f'))
         diff = stoch_k_value - stock_d_value
         if diff >= 5:
-            await send_message_to_user(
+            await self.notify(
                 (
                     f"⚡️ <b>Stochastic increase</b> ⚡️\n"
                     f"Current stochastic %K: {stoch_k_value}\n"
@@ -192,7 +191,7 @@ class SocketConn:
         stock_d_value = float(format(last_macd_result["%D"], '.2f'))
         diff = stoch_k_value - stock_d_value
         if diff <= 1:
-            await send_message_to_user(
+            await self.notify(
                 (
                     f"❌ <b>Stochastic decrease</b> ❌\n"
                     f"Current stochastic %K: {stoch_k_value}\n"
@@ -210,7 +209,7 @@ class SocketConn:
         diff = macd_value - signal_value
         stoch_diff = stoch_k_value - stock_d_value
         if diff >= 2 and stoch_diff >= 5:
-            await send_message_to_user(
+            await self.notify(
                 (
                     f"⚠️ <b>SIGNAL</b> ⚠️\n"
                     f"Current MACD: {macd_value}\n"
@@ -224,7 +223,7 @@ class SocketConn:
             )
             self.current_monitor_signal = self.monitor_decrease_stochastic
         elif diff >= 1.5:
-            await send_message_to_user(
+            await self.notify(
                 (
                     f"⚡️ <b>MACD increase</b> ⚡️\n"
                     f"Current MACD: {macd_value}\n"
@@ -241,7 +240,7 @@ class SocketConn:
         stock_d_value = float(format(last_macd_result["%D"], '.2f'))
         stoch_diff = stoch_k_value - stock_d_value
         if diff <= 1 and stoch_diff <= 1:
-            await send_message_to_user(
+            await self.notify(
                 (
                     f"❌ <b>SELL NOW!!!</b> ❌\n"
                     f"Current MACD: {macd_value}\n"
@@ -254,7 +253,7 @@ class SocketConn:
             self.current_monitor_signal = self.monitor_increase_stochastic
 
         if diff <= 1:
-            await send_message_to_user(
+            await self.notify(
                 (
                     f"❌ <b>MACD decrease</b> ❌\n"
                     f"Current MACD: {macd_value}\n"
@@ -264,33 +263,189 @@ class SocketConn:
             )
 
 
-async def main():
-    await tortoise.Tortoise.init(db_config)
-    open_time = datetime(2023, 12, 1, tzinfo=timezone.utc)
-    all_klines = await (
-            KlineData
-            .filter(
-                open_time__gte=open_time,
-                symbmol="ETHUSDT",
+def stream_name(symbol: str, interval: str) -> str:
+    return f"{symbol.lower()}@kline_{interval}"
+
+
+class StreamMultiplexer:
+    # One combined-stream connection (/stream?streams=a/b/...) feeding a SocketConn strategy per
+    # symbol and interval. Strategies only get handle_kline calls; they never open sockets themselves.
+    def __init__(
+            self,
+            base_url: str = STREAM_BASE_URL,
+            notify=outbox.notify,
+            on_processed=None,
+            stats_window: int = 10_000,
+    ):
+        self.base_url = base_url
+        self.notify = notify
+        self.on_processed = on_processed
+        self.stats_window = stats_window
+        self.decoder = get_decoder()
+        self.latency = TickLatency()
+        self.strategies = {}
+        self.trade_buffers = {}
+        self.order_flows = {}
+        self.counts = {}
+        self.processing_ns = {}
+        self.unknown_streams = 0
+        self.started_at = None
+
+    @classmethod
+    async def from_cache(
+            cls,
+            streams: list[tuple[str, str, str]],
+            start: datetime,
+            cache: KlineCache | None = None,
+            **kwargs,
+    ) -> "StreamMultiplexer":
+        # streams are (symbol, interval, search_for_trend); histories come from one shared cache.
+        cache = cache or KlineCache()
+        multiplexer = cls(**kwargs)
+        now = datetime.now(timezone.utc)
+        for symbol, interval, search_for_trend in streams:
+            klines = await cache.load_or_fill(
+                symbol,
+                interval,
+                start,
+                now,
+                columns=["open_time", "open_price", "high_price", "low_price", "close_price"],
             )
-            .order_by("open_time")
+            multiplexer.add(symbol, interval, kline_rows(klines), search_for_trend)
+        return multiplexer
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/stream?streams={'/'.join([*self.strategies, *self.trade_buffers])}"
+
+    def labelled_notify(self, symbol: str, interval: str):
+        async def notify(message_text: str):
+            await self.notify(f"<b>{symbol} {interval}</b>\n{message_text}")
+        return notify
+
+    def add(self, symbol: str, interval: str, kline_data, search_for_trend: str = "decrease") -> SocketConn:
+        name = stream_name(symbol, interval)
+        strategy = SocketConn(
+            None,
+            kline_data,
+            search_for_trend=search_for_trend,
+            notify=self.labelled_notify(symbol, interval),
+            symbol=symbol,
+            interval=interval,
+            latency=self.latency,
+            order_flow=self.order_flows.get(symbol),
         )
-    kline_data = []
-    for kline in all_klines:
-        kline_data.append(
-            [
-                kline.open_time,
-                kline.open_price,
-                kline.high_price,
-                kline.low_price,
-                kline.close_price,
-            ]
+        self.strategies[name] = strategy
+        self.counts[name] = 0
+        self.processing_ns[name] = deque(maxlen=self.stats_window)
+        return strategy
+
+    def add_order_flow(self, symbol: str, window_ms: int = MINUTE_MS) -> OrderFlowAccumulator:
+        # Subscribes to <symbol>@aggTrade; trades are buffered as they come and folded into the
+        # order flow in one vectorized batch right before the symbol's strategies see a kline.
+        name = f"{symbol.lower()}@aggTrade"
+        accumulator = OrderFlowAccumulator(window_ms)
+        self.order_flows[symbol] = accumulator
+        self.trade_buffers[name] = TradeBuffer()
+        self.counts[name] = 0
+        self.processing_ns[name] = deque(maxlen=self.stats_window)
+        for strategy in self.strategies.values():
+            if strategy.symbol == symbol:
+                strategy.order_flow = accumulator
+        return accumulator
+
+    def add_trade(self, data: str) -> None:
+        received_at = time.perf_counter_ns()
+        name, trade = self.decoder.combined_agg_trade_event(data)
+        self.trade_buffers[name].reserve(1)[0] = trade
+        self.counts[name] += 1
+        self.processing_ns[name].append(time.perf_counter_ns() - received_at)
+
+    def flush_trades(self, symbol: str) -> None:
+        buffer = self.trade_buffers.get(f"{symbol.lower()}@aggTrade")
+        if buffer is not None and len(buffer):
+            self.order_flows[symbol].extend(buffer.records)
+            buffer.clear()
+
+    async def dispatch(self, data: str) -> None:
+        if self.trade_buffers and stream_of(data) in self.trade_buffers:
+            self.add_trade(data)
+            return
+        received_at = time.perf_counter_ns()
+        self.latency.begin()
+        name, current_kline = self.decoder.combined_kline_event(data)
+        self.latency.mark("decode")
+        strategy = self.strategies.get(name)
+        if strategy is None:
+            self.unknown_streams += 1
+            return
+        self.flush_trades(strategy.symbol)
+        await strategy.handle_kline(current_kline)
+        self.latency.end()
+        self.counts[name] += 1
+        self.processing_ns[name].append(time.perf_counter_ns() - received_at)
+        if self.on_processed is not None:
+            self.on_processed(name, data)
+
+    async def __call__(self, *args, **kwargs):
+        logger.info(f"Subscribing to {len(self.strategies)} streams")
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+            async with session.ws_connect(self.url, ssl=False) as ws:
+                self.started_at = time.perf_counter()
+                while True:
+                    msg = await ws.receive()
+                    if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                        logger.info(f"Stream closed: {msg.type}")
+                        break
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        await self.dispatch(msg.data)
+        logger.info(f"Stream stats: {self.stats()}")
+
+    def stats(self) -> dict[str, dict]:
+        # Per stream message count, rate since connecting and handling time percentiles.
+        elapsed = time.perf_counter() - self.started_at if self.started_at is not None else 0.0
+        stats = {}
+        for name, count in self.counts.items():
+            processing_ms = np.asarray(self.processing_ns[name], dtype=np.float64) / 1e6
+            stats[name] = {
+                "messages": count,
+                "rate_per_s": count / elapsed if elapsed else 0.0,
+            }
+            if len(processing_ms):
+                stats[name].update(
+                    {
+                        "p50_ms": float(np.percentile(processing_ms, 50)),
+                        "p99_ms": float(np.percentile(processing_ms, 99)),
+                        "max_ms": float(processing_ms.max()),
+                    }
+                )
+        return stats
+
+
+async def main():
+    async with database:
+        open_time = datetime(2023, 12, 1, tzinfo=timezone.utc)
+        klines = await KlineCache().load_or_fill(
+            "ETHUSDT",
+            "1h",
+            open_time,
+            datetime.now(timezone.utc),
+            columns=["open_time", "open_price", "high_price", "low_price", "close_price"],
         )
+    kline_data = kline_rows(klines)
+    # replay_server.ReplayServer's default address; it serves plain ws:// unless given a certfile.
     socket_conn = SocketConn(
-        "wss://127.0.0.1:5555",
+        "ws://127.0.0.1:5555",
         kline_data,
         search_for_trend="increase",)
+    metrics_runner = None
+    if METRICS_PORT is not None:
+        metrics_runner = await socket_conn.latency.serve(port=int(METRICS_PORT))
     await socket_conn()
+    logger.info(f"Tick latency: {socket_conn.latency.snapshot()}")
+    await outbox.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,101 @@
+import asyncio
+
+from aws_ssh_app.proxy_recycler import ProxyRecycler
+
+
+class StandInConnection:
+    # Stands in for an asyncssh connection: records commands instead of running them.
+    def __init__(self, commands: list[str]):
+        self.commands = commands
+        self.closed = False
+
+    async def run(self, command: str, check: bool = False):
+        self.commands.append(command)
+
+    def is_closed(self) -> bool:
+        return self.closed
+
+    def close(self) -> None:
+        self.closed = True
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+class StandInPool:
+    def __init__(self):
+        self.events = []
+
+    async def drain(self, proxy: str) -> None:
+        self.events.append(("drain", proxy))
+
+    async def resume(self, proxy: str) -> None:
+        self.events.append(("resume", proxy))
+
+
+async def answer_ok(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    # A local HTTP proxy stand-in that answers every forwarded request with 200.
+    await reader.readuntil(b"\r\n\r\n")
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+    await writer.drain()
+    writer.close()
+
+
+def stand_in_recycler(proxy_port: int, commands: list[str]) -> ProxyRecycler:
+    async def connect(**kwargs):
+        return StandInConnection(commands)
+
+    return ProxyRecycler(
+        port=22,
+        username="ubuntu",
+        keys_path="keys/",
+        proxy_port=proxy_port,
+        probe_url="http://api.binance.com/api/v3/ping",
+        probe_timeout=1.0,
+        ready_timeout=1.0,
+        connect=connect,
+    )
+
+
+def test_recycle_restarts_probes_and_hands_back_each_proxy():
+    async def scenario():
+        server = await asyncio.start_server(answer_ok, "127.0.0.1", 0)
+        proxy_port = server.sockets[0].getsockname()[1]
+        commands = []
+        pool = StandInPool()
+        servers = [{"dns_name": "127.0.0.1", "instance_id": "i-1"}]
+        async with server, stand_in_recycler(proxy_port, commands) as recycler:
+            ready = await recycler.recycle(servers, pool)
+        return ready, servers, commands, pool.events, proxy_port
+
+    ready, servers, commands, events, proxy_port = asyncio.run(scenario())
+    proxy = f"http://127.0.0.1:{proxy_port}"
+    assert ready == servers
+    assert commands == ["sudo systemctl restart tinyproxy"]
+    assert events == [("drain", proxy), ("resume", proxy)]
+
+
+def test_unready_proxy_stays_drained_until_a_later_probe_passes():
+    async def scenario():
+        # Bind and close a socket to get a local port nothing listens on yet.
+        server = await asyncio.start_server(answer_ok, "127.0.0.1", 0)
+        proxy_port = server.sockets[0].getsockname()[1]
+        server.close()
+        await server.wait_closed()
+        pool = StandInPool()
+        recycler = stand_in_recycler(proxy_port, [])
+        recycler.retry_interval = 0.05
+        async with recycler:
+            ready = await recycler.recycle([{"dns_name": "127.0.0.1", "instance_id": "i-1"}], pool)
+            events_while_down = list(pool.events)
+            async with await asyncio.start_server(answer_ok, "127.0.0.1", proxy_port):
+                for _ in range(100):
+                    if not recycler.reprobes:
+                        break
+                    await asyncio.sleep(0.05)
+        return ready, events_while_down, pool.events
+
+    ready, events_while_down, events = asyncio.run(scenario())
+    assert ready == []
+    assert [event for event, _ in events_while_down] == ["drain"]
+    assert [event for event, _ in events] == ["drain", "resume"]
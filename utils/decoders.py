@@ -0,0 +1,215 @@
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+from db_app.kline_cache import KLINE_DTYPE, KLINE_FIELDS
+from db_app.record_buffers import BEST_PRICE_MATCH, BUYER_MARKET_MAKER, TRADE_DTYPE, KlineBuffer, TradeBuffer
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Field order of a /api/v3/klines row.
+REST_KLINE_DTYPE = np.dtype(
+    [
+        ("open_time", "<i8"),
+        ("open_price", "<f8"),
+        ("high_price", "<f8"),
+        ("low_price", "<f8"),
+        ("close_price", "<f8"),
+        ("volume", "<f8"),
+        ("close_time", "<i8"),
+        ("quote_asset_volume", "<f8"),
+        ("number_of_trades", "<i8"),
+        ("buy_base_asset_volume", "<f8"),
+        ("buy_quote_asset_volume", "<f8"),
+        ("ignore", "S1"),
+    ]
+)
+
+
+def stream_of(payload) -> str:
+    # Binance puts "stream" first in combined frames, so the name is read without parsing the event.
+    if isinstance(payload, bytes):
+        payload = payload.decode()
+    if payload.startswith('{"stream":"'):
+        return payload[11:payload.index('"', 11)]
+    return json.loads(payload)["stream"]
+
+
+def agg_trade_record(trade) -> tuple:
+    # An aggTrade dict in TRADE_DTYPE field order.
+    return (
+        trade["a"], float(trade["p"]), float(trade["q"]), trade["f"], trade["l"], trade["T"],
+        BUYER_MARKET_MAKER * trade["m"] + BEST_PRICE_MATCH * trade["M"],
+        -1,
+    )
+
+
+class StdlibDecoder:
+    # Decodes with a loads function and fills the project's buffers field by field.
+    name = "json"
+
+    def __init__(self, loads=json.loads):
+        self.loads = loads
+
+    def kline_event(self, payload) -> list:
+        # [open_time, open, high, low, close], the row shape SocketConn works with.
+        kline = self.loads(payload)["k"]
+        return [
+            datetime.utcfromtimestamp(kline["t"] / 1000),
+            float(kline["o"]),
+            float(kline["h"]),
+            float(kline["l"]),
+            float(kline["c"]),
+        ]
+
+    def combined_kline_event(self, payload) -> tuple[str, list]:
+        # Frames of /stream?streams=... wrap the event as {"stream": name, "data": event}.
+        event = self.loads(payload)
+        kline = event["data"]["k"]
+        return event["stream"], [
+            datetime.utcfromtimestamp(kline["t"] / 1000),
+            float(kline["o"]),
+            float(kline["h"]),
+            float(kline["l"]),
+            float(kline["c"]),
+        ]
+
+    def agg_trade_event(self, payload) -> tuple:
+        # One <symbol>@aggTrade event in TRADE_DTYPE field order.
+        return agg_trade_record(self.loads(payload))
+
+    def combined_agg_trade_event(self, payload) -> tuple[str, tuple]:
+        event = self.loads(payload)
+        return event["stream"], agg_trade_record(event["data"])
+
+    def rest_klines(self, payload) -> np.ndarray:
+        buffer = KlineBuffer(0)
+        buffer.extend_klines(self.loads(payload))
+        return buffer.records
+
+    def agg_trades(self, payload) -> np.ndarray:
+        buffer = TradeBuffer(0)
+        buffer.extend_agg_trades(self.loads(payload))
+        return buffer.records
+
+
+class OrjsonDecoder(StdlibDecoder):
+    name = "orjson"
+
+    def __init__(self):
+        super().__init__(orjson.loads)
+
+
+if msgspec is not None:
+    class KlinePayload(msgspec.Struct):
+        t: int
+        o: float
+        h: float
+        l: float
+        c: float
+
+    class KlineEvent(msgspec.Struct):
+        k: KlinePayload
+
+    class CombinedKlineEvent(msgspec.Struct):
+        stream: str
+        data: KlineEvent
+
+    RestKlineRow = tuple[int, float, float, float, float, float, int, float, int, float, float, str]
+
+    class AggTrade(msgspec.Struct):
+        a: int
+        p: float
+        q: float
+        f: int
+        l: int
+        T: int
+        m: bool
+        M: bool
+
+    class CombinedAggTradeEvent(msgspec.Struct):
+        stream: str
+        data: AggTrade
+
+
+class MsgspecDecoder:
+    # Typed schemas; strict=False lets msgspec parse Binance's quoted decimals straight to float.
+    name = "msgspec"
+
+    def __init__(self):
+        self.loads = msgspec.json.decode
+        self.kline_event_decoder = msgspec.json.Decoder(KlineEvent, strict=False)
+        self.combined_kline_event_decoder = msgspec.json.Decoder(CombinedKlineEvent, strict=False)
+        self.rest_klines_decoder = msgspec.json.Decoder(list[RestKlineRow], strict=False)
+        self.agg_trades_decoder = msgspec.json.Decoder(list[AggTrade], strict=False)
+        self.agg_trade_event_decoder = msgspec.json.Decoder(AggTrade, strict=False)
+        self.combined_agg_trade_event_decoder = msgspec.json.Decoder(CombinedAggTradeEvent, strict=False)
+
+    def kline_event(self, payload) -> list:
+        kline = self.kline_event_decoder.decode(payload).k
+        return [datetime.utcfromtimestamp(kline.t / 1000), kline.o, kline.h, kline.l, kline.c]
+
+    def combined_kline_event(self, payload) -> tuple[str, list]:
+        event = self.combined_kline_event_decoder.decode(payload)
+        kline = event.data.k
+        return event.stream, [datetime.utcfromtimestamp(kline.t / 1000), kline.o, kline.h, kline.l, kline.c]
+
+    @staticmethod
+    def _trade_record(trade) -> tuple:
+        return (
+            trade.a, trade.p, trade.q, trade.f, trade.l, trade.T,
+            BUYER_MARKET_MAKER * trade.m + BEST_PRICE_MATCH * trade.M,
+            -1,
+        )
+
+    def agg_trade_event(self, payload) -> tuple:
+        return self._trade_record(self.agg_trade_event_decoder.decode(payload))
+
+    def combined_agg_trade_event(self, payload) -> tuple[str, tuple]:
+        event = self.combined_agg_trade_event_decoder.decode(payload)
+        return event.stream, self._trade_record(event.data)
+
+    def rest_klines(self, payload) -> np.ndarray:
+        rows = np.array(self.rest_klines_decoder.decode(payload), dtype=REST_KLINE_DTYPE)
+        records = np.empty(len(rows), dtype=KLINE_DTYPE)
+        for name in KLINE_FIELDS:
+            records[name] = rows[name]
+        return records
+
+    def agg_trades(self, payload) -> np.ndarray:
+        trades = self.agg_trades_decoder.decode(payload)
+        return np.array(
+            [
+                (
+                    trade.a, trade.p, trade.q, trade.f, trade.l, trade.T,
+                    BUYER_MARKET_MAKER * trade.m + BEST_PRICE_MATCH * trade.M,
+                    -1,
+                )
+                for trade in trades
+            ],
+            dtype=TRADE_DTYPE,
+        )
+
+
+DECODERS = {"json": StdlibDecoder}
+if orjson is not None:
+    DECODERS["orjson"] = OrjsonDecoder
+if msgspec is not None:
+    DECODERS["msgspec"] = MsgspecDecoder
+
+
+def get_decoder(backend: str | None = os.getenv("json_backend")):
+    # Fastest installed backend unless one is named explicitly.
+    if backend is None:
+        backend = next(name for name in ("msgspec", "orjson", "json") if name in DECODERS)
+    return DECODERS[backend]()
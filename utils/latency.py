@@ -0,0 +1,170 @@
+import logging
+import os
+import time
+
+import numpy as np
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Values below 2**SUB_BUCKET_BITS ns get exact buckets, larger ones keep 6 significant bits (~1.6% error).
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS // 2
+MAX_EXPONENT = 40
+
+LATENCY_BUDGET_MS = float(os.getenv("latency_budget_ms", "50"))
+METRICS_PATH = os.getenv("metrics_path")
+METRICS_EXPORT_INTERVAL = float(os.getenv("metrics_export_interval", "60"))
+
+
+def bucket_index(value: int) -> int:
+    if value < SUB_BUCKETS:
+        return max(value, 0)
+    exponent = min(value.bit_length() - SUB_BUCKET_BITS, MAX_EXPONENT)
+    index = SUB_BUCKETS + (exponent - 1) * HALF_SUB_BUCKETS + (value >> exponent) - HALF_SUB_BUCKETS
+    return min(index, SUB_BUCKETS + MAX_EXPONENT * HALF_SUB_BUCKETS - 1)
+
+
+def bucket_values(size: int) -> np.ndarray:
+    # Upper edge of every bucket, so percentiles never under-report.
+    values = np.arange(size, dtype=np.int64)
+    large = values >= SUB_BUCKETS
+    exponent = (values[large] - SUB_BUCKETS) // HALF_SUB_BUCKETS + 1
+    mantissa = (values[large] - SUB_BUCKETS) % HALF_SUB_BUCKETS + HALF_SUB_BUCKETS
+    values[large] = ((mantissa + 1) << exponent) - 1
+    return values
+
+
+class LatencyHistogram:
+    # Log-linear histogram of nanosecond durations with a fixed number of buckets, like HdrHistogram.
+    size = SUB_BUCKETS + MAX_EXPONENT * HALF_SUB_BUCKETS
+    values = bucket_values(size)
+
+    def __init__(self):
+        # A list, since incrementing one numpy element costs several times more per record.
+        self.counts = [0] * self.size
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> int:
+        if not self.count:
+            return 0
+        rank = max(1, int(np.ceil(self.count * q / 100)))
+        index = int(np.searchsorted(np.cumsum(self.counts, dtype=np.int64), rank))
+        return min(int(self.values[index]), self.max)
+
+    def reset(self) -> None:
+        self.counts = [0] * self.size
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "p50_ms": self.percentile(50) / 1e6,
+            "p99_ms": self.percentile(99) / 1e6,
+            "max_ms": self.max / 1e6,
+        }
+
+
+class TickLatency:
+    # Per-stage timings of one tick: begin(), mark(stage) after each stage, end().
+    # Ticks slower than budget_ms are logged with their stage breakdown.
+    def __init__(
+            self,
+            name: str = "strategy",
+            budget_ms: float = LATENCY_BUDGET_MS,
+            export_path: str | None = METRICS_PATH,
+            export_interval: float = METRICS_EXPORT_INTERVAL,
+    ):
+        self.name = name
+        self.budget_ns = int(budget_ms * 1e6)
+        self.export_path = export_path
+        self.export_interval = export_interval
+        self.histograms = {}
+        self.total = LatencyHistogram()
+        self.over_budget = 0
+        self.tick_stages = {}
+        self.started_at = 0
+        self.marked_at = 0
+        self.exported_at = time.monotonic()
+
+    def begin(self) -> None:
+        self.started_at = self.marked_at = time.perf_counter_ns()
+        self.tick_stages.clear()
+
+    def mark(self, stage: str) -> None:
+        now = time.perf_counter_ns()
+        elapsed = now - self.marked_at
+        self.marked_at = now
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.record(elapsed)
+        self.tick_stages[stage] = self.tick_stages.get(stage, 0) + elapsed
+
+    def end(self) -> None:
+        elapsed = time.perf_counter_ns() - self.started_at
+        self.total.record(elapsed)
+        if elapsed > self.budget_ns:
+            self.over_budget += 1
+            logger.warning(
+                f"Slow tick {elapsed / 1e6:.2f} ms: "
+                + ", ".join(f"{stage} {value / 1e6:.2f} ms" for stage, value in self.tick_stages.items())
+            )
+        if self.export_path is not None and time.monotonic() - self.exported_at >= self.export_interval:
+            self.export()
+
+    def snapshot(self) -> dict:
+        stages = {stage: histogram.summary() for stage, histogram in self.histograms.items()}
+        stages["tick"] = self.total.summary()
+        stages["tick"]["over_budget"] = self.over_budget
+        return stages
+
+    def prometheus_text(self) -> str:
+        # Prometheus text exposition, one summary per stage plus the whole tick.
+        metric = f"{self.name}_stage_seconds"
+        lines = [
+            f"# HELP {metric} Time spent in each stage of a tick.",
+            f"# TYPE {metric} summary",
+        ]
+        for stage, histogram in (*self.histograms.items(), ("tick", self.total)):
+            for quantile in (0.5, 0.9, 0.99, 1.0):
+                value = histogram.max if quantile == 1.0 else histogram.percentile(quantile * 100)
+                lines.append(f'{metric}{{stage="{stage}",quantile="{quantile}"}} {value / 1e9:.9f}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram.total / 1e9:.9f}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {histogram.count}')
+        lines.append(f"# TYPE {self.name}_ticks_over_budget_total counter")
+        lines.append(f"{self.name}_ticks_over_budget_total {self.over_budget}")
+        return "\n".join(lines) + "\n"
+
+    def export(self) -> None:
+        # Written next to the target and renamed, so a textfile collector never reads half a file.
+        temporary_path = f"{self.export_path}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(self.prometheus_text())
+        os.replace(temporary_path, self.export_path)
+        self.exported_at = time.monotonic()
+
+    async def serve(self, host: str = "0.0.0.0", port: int = 9108) -> web.AppRunner:
+        # /metrics endpoint for Prometheus to scrape; cleanup the returned runner to stop it.
+        async def metrics(request: web.Request) -> web.Response:
+            return web.Response(text=self.prometheus_text(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Serving {self.name} metrics on http://{host}:{port}/metrics")
+        return runner